@@ -1,11 +1,20 @@
 import blenderproc as bproc
 import argparse
+import numpy as np
 import os
+import sys
+
+# shared helpers of the generators, in the sibling Dope-annotation folder (see README.md)
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Dope-annotation'))
+from camera_trajectory import load_poses
+from coco_builder import CocoBuilder
 
 parser = argparse.ArgumentParser()
-parser.add_argument('camera', nargs='?', default="camera_positions", help="Path to the camera file")
+parser.add_argument('camera', nargs='?', default="camera_positions", help="Path to the camera file: 'x y z rx ry rz' text lines or a .npy file of camera_trajectory.py")
 parser.add_argument('scene', nargs='?', default="scene.blend", help="Path to the scene.blend file")
 parser.add_argument('output_dir', nargs='?', default="output", help="Path to where the final files will be saved ")
+parser.add_argument('--coco_shard_size', default=0, type=int, help="Images per COCO annotation file (listed in coco_index.json), 0 writes a single coco_annotations.json")
+parser.add_argument('--chunk_size', default=100, type=int, help="Camera poses rendered and written at a time, 0 renders the whole trajectory at once")
 args = parser.parse_args()
 
 bproc.init()
@@ -26,24 +35,34 @@ light.set_energy(1000)
 # define the camera intrinsics
 bproc.camera.set_resolution(512, 512)
 
-# read the camera positions file and convert into homogeneous camera-world transformation
-with open(args.camera, "r") as f:
-    for line in f.readlines():
-        line = [float(x) for x in line.split()]
-        position, euler_rotation = line[:3], line[3:6]
-        matrix_world = bproc.math.build_transformation_mat(position, euler_rotation)
-        bproc.camera.add_camera_pose(matrix_world)
-
 # activate normal rendering
 bproc.renderer.enable_normals_output()
 bproc.renderer.enable_segmentation_output(map_by=["category_id", "instance", "name"])
 
-# render the whole pipeline
-data = bproc.renderer.render()
+# COCO annotations are appended image by image and written out at the end
+coco = CocoBuilder(os.path.join(args.output_dir, 'coco_data'), shard_size=args.coco_shard_size,
+                   image_extension='.jpg')
+
+# read the camera positions (memory-mapped for .npy files) and render them chunk by chunk
+poses = load_poses(args.camera)
+chunk_size = args.chunk_size if args.chunk_size > 0 else max(1, len(poses))
+for start in range(0, len(poses), chunk_size):
+    # convert into homogeneous camera-world transformation
+    for frame, pose in enumerate(np.asarray(poses[start:start + chunk_size], dtype=float)):
+        position, euler_rotation = pose[:3], pose[3:6]
+        matrix_world = bproc.math.build_transformation_mat(position, euler_rotation)
+        bproc.camera.add_camera_pose(matrix_world, frame=frame)
+
+    # render the poses of this chunk
+    data = bproc.renderer.render()
+
+    # Add the images of this chunk to the coco data
+    for segmap, attribute_map, color in zip(data["instance_segmaps"],
+                                            data["instance_attribute_maps"], data["colors"]):
+        coco.add_image(segmap, attribute_map, color=color)
+
+    # only one chunk of images is held in memory at a time
+    del data
+    bproc.utility.reset_keyframes()
 
-# Write data to coco file
-bproc.writer.write_coco_annotations(os.path.join(args.output_dir, 'coco_data'),
-                                    instance_segmaps=data["instance_segmaps"],
-                                    instance_attribute_maps=data["instance_attribute_maps"],
-                                    colors=data["colors"],
-                                    color_file_format="JPEG")
+coco.close()
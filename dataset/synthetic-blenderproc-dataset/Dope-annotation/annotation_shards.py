@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+
+"""
+Compact, sharded binary form of the DOPE frame annotations.
+
+Frames are appended to shards of fixed-width NumPy arrays, one .npy file per
+field, so a whole dataset is loaded with a handful of memory maps instead of
+one json.load per frame. Frame level fields are indexed by frame, object level
+fields by object, and 'object_offsets' gives the objects of every frame:
+
+    objects of frame i = object_offsets[i] : object_offsets[i+1]
+
+index.json lists the shards and the class names. Generators write a shard
+every few hundred frames, so a crash loses little, and a resumed run skips the
+frames that are already stored. Existing DOPE JSON directories are converted
+with
+
+    python annotation_shards.py convert <json directory> <output directory>
+"""
+
+import argparse
+import glob
+import json
+import os
+import shutil
+
+import numpy as np
+
+
+INDEX_NAME = 'index.json'
+FRAMES_PER_SHARD = 500
+
+FRAME_FIELDS = ['frame_names', 'image_size', 'intrinsics', 'look_at', 'object_offsets']
+OBJECT_FIELDS = ['class_ids', 'names', 'visibility', 'truncated', 'bounding_box',
+                 'projected_cuboid', 'location', 'quaternion_xyzw']
+# field -> dtype and shape of one row
+FIELD_TYPES = {
+    'frame_names': (str, ()),
+    'image_size': (np.int32, (2,)),
+    'intrinsics': (np.float32, (4,)),
+    'look_at': (np.float32, (3, 3)),
+    'object_offsets': (np.int64, ()),
+    'class_ids': (np.int16, ()),
+    'names': (str, ()),
+    'visibility': (np.int32, ()),
+    'truncated': (bool, ()),
+    'bounding_box': (np.int32, (4,)),
+    'projected_cuboid': (np.float32, (9, 2)),
+    'location': (np.float32, (3,)),
+    'quaternion_xyzw': (np.float32, (4,)),
+}
+
+
+def _vector(values, size):
+    """Fixed-width float vector; missing values are NaN."""
+    out = np.full(size, np.nan, dtype=np.float32)
+    if values is not None:
+        out[:] = np.asarray(values, dtype=np.float32).reshape(size)
+    return out
+
+
+def field_array(name, values):
+    """Array of a field from a list of rows."""
+    dtype, shape = FIELD_TYPES[name]
+    return np.array(values, dtype=dtype).reshape((-1,) + shape)
+
+
+def visible_pixels(obj):
+    """Visible pixel count of an object; NVISII files keep it in 'px_count_visib'."""
+    if 'px_count_visib' in obj:
+        return int(obj['px_count_visib'])
+    return int(obj.get('visibility', -1))
+
+
+def bounding_box(obj):
+    """[x_min, y_min, x_max, y_max] of an object, -1 if it has none."""
+    if obj.get('bounding_box') is not None:
+        return obj['bounding_box']['top_left'] + obj['bounding_box']['bottom_right']
+    if obj.get('bounding_box_minx_maxx_miny_maxy') is not None:
+        x_min, x_max, y_min, y_max = obj['bounding_box_minx_maxx_miny_maxy']
+        return [x_min, y_min, x_max, y_max]
+    return [-1, -1, -1, -1]
+
+
+class ShardedAnnotationWriter:
+    """
+    Appends DOPE annotation dictionaries (as returned by write_json) to shards
+    of 'frames_per_shard' frames. Appending to an existing directory adds new
+    shards after the existing ones, and frames already stored there are
+    skipped, so a resumed run does not duplicate them.
+    """
+
+    def __init__(self, out_directory, frames_per_shard=FRAMES_PER_SHARD):
+        self.out_directory = out_directory
+        self.frames_per_shard = frames_per_shard
+        os.makedirs(out_directory, exist_ok=True)
+
+        self.index = {'shards': [], 'classes': []}
+        index_path = os.path.join(out_directory, INDEX_NAME)
+        if os.path.exists(index_path):
+            with open(index_path) as f:
+                self.index = json.load(f)
+        self._class_ids = {name: ii for ii, name in enumerate(self.index['classes'])}
+        self.stored = set()
+        self.nb_appended = 0 # frames added by this writer, duplicates of stored frames excluded
+        for shard in self.index['shards']:
+            names = np.load(os.path.join(out_directory, shard['name'], 'frame_names.npy'))
+            self.stored.update(str(nn) for nn in names)
+        self._reset()
+
+    def __contains__(self, frame_name):
+        return frame_name in self.stored or frame_name in self._buffered
+
+    def append_missing(self, json_paths):
+        """
+        Append the frames of 'json_paths' (frame name -> DOPE JSON file) that
+        are not stored yet, e.g. frames a resumed run skips because they are
+        complete but whose annotations were lost with an interrupted run.
+        Returns the number of frames appended.
+        """
+        nb_frames = 0
+        for frame_name, path in json_paths.items():
+            if frame_name in self or not os.path.exists(path):
+                continue
+            with open(path) as f:
+                nb_frames += self.append(frame_name, json.load(f))
+        return nb_frames
+
+    def append(self, frame_name, data):
+        """Buffer the annotations of a frame; returns False if the frame is already stored."""
+        if frame_name in self:
+            return False
+        self._buffered.add(frame_name)
+        self.nb_appended += 1
+        camera = data['camera_data']
+        look_at = camera.get('camera_look_at', {})
+        intrinsics = camera.get('intrinsics', {})
+        self._frames['frame_names'].append(frame_name)
+        self._frames['image_size'].append([camera.get('width', 0), camera.get('height', 0)])
+        self._frames['intrinsics'].append(_vector([intrinsics.get(kk, np.nan)
+                                                   for kk in ('fx', 'fy', 'cx', 'cy')], 4))
+        self._frames['look_at'].append(np.stack([_vector(look_at.get(kk), 3)
+                                                 for kk in ('at', 'eye', 'up')]))
+
+        for oo in data['objects']:
+            if oo['class'] not in self._class_ids:
+                self._class_ids[oo['class']] = len(self.index['classes'])
+                self.index['classes'].append(oo['class'])
+            self._objects['class_ids'].append(self._class_ids[oo['class']])
+            self._objects['names'].append(oo.get('name', ''))
+            self._objects['visibility'].append(visible_pixels(oo))
+            self._objects['truncated'].append(bool(oo.get('truncated', False)))
+            self._objects['bounding_box'].append(bounding_box(oo))
+            self._objects['projected_cuboid'].append(_vector(oo.get('projected_cuboid'), (9, 2)))
+            self._objects['location'].append(_vector(oo.get('location'), 3))
+            self._objects['quaternion_xyzw'].append(_vector(oo.get('quaternion_xyzw'), 4))
+        self._frames['object_offsets'].append(len(self._objects['class_ids']))
+
+        if len(self._frames['frame_names']) >= self.frames_per_shard:
+            self.flush()
+        return True
+
+    def flush(self):
+        """Write the frames appended so far as a new shard and update the index."""
+        nb_frames = len(self._frames['frame_names'])
+        if nb_frames == 0:
+            return
+
+        arrays = {field: field_array(field, values) for field, values in self._frames.items()}
+        arrays['object_offsets'] = field_array('object_offsets', [0] + self._frames['object_offsets'])
+        arrays.update({field: field_array(field, values) for field, values in self._objects.items()})
+
+        # the shard is complete on disk before the index lists it; a directory left by a crash
+        # before the index was written is replaced
+        name = f"shard_{len(self.index['shards']):05d}"
+        shard_directory = os.path.join(self.out_directory, name)
+        tmp_directory = f"{shard_directory}.{os.getpid()}.tmp"
+        os.makedirs(tmp_directory, exist_ok=True)
+        for field, array in arrays.items():
+            np.save(os.path.join(tmp_directory, field + '.npy'), array)
+        if os.path.isdir(shard_directory):
+            shutil.rmtree(shard_directory)
+        os.replace(tmp_directory, shard_directory)
+
+        self.index['shards'].append({'name': name,
+                                     'nb_frames': nb_frames,
+                                     'nb_objects': len(self._objects['class_ids'])})
+        self._write_index()
+        self.stored.update(self._buffered)
+        self._reset()
+
+    def close(self):
+        self.flush()
+        self._write_index()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _reset(self):
+        self._buffered = set()
+        self._frames = {field: [] for field in FRAME_FIELDS}
+        self._objects = {field: [] for field in OBJECT_FIELDS}
+
+    def _write_index(self):
+        index_path = os.path.join(self.out_directory, INDEX_NAME)
+        with open(index_path + '.tmp', 'w') as f:
+            json.dump(self.index, f, indent=4)
+        os.replace(index_path + '.tmp', index_path)
+
+
+class AnnotationShards:
+    """
+    Memory-mapped view of a sharded annotation directory. shards[i][field]
+    gives one field of one shard; field(name) concatenates it over all the
+    shards (a plain memory map when there is a single shard).
+    """
+
+    def __init__(self, directory, mmap_mode='r'):
+        with open(os.path.join(directory, INDEX_NAME)) as f:
+            self.index = json.load(f)
+        self.classes = self.index['classes']
+        self.shards = []
+        for shard in self.index['shards']:
+            shard_directory = os.path.join(directory, shard['name'])
+            self.shards.append({field: np.load(os.path.join(shard_directory, field + '.npy'),
+                                               mmap_mode=mmap_mode)
+                                for field in FRAME_FIELDS + OBJECT_FIELDS})
+        self.frame_starts = np.cumsum([0] + [ss['nb_frames'] for ss in self.index['shards']])
+
+    def __len__(self):
+        return int(self.frame_starts[-1])
+
+    def field(self, name):
+        if not self.shards:
+            return field_array(name, [0] if name == 'object_offsets' else [])
+        if name == 'object_offsets':
+            starts = np.cumsum([0] + [ss['nb_objects'] for ss in self.index['shards']])
+            return np.concatenate([[0]] + [shard[name][1:] + start
+                                           for shard, start in zip(self.shards, starts)])
+        if len(self.shards) == 1:
+            return self.shards[0][name]
+        return np.concatenate([shard[name] for shard in self.shards])
+
+    def frame(self, index):
+        """Annotations of one frame as a dictionary of arrays."""
+        shard_index = int(np.searchsorted(self.frame_starts, index, side='right')) - 1
+        shard = self.shards[shard_index]
+        ii = index - self.frame_starts[shard_index]
+        start, end = shard['object_offsets'][ii], shard['object_offsets'][ii+1]
+        frame = {field: shard[field][ii] for field in FRAME_FIELDS if field != 'object_offsets'}
+        frame.update({field: shard[field][start:end] for field in OBJECT_FIELDS})
+        return frame
+
+
+def is_frame_annotation(data):
+    return isinstance(data, dict) and 'camera_data' in data and 'objects' in data
+
+
+def convert(json_directory, out_directory, frames_per_shard=100000):
+    """
+    Convert a directory of DOPE JSON files (searched recursively) to shards.
+    Returns the number of frames added; frames already in 'out_directory' are skipped.
+    """
+    paths = sorted(glob.glob(os.path.join(json_directory, '**', '*.json'), recursive=True))
+    with ShardedAnnotationWriter(out_directory, frames_per_shard) as writer:
+        for path in paths:
+            name = os.path.splitext(os.path.relpath(path, json_directory))[0]
+            if name in writer:
+                continue
+            with open(path) as f:
+                data = json.load(f)
+            if is_frame_annotation(data):
+                writer.append(name, data)
+    return writer.nb_appended
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    convert_parser = subparsers.add_parser('convert', help="convert DOPE JSON files to shards")
+    convert_parser.add_argument('json_directory', help="directory of DOPE JSON files")
+    convert_parser.add_argument('out_directory', help="directory of the sharded annotations")
+    convert_parser.add_argument('--frames_per_shard', default=100000, type=int,
+                                help="how many frames each shard holds")
+
+    opt = parser.parse_args()
+    nb = convert(opt.json_directory, opt.out_directory, opt.frames_per_shard)
+    print(f"{nb} frames added to '{opt.out_directory}'")
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+
+"""
+Load each model once and instance it as linked duplicates.
+
+The first request for a model path loads the OBJ file; every further request
+for the same path returns a linked duplicate that shares the mesh and material
+data of the first instance, so neither memory nor loading time grow with the
+number of objects drawn from the same model.
+
+Loaded models are also kept as a .blend file next to the OBJ file
+('door6.obj' -> 'door6.cache.blend'). Later runs load that binary file
+instead of parsing the OBJ/MTL text again. It is rebuilt whenever the OBJ file,
+its MTL files or its textures are newer than the cache.
+
+Must be imported after blenderproc, from a script run with 'blenderproc run'.
+"""
+
+import glob
+import os
+import threading
+
+import blenderproc as bp
+import bpy
+
+
+CACHE_SUFFIX = '.cache.blend'
+SOURCE_PATTERNS = ['*.mtl', '*.png', '*.jpg', '*.jpeg']
+
+
+def cache_path(model_path):
+    return os.path.splitext(model_path)[0] + CACHE_SUFFIX
+
+
+def _source_mtime(model_path):
+    """Latest modification time of the OBJ file and the files of its directory it may use."""
+    directory = os.path.dirname(model_path)
+    paths = [model_path]
+    for pattern in SOURCE_PATTERNS:
+        paths += glob.glob(os.path.join(directory, pattern))
+    return max(os.path.getmtime(pp) for pp in paths)
+
+
+class AssetCache:
+    """
+    use_blend_cache - read and write the .blend cache next to the models
+    """
+
+    def __init__(self, use_blend_cache=True):
+        self.use_blend_cache = use_blend_cache
+        self._templates = {} # model path -> first loaded object
+
+    def load(self, model_path):
+        """A new object of the model at 'model_path', sharing its data with the others."""
+        model_path = os.path.abspath(model_path)
+        template = self._templates.get(model_path)
+        if template is None:
+            template = self._load(model_path)
+            self._templates[model_path] = template
+            return template
+        return template.duplicate(linked=True)
+
+    def _load(self, model_path):
+        blend_path = cache_path(model_path)
+        if self.use_blend_cache and os.path.exists(blend_path) \
+                and os.path.getmtime(blend_path) >= _source_mtime(model_path):
+            objects = bp.loader.load_blend(blend_path, obj_types=['mesh'])
+            if len(objects) > 0:
+                return objects[0]
+
+        obj = bp.loader.load_obj(model_path)[0]
+        if self.use_blend_cache:
+            self._write_cache(obj, blend_path)
+        return obj
+
+    def _write_cache(self, obj, blend_path):
+        # texture paths stay relative to the model directory, like in the MTL file
+        # unique per writer: parallel workers may cache the same model at the same time
+        tmp_path = f"{blend_path}.{os.getpid()}.{threading.get_ident()}.tmp.blend"
+        try:
+            bpy.data.libraries.write(tmp_path, {obj.blender_obj}, path_remap='RELATIVE_ALL')
+            os.replace(tmp_path, blend_path)
+        except (OSError, RuntimeError) as e:
+            # a read-only model directory only costs the speed up
+            print(f"Could not cache '{blend_path}': {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+
+"""
+Background writer for the images and annotations of the generators.
+
+PNG encoding, NumPy arrays and JSON dumps are handed to a bounded pool of
+threads (or processes) so they overlap the rendering of the next frame.
+Submitting blocks once 'max_pending' writes are queued, which keeps memory
+bounded when the disk cannot keep up. Every file is written to a temporary name,
+fsynced and renamed, so an interrupted run never leaves half-written
+frames behind, and pending writes are flushed when the interpreter exits.
+"""
+
+import atexit
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import json
+import os
+import threading
+
+import numpy as np
+from PIL import Image
+
+
+def _atomic_write(path, write, fsync):
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_path, 'wb') as f:
+            write(f)
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def write_image(path, array, compress_level=6, fsync=True):
+    ext = os.path.splitext(path)[1].lower()
+    image_format = Image.registered_extensions().get(ext, 'PNG')
+    options = {'compress_level': compress_level} if image_format == 'PNG' else {}
+    _atomic_write(path, lambda f: Image.fromarray(array).save(f, format=image_format, **options),
+                  fsync)
+
+
+def write_json(path, data, indent=4, fsync=True):
+    _atomic_write(path, lambda f: f.write(json.dumps(data, indent=indent).encode()), fsync)
+
+
+def write_array(path, array, fsync=True):
+    _atomic_write(path, lambda f: np.save(f, array), fsync)
+
+
+def write_text(path, text, fsync=True):
+    _atomic_write(path, lambda f: f.write(text.encode()), fsync)
+
+
+class AsyncWriter:
+    """
+    workers        - number of writer threads/processes; 0 writes synchronously
+    max_pending    - writes that may be queued before submitting blocks
+    compress_level - PNG compression level, 0 (none) to 9 (smallest)
+    use_processes  - encode in processes instead of threads
+    """
+
+    def __init__(self, workers=2, max_pending=8, compress_level=6, use_processes=False,
+                 fsync=True):
+        self.compress_level = compress_level
+        self.fsync = fsync
+        self._executor = None
+        if workers > 0:
+            pool = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+            self._executor = pool(max_workers=workers)
+        self._slots = threading.BoundedSemaphore(max(1, max_pending))
+        self._lock = threading.Lock()
+        self._pending = {} # path -> future of its last write
+        self._errors = []
+        self._callbacks = 0 # after_pending callbacks that have not run yet
+        self._callbacks_done = threading.Condition(self._lock)
+        self._closed = False
+        atexit.register(self.close)
+
+    def save_image(self, path, array):
+        return self._submit(path, write_image, path, array, self.compress_level, self.fsync)
+
+    def save_json(self, path, data, indent=4):
+        return self._submit(path, write_json, path, data, indent, self.fsync)
+
+    def save_array(self, path, array):
+        return self._submit(path, write_array, path, array, self.fsync)
+
+    def save_text(self, path, text):
+        return self._submit(path, write_text, path, text, self.fsync)
+
+    def after_pending(self, callback):
+        """
+        Call 'callback' once every write submitted so far is on disk, e.g. to
+        record a finished frame. It runs in a writer thread (or right away).
+        """
+        with self._lock:
+            futures = list(self._pending.values())
+        if not futures:
+            callback()
+            return
+
+        remaining = [len(futures)]
+        counter_lock = threading.Lock()
+        with self._lock:
+            self._callbacks += 1
+
+        def done(_):
+            with counter_lock:
+                remaining[0] -= 1
+                last = remaining[0] == 0
+            if last:
+                error = None
+                try:
+                    callback()
+                except Exception as e:
+                    error = e
+                with self._lock:
+                    if error is not None:
+                        self._errors.append(error)
+                    self._callbacks -= 1
+                    self._callbacks_done.notify_all()
+
+        for future in futures:
+            future.add_done_callback(done)
+
+    def flush(self):
+        """
+        Wait for all the pending writes and their after_pending callbacks;
+        raises the first write or callback error, if any.
+        """
+        with self._lock:
+            futures = list(self._pending.values())
+        errors = [ff.exception() for ff in futures if ff.exception() is not None]
+        with self._lock:
+            while self._callbacks > 0:
+                self._callbacks_done.wait()
+            errors += [ee for ee in self._errors if all(ee is not oo for oo in errors)]
+            self._errors = []
+        if errors:
+            raise errors[0]
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            self.flush()
+        finally:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+            atexit.unregister(self.close)
+        # errors of callbacks that ran while the executor shut down
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _submit(self, path, function, *args):
+        if self._executor is None:
+            function(*args)
+            return None
+
+        # Writes to the same file are kept in order
+        with self._lock:
+            previous = self._pending.get(path)
+        if previous is not None:
+            previous.exception()
+
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(function, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        with self._lock:
+            self._pending[path] = future
+        future.add_done_callback(lambda ff: self._done(path, ff))
+        return future
+
+    def _done(self, path, future):
+        self._slots.release()
+        with self._lock:
+            if future.exception() is not None:
+                self._errors.append(future.exception())
+            if self._pending.get(path) is future:
+                del self._pending[path]
@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+
+"""
+Background images for dope_model.py, prepared off the render loop.
+
+Every backdrop is decoded once into a bounded LRU cache of RGB arrays that are
+downscaled close to the output resolution. The random rotation, crop, resize
+and flips of each frame are planned from the frame seed, so a thread pool can
+prepare the backgrounds of the next frames through a prefetch queue while
+Blender renders the current one.
+"""
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from math import pi, sin, cos
+import os
+import random
+import threading
+
+import numpy as np
+from PIL import Image
+
+from frame_manifest import frame_seed
+
+
+# frame_seed() stream of the background plans, independent of the global random state
+BACKGROUND_STREAM = 1
+
+
+def rotated_rectangle_extents(w, h, angle):
+    """
+    Given a rectangle of size W x H that has been rotated by 'angle' (in
+    radians), computes the width and height of the largest possible
+    axis-aligned rectangle (maximal area) within the rotated rectangle.
+    """
+    if w <= 0 or h <= 0:
+        return 0,0
+
+    width_is_longer = w >= h
+    side_long, side_short = (w,h) if width_is_longer else (h,w)
+
+    # since the solutions for angle, -angle and 180-angle are all the same, it
+    # suffices to only look at the first quadrant and the absolute values of
+    # sin,cos:
+    sin_a, cos_a = abs(sin(angle)), abs(cos(angle))
+    if side_short <= 2.*sin_a*cos_a*side_long or abs(sin_a-cos_a) < 1e-10:
+        # half constrained case: two crop corners touch the longer side,
+        #   the other two corners are on the mid-line parallel to the longer line
+        x = 0.5*side_short
+        wr,hr = (x/sin_a,x/cos_a) if width_is_longer else (x/cos_a,x/sin_a)
+    else:
+        # fully constrained case: crop touches all 4 sides
+        cos_2a = cos_a*cos_a - sin_a*sin_a
+        wr,hr = (w*cos_a - h*sin_a)/cos_2a, (h*cos_a - w*sin_a)/cos_2a
+
+    return wr,hr
+
+
+def crop_around_center(image, width, height):
+    """
+    Crop 'image' (a PIL image) to 'width' and height' around the images center
+    point
+    """
+    size = image.size
+    center = (int(size[0] * 0.5), int(size[1] * 0.5))
+
+    if(width > size[0]):
+        width = size[0]
+
+    if(height > size[1]):
+        height = size[1]
+
+    x1 = int(center[0] - width * 0.5)
+    x2 = int(center[0] + width * 0.5)
+    y1 = int(center[1] - height * 0.5)
+    y2 = int(center[1] + height * 0.5)
+
+    return image.crop((x1, y1, x2, y2)) # (left, upper, right, lower)
+
+
+def crop_to_rotation(img, angle):
+    # 'img' is a PIL Image of uint8 RGB values
+    # 'angle' is in degrees
+    angle_rad = angle*pi/180.0
+    width, height = img.size
+
+    img = img.rotate(angle)
+    # Crop out black border resulting from rotation
+    wr, hr = rotated_rectangle_extents(width, height, angle_rad)
+    return crop_around_center(img, wr, hr)
+
+
+def scale_to_original_shape(img, o_width, o_height):
+    c_width, c_height = img.size
+    o_ar = o_width/o_height
+    c_ar = c_width/c_height
+    if o_ar > c_ar:
+        cropped = crop_around_center(img, c_width, c_width/o_ar)
+    else:
+        cropped = crop_around_center(img, c_height*o_ar, c_height)
+
+    return cropped.resize((o_width, o_height))
+
+
+def random_background_params(rng):
+    """Random rotation (degrees) and flips of a background, drawn from 'rng'."""
+    return {'angle': 45.0 - rng.random()*90.0,
+            'flip_horizontal': rng.random() > 0.5,
+            'flip_vertical': rng.random() > 0.5}
+
+
+def randomize_background(img, params, width, height):
+    """Rotate, crop, resize and flip a PIL image according to 'params'."""
+    img = crop_to_rotation(img, params['angle'])
+    img = scale_to_original_shape(img, width, height)
+
+    # Randomly flip in horizontal and vertical directions
+    if params['flip_horizontal']:
+        img = img.transpose(Image.FLIP_LEFT_RIGHT)
+    if params['flip_vertical']:
+        img = img.transpose(Image.FLIP_TOP_BOTTOM)
+
+    return img
+
+
+class BackgroundCache:
+    """
+    Bounded LRU cache of decoded backgrounds. Images are downscaled so that
+    their limiting side is 'oversample' times the output size, which leaves
+    room for the rotation crop without keeping full resolution pixels around.
+    """
+
+    def __init__(self, width, height, max_items=64, oversample=2.0):
+        self.width = width
+        self.height = height
+        self.max_items = max_items
+        self.oversample = oversample
+        self._images = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, path):
+        with self._lock:
+            if path in self._images:
+                self._images.move_to_end(path)
+                return self._images[path]
+
+        array = self._decode(path)
+
+        with self._lock:
+            self._images[path] = array
+            self._images.move_to_end(path)
+            while len(self._images) > self.max_items:
+                self._images.popitem(last=False)
+        return array
+
+    def _decode(self, path):
+        img = Image.open(path)
+        target = (int(self.width*self.oversample), int(self.height*self.oversample))
+        # JPEG images can be decoded directly at a reduced scale
+        img.draft('RGB', target)
+        img = img.convert('RGB') # some images may be B&W
+
+        scale = max(target[0]/img.width, target[1]/img.height)
+        if scale < 1.0:
+            img = img.resize((max(1, round(img.width*scale)), max(1, round(img.height*scale))),
+                             Image.BILINEAR)
+        return np.asarray(img)
+
+
+class BackgroundPipeline:
+    """
+    Plans the background of every frame from the run seed and prepares the
+    image backgrounds in worker threads ahead of the render loop. HDR files
+    are only planned (strength and rotation); they are set up in blender by
+    the caller.
+    """
+
+    def __init__(self, paths, width, height, seed, cache_size=64, workers=2, prefetch=4):
+        self.paths = paths
+        self.width = width
+        self.height = height
+        self.seed = seed
+        self.prefetch = prefetch
+        self.cache = BackgroundCache(width, height, cache_size)
+        self._executor = ThreadPoolExecutor(max_workers=max(1, workers))
+        self._pending = OrderedDict() # frame -> future of its background array
+        self._queue = []
+        self._positions = {} # frame -> its index in _queue
+
+    def schedule(self, frames):
+        """Frames that will be rendered, in order; backgrounds are prefetched along it."""
+        self._queue = list(frames)
+        self._positions = {frame: ii for ii, frame in enumerate(self._queue)}
+
+    def plan(self, frame):
+        rng = random.Random(frame_seed(self.seed, frame, BACKGROUND_STREAM))
+        path = self.paths[rng.randint(0, len(self.paths) - 1)]
+        if os.path.splitext(path)[1].lower() == ".hdr":
+            return {'path': path,
+                    'hdr': True,
+                    'strength': rng.random()+0.5,
+                    'rotation': [rng.random()*0.2-0.1, rng.random()*0.2-0.1,
+                                 rng.random()*0.2-0.1]}
+        plan = {'path': path, 'hdr': False}
+        plan.update(random_background_params(rng))
+        return plan
+
+    def get(self, frame):
+        """Background of 'frame' as an (height, width, 3) uint8 array, None for HDR frames."""
+        self._fill(frame)
+        future = self._pending.pop(frame, None)
+        if future is None:
+            future = self._submit(frame)
+        return None if future is None else future.result()
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _fill(self, frame):
+        position = self._positions.get(frame)
+        if position is None:
+            upcoming = [frame]
+        else:
+            upcoming = self._queue[position:position+self.prefetch+1]
+            # scheduled frames before this one were skipped: drop what was prefetched for them
+            while self._pending:
+                ff = next(iter(self._pending))
+                if self._positions.get(ff, position) >= position:
+                    break
+                self._pending.popitem(last=False)[1].cancel()
+        for ff in upcoming:
+            if ff not in self._pending:
+                future = self._submit(ff)
+                if future is not None:
+                    self._pending[ff] = future
+
+    def _submit(self, frame):
+        plan = self.plan(frame)
+        if plan['hdr']:
+            return None
+        return self._executor.submit(self._prepare, plan)
+
+    def _prepare(self, plan):
+        img = Image.fromarray(self.cache.get(plan['path']))
+        img = randomize_background(img, plan, self.width, self.height)
+        # a fresh, writable array: the render is composited over it in place
+        return np.array(img)
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+
+"""
+Bake occluder drops for drop_library.py.
+
+Every drop throws a random set of cubes and spheres on the (passive) scene,
+runs the rigid body simulation until they settle and saves their final poses
+as drop_<n>.npz. Use run_blenderproc_datagen.py --script bake_drops.py to bake
+in parallel processes, then pack the drops with 'drop_library.py pack'.
+"""
+
+import blenderproc as bproc  # must be first!
+import argparse
+import os
+import sys
+import numpy as np
+
+from drop_library import SHAPES, save_drop
+from frame_manifest import FrameManifest
+
+
+def random_drop():
+    """Random occluders above the scene, drawn like add_occlusion_objects() in cuboid-generator-6.py."""
+    num_objects = np.random.randint(3, 100)
+    shapes = [SHAPES[np.random.randint(len(SHAPES))] for _ in range(num_objects)]
+    locations = np.random.uniform([-5, -5, 10], [5, 5, 15], size=(num_objects, 3))
+    rotations = np.random.uniform(0, 2 * np.pi, size=(num_objects, 3))
+    scales = np.random.uniform(0.3, 1.0, size=(num_objects, 3))
+    return shapes, locations, rotations, scales
+
+
+def main(args):
+    out_directory = args.outf if args.run_id is None else os.path.join(args.outf, str(args.run_id))
+    os.makedirs(out_directory, exist_ok=True)
+
+    # Drop manifest, used to resume an interrupted bake
+    try:
+        manifest = FrameManifest.open(out_directory, args.seed, args.resume, args.overwrite)
+    except FileExistsError as e:
+        print(e)
+        sys.exit(1)
+
+    bproc.init()
+
+    # The scene does not move; occluders fall on it and come to rest
+    scene_objects = bproc.loader.load_blend(args.scene)
+    for obj in scene_objects:
+        if isinstance(obj, bproc.types.MeshObject):
+            obj.enable_rigidbody(active=False, collision_shape='MESH')
+
+    for frame in range(args.nb_frames):
+        if args.resume and manifest.is_complete(frame):
+            continue
+        # Every drop has its own random state so it can be baked again on its own
+        manifest.seed_frame(frame)
+
+        shapes, locations, rotations, scales = random_drop()
+        occluders = []
+        for shape, location, rotation, scale in zip(shapes, locations, rotations, scales):
+            occluder = bproc.object.create_primitive(shape)
+            occluder.set_location(location)
+            occluder.set_rotation_euler(rotation)
+            occluder.set_scale(scale)
+            occluder.enable_rigidbody(active=True, mass=1.0)
+            occluders.append(occluder)
+
+        bproc.object.simulate_physics_and_fix_final_poses(min_simulation_time=args.min_simulation_time,
+                                                          max_simulation_time=args.max_simulation_time,
+                                                          check_object_interval=1)
+
+        # Occluders that fell off the scene are left out of the drop
+        final_locations = np.array([oo.get_location() for oo in occluders])
+        final_rotations = np.array([oo.get_rotation_euler() for oo in occluders])
+        kept = final_locations[:, 2] > args.min_height
+
+        drop_filename = os.path.join(out_directory, f"drop_{frame:06d}.npz")
+        save_drop(drop_filename, [ss for ss, kk in zip(shapes, kept) if kk],
+                  final_locations[kept], final_rotations[kept], scales[kept])
+        manifest.record(frame, [drop_filename])
+
+        bproc.object.delete_multiple(occluders)
+
+    print(f"Saved drops to {out_directory}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scene', default="scene11.blend", help="Path to the scene.blend file the occluders fall on")
+    parser.add_argument('--nb_frames', default=100, type=int, help="how many drops to bake")
+    parser.add_argument('--outf', default='drops/', help="output folder for the drop_*.npz files")
+    parser.add_argument('--min_simulation_time', default=2.0, type=float, help="seconds simulated before checking if the occluders rest")
+    parser.add_argument('--max_simulation_time', default=10.0, type=float, help="seconds simulated at most")
+    parser.add_argument('--min_height', default=-1.0, type=float, help="occluders that end up below this height fell off the scene and are dropped")
+    parser.add_argument('--seed', default=None, type=int, help="seed of the random generators")
+    parser.add_argument('--nb_runs', default=1, type=int, help="how many runs bake the library together (set by run_blenderproc_datagen.py)")
+    parser.add_argument('--run_id', default=None, type=int,
+                        help="if set, output files are put in a subdirectory of this name (set by run_blenderproc_datagen.py)")
+    parser.add_argument('--resume', action='store_true', help="skip the drops recorded as complete in the manifest of --outf and bake the rest")
+    parser.add_argument('--overwrite', action='store_true', help="start over in an output folder that already holds drops")
+    parser.add_argument('--cpu_threads', default=0, type=int, help="unused, accepted for run_blenderproc_datagen.py")
+
+    opt = parser.parse_args()
+    main(opt)
@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+
+"""
+Offline DOPE training targets: belief maps and affinity fields.
+
+The DOPE network predicts, at 1/stride of the image resolution,
+
+    9 belief maps      a Gaussian of 'sigma' map pixels around each keypoint of
+                       'projected_cuboid' (8 corners, then the centroid); the
+                       maximum over the objects
+    16 affinity fields for each corner, the unit vector from the corner to the
+                       centroid, on the disk of 'radius' map pixels around the
+                       corner; the mean where objects overlap
+
+Computing these in the training loader costs CPU time for every sample of
+every epoch. Here they are rendered once, for all the objects of a frame at
+once with separable Gaussians and broadcast disks. Worker processes each
+read a range of frames from the memory-mapped annotation index. The maps are
+stored as float16 .npy shards, which halves their size and keeps them
+memory-mappable. Map pixel (i, j) is centered on keypoint coordinates
+((j + 0.5) * stride, (i + 0.5) * stride). Frames whose image size differs
+from the first frame are scaled to its maps.
+
+    <out>/index.json                     parameters, map size and the shards
+    <out>/shard_00000/beliefs.npy        (n, 9, h, w) float16
+    <out>/shard_00000/affinities.npy     (n, 16, h, w) float16
+    <out>/shard_00000/frame_names.npy    frame names, as in the annotation index
+    <out>/shard_00000/source.json        sha256 of the annotations of the shard
+
+The annotations are read from a directory of sharded annotations (see
+annotation_shards.py) or from a dataset directory indexed by dope_dataset.py.
+Shards already written with the same parameters from the same annotations
+are kept, so an interrupted run can be restarted. Every shard stores a
+sha256 of the annotations it was rendered from (frame names, image sizes,
+classes and keypoints) in its source.json; a shard whose annotations changed,
+e.g. in a regenerated dataset, is rendered again.
+
+    python belief_maps.py precompute output/ targets/ --stride 8 --sigma 2 --class door
+    python belief_maps.py info targets/
+"""
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+
+from annotation_shards import AnnotationShards, INDEX_NAME
+
+
+NB_KEYPOINTS = 9
+NB_AFFINITIES = 2 * (NB_KEYPOINTS - 1)
+SOURCE_NAME = 'source.json'
+# annotation fields the maps are rendered from
+SOURCE_FIELDS = ('frame_names', 'image_size', 'class_ids', 'visibility', 'projected_cuboid')
+
+
+def belief_maps(keypoints, map_size, sigma=2.0):
+    """
+    (9, h, w) belief maps of the keypoints (n_objects, 9, 2), given in map
+    pixels. Missing keypoints (NaN) are left out.
+    """
+    height, width = map_size
+    keypoints = np.asarray(keypoints, dtype=np.float32).reshape(-1, NB_KEYPOINTS, 2)
+    if len(keypoints) == 0:
+        return np.zeros((NB_KEYPOINTS, height, width), dtype=np.float32)
+    xs = np.arange(width, dtype=np.float32) + 0.5
+    ys = np.arange(height, dtype=np.float32) + 0.5
+    # exp(-(dx^2 + dy^2) / 2s^2) = exp(-dx^2 / 2s^2) * exp(-dy^2 / 2s^2)
+    gx = np.nan_to_num(np.exp(-(xs - keypoints[..., 0:1])**2 / (2 * sigma**2)))
+    gy = np.nan_to_num(np.exp(-(ys - keypoints[..., 1:2])**2 / (2 * sigma**2)))
+    return (gy[..., :, None] * gx[..., None, :]).max(axis=0)
+
+
+def affinity_fields(keypoints, map_size, radius=1.0):
+    """
+    (16, h, w) affinity fields of the keypoints (n_objects, 9, 2), given in map
+    pixels: channels 2k and 2k+1 hold the x and y of the unit vectors from
+    corner k to the centroid.
+    """
+    height, width = map_size
+    keypoints = np.asarray(keypoints, dtype=np.float32).reshape(-1, NB_KEYPOINTS, 2)
+    if len(keypoints) == 0:
+        return np.zeros((NB_AFFINITIES, height, width), dtype=np.float32)
+    corners, centroids = keypoints[:, 0:-1], keypoints[:, -1:]
+    vectors = centroids - corners
+    with np.errstate(invalid='ignore', divide='ignore'):
+        vectors = np.nan_to_num(vectors / np.linalg.norm(vectors, axis=2, keepdims=True))
+
+    xs = np.arange(width, dtype=np.float32) + 0.5
+    ys = np.arange(height, dtype=np.float32) + 0.5
+    dx = xs - corners[..., 0:1]
+    dy = ys - corners[..., 1:2]
+    # comparisons with missing (NaN) corners are False
+    disks = (dy[..., :, None]**2 + dx[..., None, :]**2 <= radius**2).astype(np.float32)
+
+    sums = np.einsum('nkhw,nkc->kchw', disks, vectors)
+    counts = np.maximum(disks.sum(axis=0), 1.0)
+    return (sums / counts[:, None]).reshape(NB_AFFINITIES, height, width)
+
+
+def annotation_directory(source):
+    """Sharded annotations of 'source': an annotation shard directory or a dataset directory."""
+    if os.path.exists(os.path.join(source, INDEX_NAME)):
+        return source
+    from dope_dataset import DopeDataset
+    return DopeDataset(source).annotations_directory
+
+
+def source_digest(annotations, start, end):
+    """sha256 of the annotations of frames start:end that the maps depend on."""
+    sha = hashlib.sha256(json.dumps(annotations.classes).encode())
+    for index in range(start, end):
+        frame = annotations.frame(index)
+        for field in SOURCE_FIELDS:
+            sha.update(np.ascontiguousarray(frame[field]).tobytes())
+        sha.update(np.int64(len(frame['class_ids'])).tobytes())
+    return sha.hexdigest()
+
+
+def _stored_digest(directory):
+    try:
+        with open(os.path.join(directory, SOURCE_NAME)) as f:
+            return json.load(f)['sha256']
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def _render_shard(task):
+    """Write the maps of one range of frames; runs in a worker process."""
+    params = task['params']
+    annotations = AnnotationShards(task['annotations'])
+    height, width = params['map_size']
+    class_ids = None
+    if params['class_name'] is not None:
+        class_ids = [ii for ii, cc in enumerate(annotations.classes)
+                     if cc.lower() == params['class_name'].lower()]
+
+    tmp_directory = task['directory'] + '.tmp'
+    os.makedirs(tmp_directory, exist_ok=True)
+    nb_frames = task['end'] - task['start']
+    beliefs = np.lib.format.open_memmap(os.path.join(tmp_directory, 'beliefs.npy'), mode='w+',
+                                        dtype=np.float16, shape=(nb_frames, NB_KEYPOINTS, height, width))
+    affinities = np.lib.format.open_memmap(os.path.join(tmp_directory, 'affinities.npy'), mode='w+',
+                                           dtype=np.float16, shape=(nb_frames, NB_AFFINITIES, height, width))
+    names = []
+    for row, index in enumerate(range(task['start'], task['end'])):
+        frame = annotations.frame(index)
+        names.append(str(frame['frame_names']))
+        selected = frame['visibility'] >= params['min_visibility']
+        if class_ids is not None:
+            selected &= np.isin(frame['class_ids'], class_ids)
+
+        # image pixels -> map pixels of the reference image size
+        image_size = np.asarray(frame['image_size'], dtype=np.float32)
+        if not np.all(image_size > 0):
+            image_size = np.asarray(params['image_size'], dtype=np.float32)
+        scale = np.asarray(params['image_size'], dtype=np.float32) / image_size / params['stride']
+        keypoints = np.asarray(frame['projected_cuboid'][selected], dtype=np.float32) * scale
+
+        beliefs[row] = belief_maps(keypoints, (height, width), params['sigma'])
+        affinities[row] = affinity_fields(keypoints, (height, width), params['radius'])
+
+    beliefs.flush()
+    affinities.flush()
+    del beliefs, affinities
+    np.save(os.path.join(tmp_directory, 'frame_names.npy'), np.array(names, dtype=str))
+    with open(os.path.join(tmp_directory, SOURCE_NAME), 'w') as f:
+        json.dump({'source': task['annotations'], 'sha256': task['digest']}, f, indent=4)
+    if os.path.isdir(task['directory']):
+        shutil.rmtree(task['directory'])
+    os.replace(tmp_directory, task['directory'])
+    return nb_frames
+
+
+def precompute(source, out_directory, stride=8, sigma=2.0, radius=1.0, class_name=None, min_visibility=0,
+               frames_per_shard=1000, workers=None):
+    """Render the maps of every frame of 'source' into shards; returns the number of frames."""
+    annotations_path = os.path.abspath(annotation_directory(source))
+    annotations = AnnotationShards(annotations_path)
+    nb_frames = len(annotations)
+    if nb_frames == 0:
+        return 0
+
+    image_size = [int(vv) for vv in annotations.frame(0)['image_size']]
+    params = {'stride': stride, 'sigma': sigma, 'radius': radius, 'class_name': class_name,
+              'min_visibility': min_visibility, 'image_size': image_size,
+              'map_size': [-(-image_size[1] // stride), -(-image_size[0] // stride)]}
+
+    # shards of an earlier run with other parameters are rendered again
+    index_path = os.path.join(out_directory, INDEX_NAME)
+    if os.path.exists(index_path):
+        with open(index_path) as f:
+            previous = json.load(f)
+        if not isinstance(previous, dict) or 'params' not in previous or 'frames_per_shard' not in previous:
+            raise ValueError(f"'{out_directory}' holds an index.json that is not one of precomputed "
+                             "targets; choose another output directory")
+        if previous['params'] != params or previous['frames_per_shard'] != frames_per_shard:
+            shutil.rmtree(out_directory)
+    os.makedirs(out_directory, exist_ok=True)
+
+    # shards rendered from other annotations (another or a regenerated dataset) are rendered again
+    shards, tasks = [], []
+    for start in range(0, nb_frames, frames_per_shard):
+        name = f"shard_{len(shards):05d}"
+        end = min(start + frames_per_shard, nb_frames)
+        digest = source_digest(annotations, start, end)
+        shards.append({'name': name, 'nb_frames': end - start, 'sha256': digest})
+        directory = os.path.join(out_directory, name)
+        if _stored_digest(directory) != digest:
+            tasks.append({'annotations': annotations_path, 'directory': directory,
+                          'start': start, 'end': end, 'params': params, 'digest': digest})
+
+    if workers == 0:
+        for task in tasks:
+            _render_shard(task)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(_render_shard, tasks))
+
+    with open(index_path + '.tmp', 'w') as f:
+        json.dump({'params': params, 'frames_per_shard': frames_per_shard, 'classes': annotations.classes,
+                   'source': os.path.abspath(annotations_path), 'shards': shards}, f, indent=4)
+    os.replace(index_path + '.tmp', index_path)
+    return nb_frames
+
+
+class BeliefShards:
+    """
+    Memory-mapped view of precomputed targets. frame(i) returns the float16
+    belief maps (9, h, w) and affinity fields (16, h, w) of frame i.
+    """
+
+    def __init__(self, directory, mmap_mode='r'):
+        with open(os.path.join(directory, INDEX_NAME)) as f:
+            self.index = json.load(f)
+        self.params = self.index['params']
+        self.shards = []
+        for shard in self.index['shards']:
+            shard_directory = os.path.join(directory, shard['name'])
+            self.shards.append({field: np.load(os.path.join(shard_directory, field + '.npy'), mmap_mode=mmap_mode)
+                                for field in ('beliefs', 'affinities', 'frame_names')})
+        self.frame_starts = np.cumsum([0] + [ss['nb_frames'] for ss in self.index['shards']])
+
+    def __len__(self):
+        return int(self.frame_starts[-1])
+
+    def frame(self, index):
+        shard_index = int(np.searchsorted(self.frame_starts, index, side='right')) - 1
+        shard = self.shards[shard_index]
+        ii = index - self.frame_starts[shard_index]
+        return shard['beliefs'][ii], shard['affinities'][ii]
+
+    def frame_names(self):
+        return np.concatenate([shard['frame_names'] for shard in self.shards])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    precompute_parser = subparsers.add_parser('precompute', help="render the targets of a dataset")
+    precompute_parser.add_argument('source', help="dataset directory or directory of sharded annotations")
+    precompute_parser.add_argument('out_directory', help="directory of the target shards")
+    precompute_parser.add_argument('--stride', default=8, type=int, help="image pixels per map pixel")
+    precompute_parser.add_argument('--sigma', default=2.0, type=float, help="standard deviation of the beliefs, in map pixels")
+    precompute_parser.add_argument('--radius', default=1.0, type=float, help="radius of the affinity disks, in map pixels")
+    precompute_parser.add_argument('--class', dest='class_name', default=None,
+                                   help="only the objects of this class (any class if not set)")
+    precompute_parser.add_argument('--min_visibility', default=0, type=int,
+                                   help="only the objects with at least this many visible pixels")
+    precompute_parser.add_argument('--frames_per_shard', default=1000, type=int, help="how many frames each shard holds")
+    precompute_parser.add_argument('--workers', default=None, type=int,
+                                   help="worker processes, one per core by default; 0 renders in this process")
+
+    info_parser = subparsers.add_parser('info', help="describe precomputed targets")
+    info_parser.add_argument('directory', help="directory of the target shards")
+
+    opt = parser.parse_args()
+    if opt.command == 'precompute':
+        nb = precompute(opt.source, opt.out_directory, opt.stride, opt.sigma, opt.radius, opt.class_name,
+                        opt.min_visibility, opt.frames_per_shard, opt.workers)
+        print(f"Targets of {nb} frames written to '{opt.out_directory}'")
+    else:
+        targets = BeliefShards(opt.directory)
+        print(f"{len(targets)} frames in {len(targets.shards)} shards, maps of "
+              f"{targets.params['map_size'][1]}x{targets.params['map_size'][0]} pixels")
+        print(json.dumps(targets.params, indent=4))
@@ -1,27 +1,16 @@
-import numpy as np
+from camera_trajectory import grid_positions, poses_looking_at, save_poses
 
 # Define parameters for back and forth motion
 camera_height = 4.1242  # Assuming the camera height remains constant (z-axis)
-steps = 5  # 15 positions forward and backward on both axes
-range_x = np.linspace(-10, 10, steps)
-range_y = np.linspace(-10, 10, steps)
+steps = 5  # positions along each of the X and Y axes
+extent = 10  # the grid covers [-10, 10] on both axes
 
 # Generate positions for back and forth motion on the X and Y axes, always pointing toward the origin
-back_and_forth_positions = []
-for x in range_x:
-    for y in range_y:
-        position = [x, y, camera_height]
-        # Assume the camera orientation remains fixed at looking at the origin (no need for yaw/pitch)
-        orientation = [0.0, 0.0]  # Placeholder for simplicity
-        back_and_forth_positions.append(position + orientation)
+positions = grid_positions(extent, steps, camera_height)
+back_and_forth_poses = poses_looking_at(positions, target=(0, 0, 0))
 
-# Convert the new positions to a string format
-output_positions_back_and_forth = '\n'.join(' '.join(map(str, pos)) for pos in back_and_forth_positions)
-
-# Save the back and forth camera positions to a file
-output_file_back_and_forth_path = 'camera_positions_1'
-with open(output_file_back_and_forth_path, 'w') as f:
-    f.write(output_positions_back_and_forth)
+# Save the back and forth camera poses to a binary file that main.py memory-maps
+output_file_back_and_forth_path = 'camera_positions_1.npy'
+save_poses(output_file_back_and_forth_path, back_and_forth_poses)
 
 print(f"Camera positions saved to {output_file_back_and_forth_path}")
-
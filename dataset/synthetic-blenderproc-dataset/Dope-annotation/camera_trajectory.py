@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+
+"""
+Camera trajectories for Coco-annotation/main.py.
+
+Every pose is a row [x, y, z, rx, ry, rz]: the camera position and its
+orientation as Blender XYZ euler angles. These are the columns of the camera
+positions files, as read by bproc.math.build_transformation_mat. The poses
+are generated as NumPy arrays, with orientations that look at a target point,
+and saved as (N, 6) float32 .npy files. main.py memory-maps those files and
+streams them chunk by chunk instead of parsing text.
+
+    python camera_trajectory.py grid poses.npy --steps 5 --extent 10 --height 4.1242
+    python camera_trajectory.py hemisphere poses.npy --nb_poses 200000 --radius 8 15
+"""
+
+import argparse
+
+import numpy as np
+
+
+def look_at_euler(positions, target=(0, 0, 0), up=(0, 0, 1)):
+    """
+    XYZ euler angles (N, 3) of Blender cameras at 'positions' (N, 3) looking
+    at 'target'. Blender cameras look down their -Z axis with +Y up.
+    """
+    positions = np.asarray(positions, dtype=float).reshape(-1, 3)
+    forward = np.asarray(target, dtype=float) - positions
+    forward /= np.linalg.norm(forward, axis=1, keepdims=True)
+
+    right = np.cross(forward, np.asarray(up, dtype=float))
+    # looking straight along 'up': any horizontal right vector will do
+    degenerate = np.linalg.norm(right, axis=1) < 1e-9
+    right[degenerate] = [1.0, 0.0, 0.0]
+    right /= np.linalg.norm(right, axis=1, keepdims=True)
+    camera_up = np.cross(right, forward)
+
+    # rotation matrix columns: camera X, Y and Z axes in world coordinates
+    R = np.stack([right, camera_up, -forward], axis=2)
+    # R = Rz(rz) @ Ry(ry) @ Rx(rx)
+    rx = np.arctan2(R[:, 2, 1], R[:, 2, 2])
+    ry = np.arcsin(np.clip(-R[:, 2, 0], -1.0, 1.0))
+    rz = np.arctan2(R[:, 1, 0], R[:, 0, 0])
+    return np.stack([rx, ry, rz], axis=1)
+
+
+def poses_looking_at(positions, target=(0, 0, 0), up=(0, 0, 1)):
+    """(N, 6) float32 poses of cameras at 'positions' looking at 'target'."""
+    positions = np.asarray(positions, dtype=float).reshape(-1, 3)
+    return np.concatenate([positions, look_at_euler(positions, target, up)], axis=1).astype(np.float32)
+
+
+def grid_positions(extent=10.0, steps=5, height=4.1242):
+    """steps x steps positions covering [-extent, extent]^2 at a constant height."""
+    x, y = np.meshgrid(np.linspace(-extent, extent, steps), np.linspace(-extent, extent, steps),
+                       indexing='ij')
+    return np.stack([x.ravel(), y.ravel(), np.full(x.size, height)], axis=1)
+
+
+def sphere_positions(nb_poses, radius=10.0, target=(0, 0, 0), min_elevation=-np.pi/2):
+    """
+    Evenly spread positions on a view sphere shell (Fibonacci lattice), only
+    keeping the elevations above 'min_elevation' (0 for the upper half).
+    """
+    z_min = np.sin(min_elevation)
+    ii = np.arange(nb_poses) + 0.5
+    z = 1.0 - ii / nb_poses * (1.0 - z_min)
+    azimuth = np.pi * (1.0 + 5**0.5) * ii
+    r = np.sqrt(1.0 - z*z)
+    unit = np.stack([r * np.cos(azimuth), r * np.sin(azimuth), z], axis=1)
+    return np.asarray(target, dtype=float) + radius * unit
+
+
+def spiral_positions(nb_poses, radius=10.0, heights=(2.0, 8.0), turns=3.0, target=(0, 0, 0)):
+    """Positions on a helix around 'target', rising from heights[0] to heights[1]."""
+    t = np.linspace(0.0, 1.0, nb_poses)
+    azimuth = 2 * np.pi * turns * t
+    return np.asarray(target, dtype=float) + np.stack([radius * np.cos(azimuth),
+                                                       radius * np.sin(azimuth),
+                                                       heights[0] + t * (heights[1] - heights[0])],
+                                                      axis=1)
+
+
+def hemisphere_positions(nb_poses, radius=(8.0, 15.0), target=(0, 0, 0), min_elevation=0.1, rng=None):
+    """
+    Positions drawn uniformly over the volume of a hemispherical shell above
+    'target', between radius[0] and radius[1], above 'min_elevation' radians.
+    """
+    rng = np.random.default_rng() if rng is None else rng
+    # uniform on the sphere: z uniform; uniform in volume: r^3 uniform
+    z = rng.uniform(np.sin(min_elevation), 1.0, nb_poses)
+    azimuth = rng.uniform(0.0, 2 * np.pi, nb_poses)
+    r = np.cbrt(rng.uniform(radius[0]**3, radius[1]**3, nb_poses))
+    horizontal = np.sqrt(1.0 - z*z)
+    unit = np.stack([horizontal * np.cos(azimuth), horizontal * np.sin(azimuth), z], axis=1)
+    return np.asarray(target, dtype=float) + r[:, None] * unit
+
+
+def save_poses(path, poses):
+    np.save(path, np.asarray(poses, dtype=np.float32).reshape(-1, 6))
+
+
+def load_poses(path):
+    """
+    (N, 6) poses of a .npy file (memory-mapped) or of a text camera positions
+    file (one 'x y z rx ry rz' line per pose).
+    """
+    if path.endswith('.npy'):
+        return np.load(path, mmap_mode='r')
+    return np.loadtxt(path, dtype=np.float32, ndmin=2)[:, 0:6]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('kind', choices=['grid', 'sphere', 'spiral', 'hemisphere'], help="shape of the trajectory")
+    parser.add_argument('output', help="pose file to write (.npy)")
+    parser.add_argument('--target', default=[0.0, 0.0, 0.0], type=float, nargs=3, help="point the cameras look at")
+    parser.add_argument('--nb_poses', default=1000, type=int, help="number of poses (sphere, spiral, hemisphere)")
+    parser.add_argument('--radius', default=[8.0, 15.0], type=float, nargs='+',
+                        help="distance to the target; min and max distance for hemisphere")
+    parser.add_argument('--steps', default=5, type=int, help="grid positions along each axis")
+    parser.add_argument('--extent', default=10.0, type=float, help="half size of the grid")
+    parser.add_argument('--height', default=4.1242, type=float, help="camera height of the grid")
+    parser.add_argument('--heights', default=[2.0, 8.0], type=float, nargs=2, help="start and end height of the spiral")
+    parser.add_argument('--turns', default=3.0, type=float, help="turns of the spiral")
+    parser.add_argument('--min_elevation', default=0.1, type=float, help="lowest elevation in radians (sphere, hemisphere)")
+    parser.add_argument('--seed', default=None, type=int, help="seed of the hemisphere sampling")
+    opt = parser.parse_args()
+
+    if opt.kind == 'grid':
+        positions = grid_positions(opt.extent, opt.steps, opt.height)
+    elif opt.kind == 'sphere':
+        positions = sphere_positions(opt.nb_poses, opt.radius[0], opt.target, opt.min_elevation)
+    elif opt.kind == 'spiral':
+        positions = spiral_positions(opt.nb_poses, opt.radius[0], opt.heights, opt.turns, opt.target)
+    else:
+        positions = hemisphere_positions(opt.nb_poses, (opt.radius[0], opt.radius[-1]), opt.target,
+                                         opt.min_elevation, np.random.default_rng(opt.seed))
+
+    poses = poses_looking_at(positions, opt.target)
+    save_poses(opt.output, poses)
+    print(f"{len(poses)} camera poses saved to {opt.output}")
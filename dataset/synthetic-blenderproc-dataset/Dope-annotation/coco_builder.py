@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+
+"""
+Incremental COCO annotation writer.
+
+bproc.writer.write_coco_annotations reloads and rewrites the whole JSON file
+every time it appends, so its cost grows with the size of the dataset.
+CocoBuilder keeps the image and annotation ids in memory and appends every
+image and annotation as one line to part files. Adding an image therefore
+costs the same however many came before. close() streams the parts into a
+single coco_annotations.json, the same layout the BlenderProc writer produces.
+With shard_size > 0, every shard_size images instead become a
+coco_annotations_<n>.json file, listed in coco_index.json.
+
+Masks are run-length encoded (uncompressed COCO RLE, column-major) for all
+instances of a segmentation map at once, from the runs of the flattened map.
+The boxes and areas come from the histograms of instance_stats.py.
+"""
+
+import datetime
+import json
+import os
+
+import numpy as np
+
+from async_writer import write_image
+from instance_stats import instance_stats
+
+
+INFO = {
+    'description': 'coco_annotations',
+    'url': 'https://github.com/waspinator/pycococreator',
+    'version': '0.1.0',
+    'year': 2020,
+    'contributor': 'Unknown',
+}
+LICENSES = [{'id': 1,
+             'name': 'Attribution-NonCommercial-ShareAlike License',
+             'url': 'http://creativecommons.org/licenses/by-nc-sa/2.0/'}]
+PARTS_DIRECTORY = '.coco_parts'
+INDEX_NAME = 'coco_index.json'
+
+
+def rle_encode_all(seg_map):
+    """
+    Uncompressed COCO RLE of every id of an (H, W) map: {id: counts}. The
+    counts alternate background and foreground runs in column-major order,
+    starting with a (possibly empty) background run, like pycococreator.
+    """
+    flat = np.asarray(seg_map).ravel(order='F')
+    boundaries = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    starts = np.concatenate([[0], boundaries])
+    ends = np.concatenate([boundaries, [flat.size]])
+    values = flat[starts]
+
+    # runs grouped by id, in order of their position
+    order = np.argsort(values, kind='stable')
+    values, starts, ends = values[order], starts[order], ends[order]
+    groups = np.flatnonzero(np.diff(values)) + 1
+
+    rles = {}
+    for group_values, group_starts, group_ends in zip(np.split(values, groups),
+                                                      np.split(starts, groups),
+                                                      np.split(ends, groups)):
+        # [gap, run, gap, run, ..., trailing gap]: each gap ends where a run starts
+        previous_ends = np.concatenate([[0], group_ends[:-1]])
+        counts = np.empty(2 * len(group_starts) + 1, dtype=np.int64)
+        counts[0:-1:2] = group_starts - previous_ends
+        counts[1::2] = group_ends - group_starts
+        counts[-1] = flat.size - group_ends[-1]
+        rles[group_values[0].item()] = counts.tolist() if counts[-1] else counts[:-1].tolist()
+    return rles
+
+
+class CocoBuilder:
+    """
+    out_directory   - COCO output directory, like the one of write_coco_annotations
+    shard_size      - images per annotation file; 0 writes a single file
+    image_extension - extension of the images saved by add_image()
+    writer          - optional AsyncWriter that saves the images in the background
+    """
+
+    def __init__(self, out_directory, shard_size=0, image_extension='.jpg', writer=None):
+        self.out_directory = out_directory
+        self.shard_size = shard_size
+        self.image_extension = image_extension
+        self.writer = writer
+        self.parts_directory = os.path.join(out_directory, PARTS_DIRECTORY)
+        os.makedirs(os.path.join(out_directory, 'images'), exist_ok=True)
+        os.makedirs(self.parts_directory, exist_ok=True)
+
+        self.categories = {} # category id -> category
+        self.shards = []
+        self._next_image_id = 0
+        self._next_annotation_id = 1
+        self._open_parts()
+
+    def add_image(self, instance_segmap, instance_attribute_map, color=None, file_name=None):
+        """
+        Add the annotations of one rendered image and return its id. The
+        'color' image is saved in the images/ directory; an image saved
+        elsewhere is referenced by its 'file_name' relative to out_directory.
+        """
+        image_id = self._next_image_id
+        self._next_image_id += 1
+        height, width = instance_segmap.shape[0:2]
+
+        if file_name is None:
+            file_name = os.path.join('images', str(image_id).zfill(6) + self.image_extension)
+            color = np.asarray(color)[..., 0:3]
+            path = os.path.join(self.out_directory, file_name)
+            if self.writer is not None:
+                self.writer.save_image(path, color)
+            else:
+                write_image(path, color)
+
+        self._images.write(json.dumps({
+            'id': image_id, 'file_name': file_name, 'width': width, 'height': height,
+            'date_captured': str(datetime.datetime.now()), 'license': 1,
+            'coco_url': '', 'flickr_url': ''}) + '\n')
+
+        instances = [inst for inst in instance_attribute_map
+                     if inst.get('category_id', 0) > 0]
+        if instances:
+            num_ids = max(inst['idx'] for inst in instances) + 1
+            stats = instance_stats(instance_segmap, num_ids)
+            rles = rle_encode_all(instance_segmap)
+            for inst in instances:
+                idx = inst['idx']
+                if stats.counts[idx] == 0:
+                    continue
+                category_id = int(inst['category_id'])
+                if category_id not in self.categories:
+                    self.categories[category_id] = {'id': category_id,
+                                                    'supercategory': 'coco_annotations',
+                                                    'name': inst.get('name', str(category_id))}
+                x_min, y_min, x_max, y_max = stats.bboxes[idx].tolist()
+                self._annotations.write(json.dumps({
+                    'id': self._next_annotation_id, 'image_id': image_id,
+                    'category_id': category_id, 'iscrowd': 0, 'area': int(stats.counts[idx]),
+                    'bbox': [x_min, y_min, x_max - x_min + 1, y_max - y_min + 1],
+                    'segmentation': {'counts': rles[idx], 'size': [height, width]},
+                    'width': width, 'height': height}) + '\n')
+                self._next_annotation_id += 1
+
+        self._shard_images += 1
+        if self.shard_size > 0 and self._shard_images >= self.shard_size:
+            self._write_shard()
+        return image_id
+
+    def close(self):
+        if self._images is None:
+            return
+        if self.shard_size == 0:
+            self._write_annotations(os.path.join(self.out_directory, 'coco_annotations.json'))
+        elif self._shard_images > 0:
+            self._write_shard()
+        if self.shard_size > 0:
+            with open(os.path.join(self.out_directory, INDEX_NAME), 'w') as f:
+                json.dump({'shards': self.shards, 'categories': list(self.categories.values())},
+                          f, indent=4)
+        self._close_parts()
+        for name in os.listdir(self.parts_directory):
+            os.remove(os.path.join(self.parts_directory, name))
+        os.rmdir(self.parts_directory)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _open_parts(self):
+        self._images = open(os.path.join(self.parts_directory, 'images.jsonl'), 'w')
+        self._annotations = open(os.path.join(self.parts_directory, 'annotations.jsonl'), 'w')
+        self._shard_images = 0
+
+    def _close_parts(self):
+        self._images.close()
+        self._annotations.close()
+        self._images = None
+        self._annotations = None
+
+    def _write_shard(self):
+        name = f"coco_annotations_{len(self.shards):05d}.json"
+        self._write_annotations(os.path.join(self.out_directory, name))
+        self.shards.append({'name': name, 'nb_images': self._shard_images})
+        self._close_parts()
+        self._open_parts()
+
+    def _write_annotations(self, path):
+        """Stream the part files into a COCO annotation file."""
+        self._images.flush()
+        self._annotations.flush()
+        info = dict(INFO, date_created=str(datetime.datetime.now()))
+        with open(path + '.tmp', 'w') as f:
+            f.write('{"info": ' + json.dumps(info) + ', "licenses": ' + json.dumps(LICENSES))
+            f.write(', "categories": ' + json.dumps(sorted(self.categories.values(),
+                                                           key=lambda cc: cc['id'])))
+            for key, part in (('images', self._images), ('annotations', self._annotations)):
+                f.write(', "' + key + '": [')
+                with open(part.name) as lines:
+                    for ii, line in enumerate(lines):
+                        f.write((',' if ii else '') + line.rstrip('\n'))
+                f.write(']')
+            f.write('}')
+        os.replace(path + '.tmp', path)
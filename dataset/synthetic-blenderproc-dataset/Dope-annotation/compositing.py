@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+
+"""
+NumPy compositing of rendered frames, without going through PIL.
+
+The rendered RGBA buffer is blended straight over the prepared background
+array, in place, and the debug cuboid markers are stamped into the same
+array. All functions work on single images (H, W, C) as well as on batches
+(..., H, W, C).
+"""
+
+import numpy as np
+from PIL import ImageColor
+
+
+MARKER_COLORS = np.array([ImageColor.getrgb(cc) for cc in
+                          ['yellow', 'magenta', 'blue', 'red', 'green', 'orange', 'brown',
+                           'cyan', 'white']], dtype=np.uint8)
+
+
+def composite_over(rgba, background):
+    """
+    Blend 'rgba' over 'background' using the alpha channel of 'rgba' and
+    return 'background', which is modified in place. uint8 images are
+    blended with integer arithmetic; float images must hold alpha in [0, 1].
+    An RGB 'rgba' (no alpha channel) is simply copied.
+    """
+    if rgba.shape[-1] == 3:
+        background[...] = rgba
+        return background
+
+    color = rgba[..., 0:3]
+    alpha = rgba[..., 3:4]
+    if background.dtype == np.uint8:
+        # round(fg*a/255 + bg*(255-a)/255), computed in 16 bits
+        blended = color.astype(np.uint16) * alpha
+        blended += background * (255 - alpha).astype(np.uint16)
+        blended += 127
+        blended //= 255
+        background[...] = blended
+    else:
+        background *= 1.0 - alpha
+        background += color * alpha
+    return background
+
+
+def disc_offsets(radius):
+    """(dy, dx) offsets of the pixels of a filled disc, the same pixels ImageDraw.ellipse fills."""
+    dy, dx = np.mgrid[-radius:radius+1, -radius:radius+1]
+    inside = dy*dy + dx*dx <= radius*radius + radius
+    return dy[inside], dx[inside]
+
+
+def draw_markers(image, keypoints, radius=2, colors=MARKER_COLORS):
+    """
+    Draw a filled disc of radius 'radius' at every keypoint of 'keypoints'
+    (n_objects, n_keypoints, 2) into the (H, W, C) 'image', in place. Keypoint
+    k gets colors[k % len(colors)]; markers outside the image are clipped.
+    """
+    keypoints = np.asarray(keypoints, dtype=float).reshape(-1, np.shape(keypoints)[-2], 2)
+    if keypoints.size == 0:
+        return image
+    height, width = image.shape[0:2]
+    nb_keypoints = keypoints.shape[1]
+
+    dy, dx = disc_offsets(radius)
+    x = keypoints[..., 0].astype(int)[..., None] + dx # (n_objects, n_keypoints, n_disc)
+    y = keypoints[..., 1].astype(int)[..., None] + dy
+    color_index = np.broadcast_to((np.arange(nb_keypoints) % len(colors))[None, :, None], x.shape)
+
+    inside = (x >= 0) & (x < width) & (y >= 0) & (y < height)
+    pixels = colors[color_index[inside]]
+    image[y[inside], x[inside], 0:3] = pixels
+    if image.shape[-1] == 4:
+        image[y[inside], x[inside], 3] = 255
+    return image
@@ -3,29 +3,23 @@
 import blenderproc as bproc
 import argparse
 import os
+import sys
 import numpy as np
 from PIL import Image, ImageDraw
-import cv2
-import json
 from scipy.spatial.transform import Rotation as R  # Import scipy for quaternion conversion
 
-def get_cuboid_image_space(mesh, camera):
-    """Project the 3D cuboid corners into 2D image space."""
-    bbox = mesh.get_bound_box()
-    centroid = np.mean(bbox, axis=0)
-
-    cam_pose = np.linalg.inv(camera.get_camera_pose())  # world to camera transformation
-    tvec = -cam_pose[0:3, 3]
-    rvec = -cv2.Rodrigues(cam_pose[0:3, 0:3])[0]
-    K = camera.get_intrinsics_as_K_matrix()
-
-    # Reorder points to match the DOPE cuboid format
-    dope_order = [6, 2, 1, 5, 7, 3, 0, 4]
-    cuboid = [cv2.projectPoints(bbox[ii], rvec, tvec, K, np.array([]))[0][0][0] for ii in dope_order]
-    cuboid.append(cv2.projectPoints(centroid, rvec, tvec, K, np.array([]))[0][0][0])  # Add centroid
-    return np.array(cuboid, dtype=float).tolist()
-
-def write_json(outf, args, camera, objects, objects_data, seg_map):
+from annotation_shards import FRAMES_PER_SHARD, ShardedAnnotationWriter
+from async_writer import AsyncWriter
+from cuboid_projection import get_bound_boxes, project_cuboids
+from drop_library import DropLibrary
+from frame_manifest import FrameManifest, frame_seed
+from frame_profiler import FrameProfiler
+from instance_stats import instance_stats
+from occlusion_controller import (OCCLUSION_STREAM, STATE_NAME, OcclusionController, expected_areas,
+                                  line_of_sight_points, occlusion_ratios, parse_target)
+from scene_pool import LightPool, OccluderPool
+
+def write_json(outf, args, camera, objects, objects_data, seg_map, cuboids, writer):
     cam_xform = camera.get_camera_pose()
     eye = (-cam_xform[0:3, 3]).tolist()  # Apply negation first, then convert to list
     at = (-cam_xform[0:3, 2]).tolist()  # Apply negation first, then convert to list
@@ -52,15 +46,18 @@ def write_json(outf, args, camera, objects, objects_data, seg_map):
         "objects": []
     }
 
+    # Visibility, 2D box and truncation of every object from a single histogram pass
+    stats = instance_stats(seg_map, len(objects) + 1)
+
     # Object data
     for ii, obj in enumerate(objects):
         idx = ii + 1  # Object ID starts at 1
-        num_pixels = int(np.sum((seg_map == idx)))
+        num_pixels = int(stats.counts[idx])
 
         if num_pixels < args.min_pixels:
             continue
 
-        projected_keypoints = get_cuboid_image_space(obj, camera)
+        projected_keypoints = cuboids[ii].tolist()
 
         # Get the rotation matrix and convert to quaternion using scipy
         rotation_matrix = obj.get_rotation_mat()
@@ -70,32 +67,32 @@ def write_json(outf, args, camera, objects, objects_data, seg_map):
             'class': objects_data[ii]['class'],
             'name': objects_data[ii]['name'],
             'visibility': num_pixels,
-            'projected_cuboid': projected_keypoints,  # Already converted to list in get_cuboid_image_space
+            'bounding_box': stats.bounding_box(idx),
+            'truncated': bool(stats.truncated[idx]),
+            'projected_cuboid': projected_keypoints,
             'location': obj.get_location().tolist(),  # Convert location (ndarray) to list
             'quaternion_xyzw': quaternion.tolist()  # Convert quaternion (ndarray) to list
         })
 
-    with open(outf, "w") as write_file:
-        json.dump(data, write_file, indent=4)
+    writer.save_json(outf, data, indent=4)
 
     return data
 
-def draw_cuboid_markers(objects, camera, im):
+def draw_cuboid_markers(cuboids, im):
     """Draw cuboid markers (keypoints) on the image."""
     colors = ['yellow', 'magenta', 'blue', 'red', 'green', 'orange', 'brown', 'cyan', 'white']
     R = 2  # Radius of the keypoint markers
     draw = ImageDraw.Draw(im)  # Prepare to draw on the image
-    for obj in objects:
-        projected_keypoints = get_cuboid_image_space(obj, camera)  # Project to 2D
+    for projected_keypoints in cuboids:
         for idx, pp in enumerate(projected_keypoints):
             x, y = int(pp[0]), int(pp[1])
             draw.ellipse((x-R, y-R, x+R, y+R), fill=colors[idx % len(colors)])  # Draw colored markers
     return im
 
-def add_random_lights():
-    """Add random lights to the scene."""
+def add_random_lights(light_pool):
+    """Light the scene with random lights from the pool."""
     num_lights = np.random.randint(1, 4)  # Random number of lights (1 to 3)
-    for _ in range(num_lights):
+    for light in light_pool.use(num_lights):
         # Random position for the light
         light_location = np.random.uniform([-10, -10, 5], [10, 10, 15])
         
@@ -105,37 +102,79 @@ def add_random_lights():
         # Random color for the light
         light_color = np.random.uniform([0.8, 0.8, 0.8], [1, 1, 1])  # Slightly varying white
 
-        # Add the light to the scene
-        light = bproc.types.Light()
-        light.set_type('POINT')
+        # Re-parameterize the pooled light
         light.set_location(light_location)
         light.set_energy(light_intensity)
         light.set_color(light_color)
 
-def add_occlusion_objects():
-    """Add random objects to fall on the scene to create occlusions."""
-    num_objects = np.random.randint(3, 100)  # Random number of occlusion objects (3 to 5)
-    
+def add_occlusion_objects(occluder_pool, level=None, eye=None, targets=None, rng=None):
+    """
+    Place random objects from the pool to fall on the scene to create occlusions.
+    With an occlusion 'level' in [0, 1] (see occlusion_controller.py), the count and
+    size of the objects grow with the level, and that share of them is put on the
+    lines of sight from the camera 'eye' to the 'targets' centers.
+    """
+    if level is None:
+        num_objects = np.random.randint(3, 100)  # Random number of occlusion objects (3 to 99)
+        choice, uniform = np.random.choice, np.random.uniform
+    else:
+        # Draw everything from the frame's own generator, so a frame rendered
+        # again on --resume gets the same occluders as in the first run
+        num_objects = int(np.clip(round((3 + 96 * level) * rng.uniform(0.8, 1.2)), 1, 99))
+        choice, uniform = rng.choice, rng.uniform
+
+    # Randomly pick a type of object (cube, sphere, etc.) and randomize its location and scale
+    shapes = []
+    placements = []
     for _ in range(num_objects):
-        # Randomly pick a type of object (cube, sphere, etc.)
-        object_type = np.random.choice(['cube', 'sphere'])
-        
-        # Create the object
-        if object_type == 'cube':
-            occluder = bproc.object.create_primitive('CUBE')
-        else:
-            occluder = bproc.object.create_primitive('SPHERE')
-
-        # Randomize the object location and scale
-        location = np.random.uniform([-5, -5, 10], [5, 5, 15])  # Fall from a random height above the scene
-        scale = np.random.uniform(0.3, 1.0, size=3)  # Random scale for the object
+        shapes.append('CUBE' if choice(['cube', 'sphere']) == 'cube' else 'SPHERE')
+        location = uniform([-5, -5, 10], [5, 5, 15])  # Fall from a random height above the scene
+        scale = uniform(0.3, 1.0, size=3)  # Random scale for the object
+        if level is not None:
+            scale *= 0.5 + level
+        placements.append((location, scale))
+    if level is not None:
+        in_sight = np.flatnonzero(uniform(size=num_objects) < level)
+        for ii, location in zip(in_sight, line_of_sight_points(eye, targets, len(in_sight), rng)):
+            placements[ii] = (location, placements[ii][1])
+
+    # The pooled objects already have a rigid body to simulate them falling
+    for occluder, (location, scale) in zip(occluder_pool.use(shapes), placements):
         occluder.set_location(location)
         occluder.set_scale(scale)
 
-        # Apply gravity to simulate the object falling
-        occluder.enable_rigidbody(active=True, mass=1.0)
+def place_baked_drop(occluder_pool, drop_library):
+    """Place the occluders of a random drop baked by bake_drops.py, already at rest on the scene."""
+    shapes, locations, rotations, scales = drop_library.sample()
+    for occluder, location, rotation, scale in zip(occluder_pool.use(shapes), locations, rotations, scales):
+        occluder.set_location(location)
+        occluder.set_rotation_euler(rotation)
+        occluder.set_scale(scale)
 
 def main(args):
+    # Make output directory
+    out_directory = args.outf if args.run_id is None else os.path.join(args.outf, str(args.run_id))
+    os.makedirs(out_directory, exist_ok=True)
+
+    # Frame manifest, used to resume an interrupted run
+    try:
+        manifest = FrameManifest.open(out_directory, args.seed, args.resume, args.overwrite)
+    except FileExistsError as e:
+        print(e)
+        sys.exit(1)
+
+    # PNG encoding and JSON dumps overlap the rendering of the next frame
+    writer = AsyncWriter(workers=args.writer_workers, max_pending=args.writer_queue,
+                         compress_level=args.png_compression, use_processes=args.writer_processes)
+
+    # Optional compact copy of the annotations for the training loader
+    shard_writer = None
+    if args.annotation_shards:
+        shard_writer = ShardedAnnotationWriter(args.annotation_shards, args.frames_per_shard)
+
+    # Seed the random generators so a run (or a shard of a run) can be reproduced
+    np.random.seed(manifest.seed)
+
     # Set up blenderproc
     bproc.init()
 
@@ -158,17 +197,69 @@ def main(args):
     # Renderer setup
     bproc.renderer.set_output_format('PNG')
     bproc.renderer.set_render_devices(desired_gpu_ids=[0])
+    if args.cpu_threads > 0:
+        bproc.renderer.set_cpu_threads(args.cpu_threads)
+
+    # Lights and occluders are reused from frame to frame so the scene keeps a constant size
+    light_pool = LightPool(size=3)
+    occluder_pool = OccluderPool(size=99)
+
+    # Settled occluder poses simulated once by bake_drops.py
+    drop_library = None
+    if args.drop_library:
+        drop_library = DropLibrary(args.drop_library)
+        if len(drop_library) == 0:
+            print(f"No drops found in {args.drop_library}")
+            return
+
+    # Occluders steered toward a target histogram of occlusion ratios
+    controller = None
+    controller_path = os.path.join(out_directory, STATE_NAME)
+    if args.occlusion_target:
+        if drop_library is not None:
+            print("--occlusion_target only steers procedural occluders, ignoring --drop_library")
+            drop_library = None
+        edges, weights = parse_target(args.occlusion_target)
+        if args.resume:
+            controller = OcclusionController.load(controller_path, edges, weights,
+                                                  exploration=args.occlusion_exploration)
+        else:
+            controller = OcclusionController(edges, weights, exploration=args.occlusion_exploration)
+        eye = cam_pose[0:3, 3]
+        target_centers = get_bound_boxes(target_objects).mean(axis=1)
+
+    # Per-frame stage timings
+    profiler = FrameProfiler(args.profile, args.profile_report_every, args.cprofile_every)
 
     # Prepare folder for JSON data
-    for frame in range(args.nb_frames):
+    complete = [frame for frame in range(args.nb_frames) if args.resume and manifest.is_complete(frame)]
+    frames = sorted(set(range(args.nb_frames)) - set(complete))
+    if shard_writer is not None:
+        # finished frames whose annotations were lost with the buffer of an interrupted run
+        shard_writer.append_missing({f"frame_{frame:06d}": os.path.join(out_directory, f"frame_{frame:06d}.json")
+                                     for frame in complete})
+    for frame in profiler.frames(frames):
+        # Every frame has its own random state so it can be regenerated on its own
+        manifest.seed_frame(frame)
+
         # Add random lights to the scene
-        add_random_lights()
+        with profiler.stage('lights'):
+            add_random_lights(light_pool)
 
         # Add random occlusion objects to fall on the scene
-        add_occlusion_objects()
+        with profiler.stage('occluders'):
+            if drop_library is not None:
+                place_baked_drop(occluder_pool, drop_library)
+            elif controller is not None:
+                rng = np.random.default_rng(frame_seed(manifest.seed, frame, OCCLUSION_STREAM))
+                level_index = controller.choose(rng)
+                add_occlusion_objects(occluder_pool, controller.level(level_index), eye, target_centers, rng)
+            else:
+                add_occlusion_objects(occluder_pool)
 
         # Render the scene
-        data = bproc.renderer.render()
+        with profiler.stage('render'):
+            data = bproc.renderer.render()
 
         # Get segmentation map
         seg_map = data.get("instance_segmaps")[0]  # Segmentation map of the first frame
@@ -182,18 +273,50 @@ def main(args):
                 'location': obj.get_location().tolist()  # Convert location to list
             })
 
+        # Project the cuboids of all target objects once for the JSON data and the debug overlay
+        with profiler.stage('projection'):
+            cuboids = project_cuboids(target_objects, bproc.camera)
+
         # Save JSON and images
-        json_filename = os.path.join(args.outf, f"frame_{frame:06d}.json")
-        write_json(json_filename, args, bproc.camera, target_objects, objects_data, seg_map)
+        json_filename = os.path.join(out_directory, f"frame_{frame:06d}.json")
+        with profiler.stage('write_json'):
+            frame_data = write_json(json_filename, args, bproc.camera, target_objects, objects_data, seg_map, cuboids, writer)
+            if shard_writer is not None:
+                shard_writer.append(f"frame_{frame:06d}", frame_data)
+
+        # Feed the occlusion ratios of the frame back to the controller
+        if controller is not None:
+            with profiler.stage('occlusion_control'):
+                visible = {oo['name']: oo['visibility'] for oo in frame_data['objects']}
+                areas = expected_areas(get_bound_boxes(target_objects), bproc.camera.get_camera_pose(),
+                                       bproc.camera.get_intrinsics_as_K_matrix(), args.width, args.height)
+                ratios = occlusion_ratios([visible.get(oo['name'], 0) for oo in objects_data], areas,
+                                          min_area=max(100, args.min_pixels))
+                controller.update(level_index, ratios)
+                if controller.nb_frames % args.occlusion_save_every == 0:
+                    controller.save(controller_path, writer)
 
         im = Image.fromarray(data['colors'][0])
         if args.debug:
-            im = draw_cuboid_markers(target_objects, bproc.camera, im)
+            im = draw_cuboid_markers(cuboids, im)
+
+        image_filename = os.path.join(out_directory, f"frame_{frame:06d}.png")
+        with profiler.stage('save_image'):
+            writer.save_image(image_filename, np.asarray(im))
+
+        # The frame is recorded once its files are on disk
+        writer.after_pending(lambda frame=frame, files=[image_filename, json_filename]:
+                             manifest.record(frame, files))
 
-        image_filename = os.path.join(args.outf, f"frame_{frame:06d}.png")
-        im.save(image_filename)
+    if controller is not None:
+        controller.save(controller_path, writer)
+        print(controller.report())
+    writer.close()
+    if shard_writer is not None:
+        shard_writer.close()
+    profiler.close()
 
-    print(f"Saved JSON and images to {args.outf}")
+    print(f"Saved JSON and images to {out_directory}")
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -205,6 +328,31 @@ if __name__ == "__main__":
     parser.add_argument('--outf', default='output/', help="output folder for images and JSON data")
     parser.add_argument('--min_pixels', default=100, type=int, help="minimum number of pixels for visibility")
     parser.add_argument('--debug', action='store_true', help="Render cuboid markers for debugging purposes")
+    parser.add_argument('--drop_library', default=None,
+                        help="library of occluder drops baked by bake_drops.py (see drop_library.py) instead of occluders hanging where they spawn")
+    parser.add_argument('--occlusion_target', default=None,
+                        help="steer the occluders toward this histogram of occlusion ratios, 'low:high:bins' (e.g. 0:0.8:8) or comma separated bin weights over [0, 1]")
+    parser.add_argument('--occlusion_exploration', default=0.1, type=float, help="share of the frames that try a random occlusion level")
+    parser.add_argument('--occlusion_save_every', default=50, type=int, help="save the state of the occlusion controller every N frames, for --resume")
+    parser.add_argument('--seed', default=None, type=int, help="seed of the random generators")
+    parser.add_argument('--nb_runs', default=1, type=int, help="how many runs generate the dataset together (set by run_blenderproc_datagen.py)")
+    parser.add_argument('--run_id', default=None, type=int,
+                        help="if set, output files are put in a subdirectory of this name (set by run_blenderproc_datagen.py)")
+    parser.add_argument('--resume', action='store_true',
+                        help="skip the frames recorded as complete in the manifest of --outf and regenerate the rest")
+    parser.add_argument('--overwrite', action='store_true', help="start over in an output folder that already holds frames")
+    parser.add_argument('--annotation_shards', default=None,
+                        help="also append the annotations to sharded NumPy arrays in this folder (one folder per run)")
+    parser.add_argument('--frames_per_shard', default=FRAMES_PER_SHARD, type=int, help="how many frames each annotation shard holds")
+    parser.add_argument('--png_compression', default=6, type=int, help="PNG compression level, 0 (fastest) to 9 (smallest)")
+    parser.add_argument('--writer_workers', default=2, type=int,
+                        help="threads (or processes) writing the output files in the background, 0 writes synchronously")
+    parser.add_argument('--writer_queue', default=8, type=int, help="files that may wait to be written before rendering blocks")
+    parser.add_argument('--writer_processes', action='store_true', help="encode the output files in processes instead of threads")
+    parser.add_argument('--profile', default=None, help="write the time spent in every stage of every frame to this .jsonl or .csv file")
+    parser.add_argument('--profile_report_every', default=50, type=int, help="print the rolling frames per second every N frames, 0 disables it")
+    parser.add_argument('--cprofile_every', default=0, type=int, help="run every Nth frame under cProfile and dump its statistics, 0 disables it")
+    parser.add_argument('--cpu_threads', default=0, type=int, help="number of render threads, 0 lets blender decide")
 
     opt = parser.parse_args()
     main(opt)
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+
+"""
+Batched projection of object cuboids into image space.
+
+All the objects of a frame are projected with a single matrix product instead
+of one cv2.projectPoints call per corner. The world to camera transform and the
+intrinsics are computed once per frame and shared by the JSON writer and the
+debug overlay.
+"""
+
+import numpy as np
+
+
+# The bounding box corners returned by blender are in a different order than
+# the original DOPE data format; DOPE keypoint k is blender corner DOPE_ORDER[k].
+# The centroid is appended as the 9th keypoint.
+DOPE_ORDER = [6, 2, 1, 5, 7, 3, 0, 4]
+
+
+class FrameProjection:
+    """
+    World to image projection of one frame. Build it once per frame with
+    from_camera() and reuse it for every object.
+    """
+
+    def __init__(self, cam2world, K):
+        world2cam = np.linalg.inv(cam2world) # 4x4 world to camera transformation matrix
+        # cv2.projectPoints used to be called with rvec = -Rodrigues(R) and
+        # tvec = -t of the world to camera transform; a negated rotation vector
+        # is the transposed rotation matrix.
+        self.rotation = world2cam[0:3,0:3].T
+        self.translation = -world2cam[0:3,3]
+        self.K = np.asarray(K, dtype=float)
+
+    @classmethod
+    def from_camera(cls, camera):
+        return cls(camera.get_camera_pose(), camera.get_intrinsics_as_K_matrix())
+
+    def project(self, points):
+        """Project world points of shape (..., 3) to pixels of shape (..., 2)."""
+        points = np.asarray(points, dtype=float)
+        cam = points @ self.rotation.T + self.translation
+        xy = cam[..., 0:2] / cam[..., 2:3]
+        uv = np.empty_like(xy)
+        uv[..., 0] = self.K[0,0] * xy[..., 0] + self.K[0,2]
+        uv[..., 1] = self.K[1,1] * xy[..., 1] + self.K[1,2]
+        return uv
+
+    def project_cuboids(self, bboxes):
+        """
+        Project bounding boxes of shape (n_objects, 8, 3) to DOPE keypoints of
+        shape (n_objects, 9, 2): the 8 reordered corners plus the centroid.
+        """
+        bboxes = np.asarray(bboxes, dtype=float).reshape(-1, 8, 3)
+        keypoints = np.concatenate([bboxes[:, DOPE_ORDER],
+                                    bboxes.mean(axis=1, keepdims=True)], axis=1)
+        return self.project(keypoints)
+
+
+def get_bound_boxes(objects):
+    '''
+    World-space oriented bounding boxes of all the objects, shape (n_objects, 8, 3).
+    Each box lists the corners of a blender object's oriented bounding box
+     https://blender.stackexchange.com/questions/32283/what-are-all-values-in-bound-box
+
+                   TOP
+           3 +-----------------+ 7
+            /                 /|
+           /                 / |
+        2 +-----------------+ 6
+          |     z    y      |  |
+          |      | /        |  |
+          |      |/         |  |
+          |  |   +--- x     |  |
+           0 +-             |  + 4
+          | /               | /
+          |                 |/
+        1 +-----------------+ 5
+                FRONT
+
+    '''
+    if len(objects) == 0:
+        return np.zeros((0, 8, 3))
+    return np.stack([np.asarray(oo.get_bound_box(), dtype=float) for oo in objects])
+
+
+def project_cuboids(objects, camera):
+    """Projected DOPE cuboids of all the objects in the current frame, shape (n_objects, 9, 2)."""
+    return FrameProjection.from_camera(camera).project_cuboids(get_bound_boxes(objects))
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+
+"""
+Submit jobs to generator_daemon.py, and benchmark the daemon against one-shot
+launches.
+
+    python daemon_client.py submit jobs/ dope_model.py -- --nb_frames 200 --outf output/a
+    python daemon_client.py wait jobs/ <job name> ...
+    python daemon_client.py stop jobs/
+
+The benchmark runs the same jobs twice: first as one 'blenderproc run'
+process each, then through a daemon it starts on a fresh queue, a new
+daemon_queue_* subdirectory of the given directory. Both times
+are wall-clock times, and the daemon's includes its own startup. '{job}' and
+'{mode}' in the script arguments are replaced by the index of the job and by
+'oneshot' or 'daemon', so every job gets its own output directory.
+
+    python daemon_client.py benchmark bench/ cuboid-generator-6.py --nb_jobs 10 -- \
+        --scene scene11.blend --nb_frames 50 --outf bench/{mode}/{job}
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+
+QUEUE_DIRECTORIES = ('pending', 'running', 'done', 'failed')
+STOP_NAME = 'stop'
+
+
+def submit(queue, script, args, name=None, cwd=None, rescan=False):
+    """Add a job to the queue and return its name."""
+    for directory in QUEUE_DIRECTORIES:
+        os.makedirs(os.path.join(queue, directory), exist_ok=True)
+    if name is None:
+        name = f"{time.time_ns()}_{os.path.splitext(os.path.basename(script))[0]}"
+    if os.path.exists(script):
+        script = os.path.abspath(script)
+    spec = {'script': script, 'args': list(args), 'cwd': cwd, 'rescan': rescan}
+    # written next to the queue and renamed, so a daemon never reads half a job
+    tmp_path = os.path.join(queue, name + '.json.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(spec, f, indent=4)
+    os.replace(tmp_path, os.path.join(queue, 'pending', name + '.json'))
+    return name
+
+
+def result(queue, name):
+    """Finished spec of a job, with its status, or None while it is pending or running."""
+    for status in ('done', 'failed'):
+        path = os.path.join(queue, status, name + '.json')
+        if os.path.exists(path):
+            with open(path) as f:
+                return json.load(f)
+    return None
+
+
+def wait(queue, names, poll=0.5, timeout=0, process=None):
+    """Wait for the jobs and return their finished specs; 'process' is a daemon that must stay alive."""
+    start = time.perf_counter()
+    results = {}
+    while len(results) < len(names):
+        for name in names:
+            if name not in results:
+                finished = result(queue, name)
+                if finished is not None:
+                    results[name] = finished
+        if len(results) < len(names):
+            if timeout > 0 and time.perf_counter() - start > timeout:
+                raise TimeoutError(f"{len(names) - len(results)} jobs still running after {timeout}s")
+            if process is not None and process.poll() is not None:
+                raise RuntimeError(f"the daemon exited with status {process.returncode} before its jobs were done")
+            time.sleep(poll)
+    return [results[name] for name in names]
+
+
+def stop(queue):
+    os.makedirs(queue, exist_ok=True)
+    open(os.path.join(queue, STOP_NAME), 'w').close()
+
+
+def job_args(script_args, mode, job):
+    return [aa.replace('{mode}', mode).replace('{job}', str(job)) for aa in script_args]
+
+
+def benchmark(queue, script, script_args, nb_jobs, daemon_args=()):
+    """Jobs per hour of one-shot launches and of the daemon, and the error count of each."""
+    here = os.path.dirname(os.path.abspath(__file__))
+    script_path = script if os.path.exists(script) else os.path.join(here, script)
+
+    start = time.perf_counter()
+    oneshot_errors = 0
+    for job in range(nb_jobs):
+        command = ['blenderproc', 'run', script_path] + job_args(script_args, 'oneshot', job)
+        oneshot_errors += subprocess.run(command).returncode != 0
+    oneshot_seconds = time.perf_counter() - start
+
+    # a new queue inside the given directory, which may also hold the outputs of the jobs
+    os.makedirs(queue, exist_ok=True)
+    queue = tempfile.mkdtemp(prefix='daemon_queue_', dir=queue)
+    start = time.perf_counter()
+    daemon = subprocess.Popen(['blenderproc', 'run', os.path.join(here, 'generator_daemon.py'),
+                               '--queue', queue] + list(daemon_args))
+    names = [submit(queue, script_path, job_args(script_args, 'daemon', job), name=f"job_{job:05d}",
+                    cwd=os.getcwd())
+             for job in range(nb_jobs)]
+    results = wait(queue, names, process=daemon)
+    daemon_seconds = time.perf_counter() - start
+    stop(queue)
+    daemon.wait()
+
+    return {'nb_jobs': nb_jobs, 'queue': queue,
+            'oneshot': {'seconds': oneshot_seconds, 'jobs_per_hour': 3600.0 * nb_jobs / oneshot_seconds,
+                        'failed': int(oneshot_errors)},
+            'daemon': {'seconds': daemon_seconds, 'jobs_per_hour': 3600.0 * nb_jobs / daemon_seconds,
+                       'failed': sum(rr['status'] != 'done' for rr in results),
+                       'job_seconds': [rr['seconds'] for rr in results]}}
+
+
+if __name__ == "__main__":
+    argv = sys.argv[1:]
+    script_args = []
+    if '--' in argv:
+        split = argv.index('--')
+        argv, script_args = argv[:split], argv[split+1:]
+
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    submit_parser = commands.add_parser('submit', help="add a job to a queue; the script arguments follow '--'")
+    submit_parser.add_argument('queue', help="queue directory of the daemon")
+    submit_parser.add_argument('script', help="generator script to run")
+    submit_parser.add_argument('--name', default=None, help="name of the job, unique in the queue")
+    submit_parser.add_argument('--cwd', default=os.getcwd(), help="directory the job runs in, the current one by default")
+    submit_parser.add_argument('--rescan', action='store_true', help="scan the model folders again instead of using the cached lists")
+    submit_parser.add_argument('--wait', action='store_true', help="wait for the job to finish")
+
+    wait_parser = commands.add_parser('wait', help="wait for jobs to finish")
+    wait_parser.add_argument('queue', help="queue directory of the daemon")
+    wait_parser.add_argument('names', nargs='+', help="names of the jobs")
+    wait_parser.add_argument('--timeout', default=0, type=float, help="give up after this many seconds, 0 waits forever")
+
+    stop_parser = commands.add_parser('stop', help="stop the daemons of a queue after their current job")
+    stop_parser.add_argument('queue', help="queue directory of the daemon")
+
+    benchmark_parser = commands.add_parser('benchmark', help="compare jobs per hour of the daemon and of one-shot launches")
+    benchmark_parser.add_argument('queue', help="directory the benchmark creates the queue of its daemon in")
+    benchmark_parser.add_argument('script', help="generator script to run")
+    benchmark_parser.add_argument('--nb_jobs', default=10, type=int, help="jobs run each way")
+    benchmark_parser.add_argument('--depth', action='store_true', help="start the daemon with --depth")
+    benchmark_parser.add_argument('--output', default=None, help="also save the results to this JSON file")
+
+    opt = parser.parse_args(argv)
+
+    if opt.command == 'submit':
+        name = submit(opt.queue, opt.script, script_args, opt.name, opt.cwd, opt.rescan)
+        print(name)
+        if opt.wait:
+            finished = wait(opt.queue, [name])[0]
+            print(f"{name} {finished['status']} in {finished['seconds']:.1f}s")
+            sys.exit(0 if finished['status'] == 'done' else 1)
+    elif opt.command == 'wait':
+        failed = 0
+        for finished, name in zip(wait(opt.queue, opt.names, timeout=opt.timeout), opt.names):
+            print(f"{name} {finished['status']} in {finished['seconds']:.1f}s")
+            failed += finished['status'] != 'done'
+        sys.exit(1 if failed else 0)
+    elif opt.command == 'stop':
+        stop(opt.queue)
+    else:
+        results = benchmark(opt.queue, opt.script, script_args, opt.nb_jobs,
+                            ['--depth'] if opt.depth else [])
+        for mode in ('oneshot', 'daemon'):
+            print(f"{mode:>8}: {results[mode]['seconds']:.1f}s, {results[mode]['jobs_per_hour']:.1f} jobs/hour, "
+                  f"{results[mode]['failed']} failed")
+        print(f"speedup: {results['daemon']['jobs_per_hour'] / results['oneshot']['jobs_per_hour']:.2f}x")
+        if opt.output:
+            with open(opt.output, 'w') as f:
+                json.dump(results, f, indent=4)
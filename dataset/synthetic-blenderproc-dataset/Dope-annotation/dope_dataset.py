@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+
+"""
+Random-access reader for DOPE-style output directories.
+
+Both layouts written by our generators are supported:
+
+    NVISII       00000.png  00000.json  00000.depth.exr  00000.seg.exr
+                 _camera_settings.json  _object_settings.json
+    BlenderProc  frame_000000.png  frame_000000.json  (or 000000.png / .json)
+
+The directory is scanned once and a persistent index is stored in
+<root>/.dope_index: the file paths of every frame plus its annotations in the
+sharded NumPy format of annotation_shards.py. Queries such as "frames with at
+least one door over 5000 visible pixels" run on the memory-mapped index without
+opening any JSON. Images, depth and segmentation maps are loaded lazily; with
+decode_cache=True they are decoded once into .npy files and memory-mapped from
+then on.
+
+    python dope_dataset.py query <root> --class door --min_visibility 5000
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+
+from annotation_shards import AnnotationShards, ShardedAnnotationWriter, is_frame_annotation
+
+
+INDEX_DIRECTORY = '.dope_index'
+FILES_NAME = 'files.npy'
+STATE_NAME = 'state.json'
+
+# kind of file -> name suffixes, in order of preference
+FILE_KINDS = {
+    'image': ['.png', '.jpg', '.jpeg'],
+    'json': ['.json'],
+    'depth': ['.depth.npy', '.depth.exr'],
+    'seg': ['.seg.npy', '.seg.exr'],
+}
+
+
+def _split_name(filename):
+    """'00012.depth.exr' -> ('00012', '.depth.exr'); settings files ('_...') are skipped."""
+    if filename.startswith(('_', '.')):
+        return None
+    stem, dot, _ = filename.partition('.')
+    if not dot:
+        return None
+    return stem, filename[len(stem):].lower()
+
+
+def scan_frames(root):
+    """
+    Group the files of every frame under 'root': {frame name: {kind: path}}.
+    Also returns a signature of the files (names, sizes and modification
+    times), which changes whenever one is added, removed or replaced.
+    """
+    frames = {}
+    stats = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = sorted(dd for dd in dirnames if not dd.startswith('.'))
+        for filename in filenames:
+            split = _split_name(filename)
+            if split is None:
+                continue
+            stem, suffix = split
+            for kind, suffixes in FILE_KINDS.items():
+                if suffix in suffixes:
+                    path = os.path.join(dirpath, filename)
+                    name = os.path.relpath(os.path.join(dirpath, stem), root)
+                    files = frames.setdefault(name, {})
+                    current = files.get(kind)
+                    if current is None or suffixes.index(suffix) < \
+                            suffixes.index(_split_name(os.path.basename(current))[1]):
+                        files[kind] = path
+                    stat = os.stat(path)
+                    stats.append(f"{os.path.relpath(path, root)}\0{stat.st_size}\0{stat.st_mtime_ns}")
+                    break
+    # frames need an image or an annotation; stray depth/seg files are ignored
+    frames = {nn: ff for nn, ff in frames.items() if 'image' in ff or 'json' in ff}
+    digest = hashlib.sha256('\n'.join(sorted(stats)).encode()).hexdigest()
+    return frames, [len(stats), digest]
+
+
+def _read_exr(path):
+    # OpenCV only decodes EXR files when this is set before it is imported
+    os.environ.setdefault('OPENCV_IO_ENABLE_OPENEXR', '1')
+    import cv2
+    array = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+    if array is None:
+        raise IOError(f"Could not read '{path}'; OpenCV needs OpenEXR support for .exr files")
+    return array
+
+
+def read_array(path):
+    if path.endswith('.npy'):
+        return np.load(path, mmap_mode='r')
+    if path.endswith('.exr'):
+        return _read_exr(path)
+    from PIL import Image
+    with Image.open(path) as img:
+        return np.asarray(img)
+
+
+class DopeDataset:
+    """
+    root         - dataset directory, scanned recursively
+    rebuild      - rebuild the index even if it is up to date
+    decode_cache - decode images/depth/segmentation once into .npy files in
+                   the index directory and memory-map them afterwards
+    """
+
+    def __init__(self, root, rebuild=False, decode_cache=False):
+        self.root = root
+        self.index_directory = os.path.join(root, INDEX_DIRECTORY)
+        self.decode_cache = decode_cache
+
+        frames, signature = scan_frames(root)
+        if rebuild or self._stored_signature() != signature:
+            self._build(frames, signature)
+
+        self.files = np.load(os.path.join(self.index_directory, FILES_NAME), mmap_mode='r')
+        self.annotations_directory = os.path.join(self.index_directory, 'annotations')
+        self.annotations = AnnotationShards(self.annotations_directory)
+        self.names = self.annotations.field('frame_names')
+        self.classes = self.annotations.classes
+        self.object_offsets = self.annotations.field('object_offsets')
+        self.object_frames = np.repeat(np.arange(len(self.names)), np.diff(self.object_offsets))
+
+    def __len__(self):
+        return len(self.names)
+
+    def paths(self, index):
+        return {kind: os.path.join(self.root, str(path))
+                for kind, path in zip(FILE_KINDS, self.files[index]) if path}
+
+    def annotation(self, index):
+        """Annotations of a frame from the index, as arrays (see annotation_shards.py)."""
+        return self.annotations.frame(index)
+
+    def load_json(self, index):
+        with open(self.paths(index)['json']) as f:
+            return json.load(f)
+
+    def image(self, index):
+        return self._load(index, 'image')
+
+    def depth(self, index):
+        return self._load(index, 'depth')
+
+    def segmentation(self, index):
+        return self._load(index, 'seg')
+
+    def query(self, class_name=None, min_visibility=0, min_objects=1):
+        """
+        Indices of the frames with at least 'min_objects' objects of class
+        'class_name' (any class if None, case insensitive) that have at least
+        'min_visibility' visible pixels.
+        """
+        selected = self.annotations.field('visibility') >= min_visibility
+        if class_name is not None:
+            class_ids = [ii for ii, cc in enumerate(self.classes) if cc.lower() == class_name.lower()]
+            selected &= np.isin(self.annotations.field('class_ids'), class_ids)
+        counts = np.bincount(self.object_frames[selected], minlength=len(self))
+        return np.flatnonzero(counts >= min_objects)
+
+    def _load(self, index, kind):
+        path = self.paths(index).get(kind)
+        if path is None:
+            return None
+        if not self.decode_cache or path.endswith('.npy'):
+            return read_array(path)
+
+        cache_path = os.path.join(self.index_directory, 'decoded', kind,
+                                  str(self.names[index]) + '.npy')
+        if not os.path.exists(cache_path):
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            np.save(cache_path + '.tmp.npy', read_array(path))
+            os.replace(cache_path + '.tmp.npy', cache_path)
+        return np.load(cache_path, mmap_mode='r')
+
+    def _stored_signature(self):
+        try:
+            with open(os.path.join(self.index_directory, STATE_NAME)) as f:
+                return json.load(f)['signature']
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def _build(self, frames, signature):
+        annotations_directory = os.path.join(self.index_directory, 'annotations')
+        if os.path.isdir(annotations_directory):
+            shutil.rmtree(annotations_directory)
+
+        names = sorted(frames)
+        # paths are relative to the root so the dataset can be moved with its index
+        files = np.array([[os.path.relpath(frames[nn][kind], self.root) if kind in frames[nn] else ''
+                           for kind in FILE_KINDS] for nn in names],
+                         dtype=str).reshape(len(names), len(FILE_KINDS))
+
+        # the index is rebuilt as a whole, so it is kept in one shard
+        with ShardedAnnotationWriter(annotations_directory, max(1, len(names))) as writer:
+            for name in names:
+                data = None
+                if 'json' in frames[name]:
+                    with open(frames[name]['json']) as f:
+                        data = json.load(f)
+                if not is_frame_annotation(data):
+                    data = {'camera_data': {}, 'objects': []}
+                writer.append(name, data)
+
+        np.save(os.path.join(self.index_directory, FILES_NAME), files)
+        with open(os.path.join(self.index_directory, STATE_NAME), 'w') as f:
+            json.dump({'signature': signature, 'nb_frames': len(names)}, f)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    index_parser = subparsers.add_parser('index', help="build or refresh the index of a dataset")
+    index_parser.add_argument('root', help="dataset directory")
+    index_parser.add_argument('--rebuild', action='store_true', help="rebuild even if up to date")
+
+    query_parser = subparsers.add_parser('query', help="list the frames matching a filter")
+    query_parser.add_argument('root', help="dataset directory")
+    query_parser.add_argument('--class', dest='class_name', default=None, help="object class")
+    query_parser.add_argument('--min_visibility', default=0, type=int,
+                              help="minimum number of visible pixels of an object")
+    query_parser.add_argument('--min_objects', default=1, type=int,
+                              help="minimum number of matching objects in a frame")
+
+    opt = parser.parse_args()
+    if opt.command == 'index':
+        dataset = DopeDataset(opt.root, rebuild=opt.rebuild)
+        print(f"{len(dataset)} frames indexed in '{dataset.index_directory}'")
+    else:
+        dataset = DopeDataset(opt.root)
+        for ii in dataset.query(opt.class_name, opt.min_visibility, opt.min_objects):
+            print(dataset.paths(ii).get('image', dataset.names[ii]))
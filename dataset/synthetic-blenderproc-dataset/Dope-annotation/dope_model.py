@@ -5,226 +5,29 @@ from blenderproc.python.utility.Utility import Utility
 import bpy
 
 import argparse
-import cv2
 import glob
-import json
-from math import acos, atan, cos, pi, sin, sqrt
 import numpy as np
 import os
-from PIL import Image, ImageDraw
 from pyquaternion import Quaternion
 import random
 import sys
 
-
-def random_object_position(near=5.0, far=40.0):
-    # Specialized function to randomly place the objects in a visible
-    # location
-    x = 20 - 40*random.random()
-    y = near + (far-near)*random.random()
-    z = 20 - 40*random.random()
-    return np.array([x, y, z])
-
-
-def random_depth_in_frustrum(tw, th, bw, bh, depth):
-    '''
-    Generate a random depth within a frustrum. In order to get a uniform volume
-    distribution, we want the probability density function to be proportional to
-    the cross-sectional area of the frustum at the generated depth.
-
-    tw, th - the width and height, respectively at the "top" (narrowest part)
-             of the frustrum
-    bw, bh - the width and height, respectively at the "bottom" (widest part)
-             of the frustrum
-    depth  - depth of frustrum (distance between 'top' and 'bottom')
-    '''
-    A = (tw - bw) * (th - bw)/(depth * depth)
-    B = (bw * (tw - bw) + bw * (th - bw))/depth
-    C = bw * bw
-    area = depth * (C + depth * (0.5 * B + depth * A / 3.0))
-    r = random.random() * area
-    det = B * B - 4 * A * C
-    part1 = B * (B * B - 6 * A * C) - 12 * A * A * r
-    part2 = sqrt(part1 * part1 - det * det * det)
-    part3 = pow(part1 + part2, 1./3.)
-    return (-(B + det / part3 + part3) / (2 * A))
-
-
-def point_in_frustrum(camera, near=10, far=20):
-    fov_w, fov_h = camera.get_fov()
-
-    tw = sin(fov_w)*near # top (nearest to camera) width of frustrum
-    th = sin(fov_h)*near # top (nearest to camera) height of frustrum
-    bw = sin(fov_w)*far  # bottom width
-    bh = sin(fov_h)*far  # bottom height
-
-    # calculate random inverse depth: 0 at the 'far' plane and 1 at the 'near' plane
-    inv_depth = random_depth_in_frustrum(tw, th, bw, bh, far-near)
-    depth = far-inv_depth
-
-    nd = depth/(far-near) # normalized depth
-    w = nd*(bw-tw)
-    h = nd*(bh-th)
-
-    # construct points so that we are looking down -Z, +Y is up, +X to right
-    x = (0.5 - random.random())*w
-    y = (0.5 - random.random())*h
-    z = depth
-
-    # orient them along the camera's view direction
-    xform = camera.get_camera_pose()
-    return (np.array([x,y,z,1]) @ xform)[0:3]
-
-
-def Rx(A):
-    return np.array([[1,      0,      0],
-                     [0, cos(A), -sin(A)],
-                     [0, sin(A),  cos(A)]])
-
-def Ry(A):
-    return np.array([[ cos(A), 0, sin(A)],
-                     [      0, 1,      0],
-                     [-sin(A), 0, cos(A)]])
-
-def Rz(A):
-    return np.array([[cos(A), -sin(A), 0],
-                     [sin(A),  cos(A), 0],
-                     [0,            0, 1]])
-
-def ur():
-    return 2.0*random.random() - 1.0
-
-def random_rotation_matrix(max_angle=180):
-    mr = pi*(max_angle/180.0)
-    # Orient the board so a white square (sq #0) in UL corner
-    RY = Ry(-0.5*pi)
-    # add some random rotations
-    return RY @ Rx(mr*ur()) @ Ry(mr*ur()) @ Rz(mr*ur())
-
-
-def rotated_rectangle_extents(w, h, angle):
-    """
-    Given a rectangle of size W x H that has been rotated by 'angle' (in
-    radians), computes the width and height of the largest possible
-    axis-aligned rectangle (maximal area) within the rotated rectangle.
-    """
-    if w <= 0 or h <= 0:
-        return 0,0
-
-    width_is_longer = w >= h
-    side_long, side_short = (w,h) if width_is_longer else (h,w)
-
-    # since the solutions for angle, -angle and 180-angle are all the same, it
-    # suffices to only look at the first quadrant and the absolute values of
-    # sin,cos:
-    sin_a, cos_a = abs(sin(angle)), abs(cos(angle))
-    if side_short <= 2.*sin_a*cos_a*side_long or abs(sin_a-cos_a) < 1e-10:
-        # half constrained case: two crop corners touch the longer side,
-        #   the other two corners are on the mid-line parallel to the longer line
-        x = 0.5*side_short
-        wr,hr = (x/sin_a,x/cos_a) if width_is_longer else (x/cos_a,x/sin_a)
-    else:
-        # fully constrained case: crop touches all 4 sides
-        cos_2a = cos_a*cos_a - sin_a*sin_a
-        wr,hr = (w*cos_a - h*sin_a)/cos_2a, (h*cos_a - w*sin_a)/cos_2a
-
-    return wr,hr
-
-
-def crop_around_center(image, width, height):
-    """
-    Crop 'image' (a PIL image) to 'width' and height' around the images center
-    point
-    """
-    size = image.size
-    center = (int(size[0] * 0.5), int(size[1] * 0.5))
-
-    if(width > size[0]):
-        width = size[0]
-
-    if(height > size[1]):
-        height = size[1]
-
-    x1 = int(center[0] - width * 0.5)
-    x2 = int(center[0] + width * 0.5)
-    y1 = int(center[1] - height * 0.5)
-    y2 = int(center[1] + height * 0.5)
-
-    return image.crop((x1, y1, x2, y2)) # (left, upper, right, lower)
-
-
-def crop_to_rotation(img, angle):
-    # 'img' is a PIL Image of uint8 RGB values
-    # 'angle' is in degrees
-    angle_rad = angle*pi/180.0
-    width, height = img.size
-
-    img = img.rotate(angle)
-    # Crop out black border resulting from rotation
-    wr, hr = rotated_rectangle_extents(width, height, angle_rad)
-    return crop_around_center(img, wr, hr)
-
-
-def scale_to_original_shape(img, o_width, o_height):
-    c_width, c_height = img.size
-    o_ar = o_width/o_height
-    c_ar = c_width/c_height
-    if o_ar > c_ar:
-        cropped = crop_around_center(img, c_width, c_width/o_ar)
-    else:
-        cropped = crop_around_center(img, c_height*o_ar, c_height)
-
-    return cropped.resize((o_width, o_height))
-
-
-def get_cuboid_image_space(mesh, camera):
-    # object aligned bounding box coordinates in world coordinates
-    bbox = mesh.get_bound_box()
-    '''
-    bbox is a list of the world-space coordinates of the corners of a
-    blender object's oriented bounding box
-     https://blender.stackexchange.com/questions/32283/what-are-all-values-in-bound-box
-
-                   TOP
-           3 +-----------------+ 7
-            /                 /|
-           /                 / |
-        2 +-----------------+ 6
-          |     z    y      |  |
-          |      | /        |  |
-          |      |/         |  |
-          |  |   +--- x     |  |
-           0 +-             |  + 4
-          | /               | /
-          |                 |/
-        1 +-----------------+ 5
-                FRONT
-
-    '''
-
-    centroid = np.array([0.,0.,0.])
-    for ii in range(8):
-        centroid += bbox[ii]
-    centroid = centroid / 8
-
-    cam_pose = np.linalg.inv(camera.get_camera_pose()) # 4x4 world to camera transformation matrx.
-    # rvec & tvec describe the world to camera coordinate system
-    tvec = -cam_pose[0:3,3]
-    rvec = -cv2.Rodrigues(cam_pose[0:3,0:3])[0]
-    K = camera.get_intrinsics_as_K_matrix()
-
-    # However these points are in a different order than the original DOPE data format,
-    # so we must reorder them
-    dope_order = [6, 2, 1, 5, 7, 3, 0, 4]
-    cuboid = [None for ii in range(9)]
-    for ii in range(8):
-        cuboid[dope_order[ii]] = cv2.projectPoints(bbox[ii], rvec, tvec, K, np.array([]))[0][0][0]
-    cuboid[8] = cv2.projectPoints(centroid, rvec, tvec, K, np.array([]))[0][0][0]
-
-    return np.array(cuboid, dtype=float).tolist()
-
-
-def write_json(outf, args, camera, objects, objects_data, seg_map):
+from annotation_shards import FRAMES_PER_SHARD, ShardedAnnotationWriter
+from asset_cache import AssetCache
+from async_writer import AsyncWriter
+from background_pipeline import BackgroundPipeline
+from compositing import composite_over, draw_markers
+from cuboid_projection import get_bound_boxes, project_cuboids
+from frame_manifest import FrameManifest, frame_seed
+from frame_profiler import FrameProfiler
+from instance_stats import instance_stats
+from occlusion_controller import (OCCLUSION_STREAM, STATE_NAME, OcclusionController, expected_areas,
+                                  line_of_sight_points, occlusion_ratios, parse_target)
+from placement import FrustumCheck, PlacementSampler, SpatialHash, bounding_radius, move_to_free
+from pose_diversity import COVERAGE_NAME, PoseIndex
+
+
+def write_json(outf, args, camera, objects, objects_data, seg_map, cuboids, writer):
     cam_xform = camera.get_camera_pose()
     eye = -cam_xform[0:3,3]
     at = -cam_xform[0:3,2]
@@ -266,19 +69,26 @@ def write_json(outf, args, camera, objects, objects_data, seg_map):
 
     ## Object data
     ##
+    # visibility, 2D box and truncation of every object from a single histogram pass
+    stats = instance_stats(seg_map, len(objects)+1)
+    if seg_map.shape[0:2] != (args.height, args.width):
+        # low resolution segmentation pass, see --visibility_scale
+        stats = stats.rescaled(seg_map.shape[1], seg_map.shape[0], args.width, args.height)
     for ii, oo in enumerate(objects):
         idx = ii+1 # objects ID indices start at '1'
 
-        num_pixels = int(np.sum((seg_map == idx)))
+        num_pixels = int(stats.counts[idx])
 
         if num_pixels < args.min_pixels:
             continue
-        projected_keypoints = get_cuboid_image_space(oo, camera)
+        projected_keypoints = cuboids[ii].tolist()
 
         data['objects'].append({
             'class': objects_data[ii]['class'],
             'name': objects_data[ii]['name'],
             'visibility': num_pixels,
+            'bounding_box': stats.bounding_box(idx),
+            'truncated': bool(stats.truncated[idx]),
             'projected_cuboid': projected_keypoints,
             ## 'location' and 'quaternion_xyzw' are both optional data fields,
             ## not used for training
@@ -286,44 +96,14 @@ def write_json(outf, args, camera, objects, objects_data, seg_map):
             'quaternion_xyzw': objects_data[ii]['quaternion_xyzw']
         })
 
-    with open(outf, "w") as write_file:
-        json.dump(data, write_file, indent=4)
+    writer.save_json(outf, data, indent=4)
 
     return data
 
 
-def draw_cuboid_markers(objects, camera, im):
-    colors = ['yellow', 'magenta', 'blue', 'red', 'green', 'orange', 'brown', 'cyan', 'white']
-    R = 2 # radius
-    # draw dots on image to label the cuiboid vertices
-    draw = ImageDraw.Draw(im)
-    for oo in objects:
-        projected_keypoints = get_cuboid_image_space(oo, camera)
-        for idx, pp in enumerate(projected_keypoints):
-            x = int(pp[0])
-            y = int(pp[1])
-            draw.ellipse((x-R, y-R, x+R, y+R), fill=colors[idx])
-
-    return im
-
-
-def randomize_background(path, width, height):
-    img = Image.open(path)
-
-    # Randomly rotate
-    angle = 45.0 - random.random()*90.0
-    img = crop_to_rotation(img, angle)
-    img = scale_to_original_shape(img, width, height)
-
-    # Randomly flip in horizontal and vertical directions
-    if random.random() > 0.5:
-        # flip horizontal
-        img = img.transpose(Image.FLIP_LEFT_RIGHT)
-    if random.random() > 0.5:
-        # flip vertical
-        img = img.transpose(Image.FLIP_TOP_BOTTOM)
-
-    return img
+def draw_cuboid_markers(cuboids, im):
+    # draw dots on the image array to label the cuboid vertices
+    return draw_markers(im, cuboids, radius=2)
 
 
 def set_world_background_hdr(filename, strength=1.0, rotation_euler=None):
@@ -371,6 +151,27 @@ def main(args):
     out_directory = os.path.join(args.outf, str(args.run_id))
     os.makedirs(out_directory, exist_ok=True)
 
+    # Frame manifest, used to resume an interrupted run
+    try:
+        manifest = FrameManifest.open(out_directory, args.seed, args.resume, args.overwrite)
+    except FileExistsError as e:
+        print(e)
+        exit(1)
+
+    # PNG encoding and JSON dumps overlap the rendering of the next frame
+    writer = AsyncWriter(workers=args.writer_workers, max_pending=args.writer_queue,
+                         compress_level=args.png_compression,
+                         use_processes=args.writer_processes)
+
+    # Optional compact copy of the annotations for the training loader
+    shard_writer = None
+    if args.annotation_shards:
+        shard_writer = ShardedAnnotationWriter(args.annotation_shards, args.frames_per_shard)
+
+    # Seed the random generators so a run (or a shard of a run) can be reproduced
+    random.seed(manifest.seed)
+    np.random.seed(manifest.seed)
+
     # Construct list of background images
     image_types = ('*.jpg', '*.jpeg', '*.JPG', '*.JPEG', '*.png', '*.PNG', '*.hdr', '*.HDR')
     backdrop_images = []
@@ -435,15 +236,29 @@ def main(args):
 
     # Renderer setup
     bp.renderer.set_output_format('PNG')
+    if args.visibility_scale < 1.0:
+        segmap_resolution = (max(1, round(args.width*args.visibility_scale)),
+                             max(1, round(args.height*args.visibility_scale)))
+    else:
+        # the segmentation comes with the color image instead of a second render
+        bp.renderer.enable_segmentation_output(map_by=["category_id"],
+                                               default_values={"category_id": 0})
+    if args.depth:
+        bp.renderer.enable_depth_output(activate_antialiasing=False)
     bp.renderer.set_render_devices(desired_gpu_ids=[0])
+    if args.cpu_threads > 0:
+        bp.renderer.set_cpu_threads(args.cpu_threads)
+
 
+    # Models drawn several times are loaded once and instanced as linked duplicates
+    assets = AssetCache(use_blend_cache=not args.no_mesh_cache)
 
     # Create objects
     objects = []
     objects_data = []
     for idx in range(args.nb_objects):
         model_path =  object_models[random.randint(0, len(object_models) - 1)]
-        obj = bp.loader.load_obj(model_path)[0]
+        obj = assets.load(model_path)
         obj.set_cp("category_id", 1+idx)
         objects.append(obj)
         obj_class = args.object_class
@@ -461,92 +276,248 @@ def main(args):
     if len(distractor_objs) > 0:
         for idx_obj in range(int(args.nb_distractors)):
             distractor_fn = distractor_objs[random.randint(0,len(distractor_objs)-1)]
-            distractor = bp.loader.load_obj(distractor_fn)[0]
+            distractor = assets.load(distractor_fn)
             distractor.set_cp("category_id", SEG_DISTRACT)
             distractors.append(distractor)
             print(f"loaded {distractor_fn}")
 
-    for frame in range(args.nb_frames):
+    # Per-frame stage timings
+    profiler = FrameProfiler(args.profile, args.profile_report_every, args.cprofile_every)
+
+    complete = [frame for frame in range(args.nb_frames) if args.resume and manifest.is_complete(frame)]
+    frames = sorted(set(range(args.nb_frames)) - set(complete))
+    if shard_writer is not None:
+        # finished frames whose annotations were lost with the buffer of an interrupted run
+        shard_writer.append_missing({str(frame).zfill(6): os.path.join(out_directory, str(frame).zfill(6) + ".json")
+                                     for frame in complete})
+
+    # Backgrounds are decoded once and prepared ahead of the render loop
+    background_pipeline = None
+    if len(backdrop_images) > 0:
+        background_pipeline = BackgroundPipeline(backdrop_images, args.width, args.height,
+                                                 manifest.seed,
+                                                 cache_size=args.background_cache_size,
+                                                 workers=args.background_workers,
+                                                 prefetch=args.background_prefetch)
+
+    # Poses of every frame, drawn up front; objects and distractors are kept from overlapping
+    # by their bounding spheres. Every frame has its own generator, so resumed runs match.
+    object_boxes = [oo.get_bound_box(local_coords=True) for oo in objects]
+    # Draws where no target can cover --min_pixels once projected are resampled before rendering
+    frustum_check = FrustumCheck(object_boxes, args.scale, bp.camera.get_camera_pose(),
+                                 bp.camera.get_intrinsics_as_K_matrix(), args.width, args.height,
+                                 min_pixels=args.min_pixels, near=1.0)
+    sampler = PlacementSampler([bounding_radius(box, args.scale) for box in object_boxes],
+                               [bounding_radius(dd.get_bound_box(local_coords=True), args.distractor_scale)
+                                for dd in distractors],
+                               bp.camera.get_fov(), bp.camera.get_camera_pose(),
+                               object_near=20.0, object_far=100.0,
+                               distractor_near=5.0, distractor_far=100.0,
+                               max_attempts=args.placement_attempts,
+                               frustum_check=frustum_check, max_resamples=args.frustum_resamples)
+    # Near duplicates of earlier frames (same background, close object poses) are redrawn.
+    # The table covers every frame of the run, so a resumed run makes the same choices.
+    diversity = None
+    if args.diversity_threshold > 0:
+        diversity = PoseIndex(bp.camera.get_camera_pose(), args.diversity_threshold,
+                              location_scale=args.diversity_location_scale,
+                              max_resamples=args.diversity_resamples)
+    backgrounds = None
+    if background_pipeline is not None:
+        backgrounds = lambda frame: background_pipeline.plan(frame)['path']
+    pose_table = sampler.pose_table(range(args.nb_frames), manifest.seed, diversity, backgrounds)
+    if sampler.nb_overlaps > 0:
+        print(f"{sampler.nb_overlaps} objects could not be placed without overlap "
+              f"in {args.placement_attempts} attempts")
+    print(sampler.report())
+    if diversity is not None:
+        print(diversity.report())
+        diversity.save(os.path.join(out_directory, COVERAGE_NAME))
+    if background_pipeline is not None:
+        # rejected frames are never rendered, so their backgrounds are not prefetched
+        background_pipeline.schedule([frame for frame in frames if pose_table['accepted'][frame]])
+
+    # Distractors steered toward a target histogram of occlusion ratios
+    controller = None
+    controller_path = os.path.join(out_directory, STATE_NAME)
+    if args.occlusion_target:
+        if len(distractors) == 0:
+            print("--occlusion_target needs distractors to occlude the objects")
+        edges, weights = parse_target(args.occlusion_target)
+        if args.resume:
+            controller = OcclusionController.load(controller_path, edges, weights,
+                                                  exploration=args.occlusion_exploration)
+        else:
+            controller = OcclusionController(edges, weights, exploration=args.occlusion_exploration)
+
+    for frame in profiler.frames(frames):
+        # Every frame has its own random state so it can be regenerated on its own
+        manifest.seed_frame(frame)
+
+        if not pose_table['accepted'][frame]:
+            # no target would be visible, or the frame nearly duplicates an earlier one: skip the
+            # render, the frame stays a gap in the numbering
+            manifest.record(frame, [], status='rejected')
+            profiler.skip()
+            continue
+
         # Randomize light
         #light.set_location([10-random.random()*20, 10-random.random()*20,
         #                    150+random.random()*100])
 
-        # Place object(s)
-        for idx, oo in enumerate(objects):
-            # Set a random pose
-            xform = np.eye(4)
-            xform[0:3,3] = random_object_position(near=20, far=100)
-            xform[0:3,0:3] = random_rotation_matrix()
-            oo.set_local2world_mat(xform)
-
-            # 'location' and 'quaternion_xyzw' describe the position and orientation of the
-            # object in the camera coordinate system
-            xform_in_cam = np.linalg.inv(bp.camera.get_camera_pose()) @ xform
-            objects_data[idx]['location'] = xform_in_cam[0:3,3].tolist()
-            tmp_wxyz = Quaternion(matrix=xform_in_cam[0:3,0:3]).elements  # [scalar, x, y, z]
-            q_xyzw = [tmp_wxyz[1], tmp_wxyz[2], tmp_wxyz[3], tmp_wxyz[0]] # [x, y, z, scalar]
-            objects_data[idx]['quaternion_xyzw'] = q_xyzw
-
-            # Scale 3D model to cm
-            oo.set_scale([args.scale, args.scale, args.scale])
-
-        # Place distractors
-        for dd in distractors:
-            xform = np.eye(4)
-            xform[0:3,3] = point_in_frustrum(bp.camera, near=5.0, far=100.)
-            xform[0:3,0:3] = random_rotation_matrix()
-            dd.set_local2world_mat(xform)
-            dd.set_scale([args.distractor_scale, args.distractor_scale, args.distractor_scale])
+        with profiler.stage('placement'):
+            object_positions = pose_table['object_positions'][frame]
+            object_rotations = pose_table['object_rotations'][frame]
+            # Place object(s)
+            for idx, oo in enumerate(objects):
+                # Set the pose drawn for this frame
+                xform = np.eye(4)
+                xform[0:3,3] = object_positions[idx]
+                xform[0:3,0:3] = object_rotations[idx]
+                oo.set_local2world_mat(xform)
+
+                # 'location' and 'quaternion_xyzw' describe the position and orientation of the
+                # object in the camera coordinate system
+                xform_in_cam = np.linalg.inv(bp.camera.get_camera_pose()) @ xform
+                objects_data[idx]['location'] = xform_in_cam[0:3,3].tolist()
+                tmp_wxyz = Quaternion(matrix=xform_in_cam[0:3,0:3]).elements  # [scalar, x, y, z]
+                q_xyzw = [tmp_wxyz[1], tmp_wxyz[2], tmp_wxyz[3], tmp_wxyz[0]] # [x, y, z, scalar]
+                objects_data[idx]['quaternion_xyzw'] = q_xyzw
+
+                # Scale 3D model to cm
+                oo.set_scale([args.scale, args.scale, args.scale])
+
+            # Place distractors
+            distractor_positions = pose_table['distractor_positions'][frame]
+            distractor_scales = np.full(len(distractors), args.distractor_scale)
+            if controller is not None:
+                # the occlusion level sets how many distractors are shown, their size and
+                # how many of them stand between the camera and the objects
+                rng = np.random.default_rng(frame_seed(manifest.seed, frame, OCCLUSION_STREAM))
+                level_index = controller.choose(rng)
+                level = controller.level(level_index)
+                shown = np.arange(len(distractors)) < round(level*len(distractors))
+                in_sight = shown & (rng.uniform(size=len(distractors)) < level)
+                distractor_scales *= 0.5 + level
+                # distractors moved into the line of sight must not overlap the objects or the
+                # other shown distractors; those without a free candidate keep their place
+                radii = sampler.distractor_radii * (0.5 + level)
+                placed = SpatialHash(sampler.cell_size * (0.5 + level))
+                for position, radius in zip(object_positions, sampler.object_radii):
+                    placed.add(position, radius)
+                for idx in np.flatnonzero(shown & ~in_sight):
+                    placed.add(distractor_positions[idx], radii[idx])
+                candidates = line_of_sight_points(cam_pose[0:3,3], object_positions,
+                                                  len(distractors) * args.placement_attempts, rng)
+                distractor_positions, _ = move_to_free(
+                    placed, distractor_positions, radii,
+                    candidates.reshape(len(distractors), args.placement_attempts, 3), in_sight)
+                for idx, dd in enumerate(distractors):
+                    dd.blender_obj.hide_render = not shown[idx]
+            for idx, dd in enumerate(distractors):
+                xform = np.eye(4)
+                xform[0:3,3] = distractor_positions[idx]
+                xform[0:3,0:3] = pose_table['distractor_rotations'][frame][idx]
+                dd.set_local2world_mat(xform)
+                dd.set_scale([distractor_scales[idx]]*3)
 
         # Render the scene
-        background_path = None
-        if args.backgrounds_folder:
-            background_path = backdrop_images[random.randint(0, len(backdrop_images) - 1)]
-            if os.path.splitext(background_path)[1].lower() == ".hdr":
-                strength = random.random()+0.5
-                rotation = [random.random()*0.2-0.1, random.random()*0.2-0.1,
-                            random.random()*0.2-0.1]
-                set_world_background_hdr(background_path, strength, rotation)
-            else:
-                bp.renderer.set_output_format(enable_transparency=True)
-
-        # redirect blenderproc output to log file
-        logfile = '/tmp/blender_render.log'
-        open(logfile, 'a').close()
-        old = os.dup(sys.stdout.fileno())
-        sys.stdout.flush()
-        os.close(sys.stdout.fileno())
-        fd = os.open(logfile, os.O_WRONLY)
-
-        segs = bp.renderer.render_segmap()
-        data = bp.renderer.render()
-
-        # disable output redirection
-        os.close(fd)
-        os.dup(old)
-        os.close(old)
-
-        im = Image.fromarray(data['colors'][0])
-
-        if args.backgrounds_folder:
-            if os.path.splitext(background_path)[1].lower() != ".hdr":
-                # We have an ordinary image. We randomize its rotation and crop
-                # and paste it in as a background
-                background = randomize_background(background_path, args.width, args.height)
-                background = background.convert('RGB') # some images may be B&W
-                # Pasting the current image on the selected background
-                background.paste(im, mask=im.convert('RGBA'))
-                im = background
+        background_plan = None
+        if background_pipeline is not None:
+            with profiler.stage('background_setup'):
+                background_plan = background_pipeline.plan(frame)
+                if background_plan['hdr']:
+                    set_world_background_hdr(background_plan['path'], background_plan['strength'],
+                                             background_plan['rotation'])
+                else:
+                    bp.renderer.set_output_format(enable_transparency=True)
+
+        with profiler.stage('redirect'):
+            # redirect blenderproc output to log file
+            logfile = '/tmp/blender_render.log'
+            open(logfile, 'a').close()
+            old = os.dup(sys.stdout.fileno())
+            sys.stdout.flush()
+            os.close(sys.stdout.fileno())
+            fd = os.open(logfile, os.O_WRONLY)
+
+        # color, segmentation and depth all come out of a single render
+        with profiler.stage('render'):
+            data = bp.renderer.render()
+
+        if args.visibility_scale < 1.0:
+            # visibility from a cheap low resolution segmentation pass instead
+            with profiler.stage('render_segmap'):
+                bp.camera.set_resolution(*segmap_resolution)
+                seg_map = bp.renderer.render_segmap()['class_segmaps'][0]
+                bp.camera.set_resolution(args.width, args.height)
+        else:
+            seg_map = data['category_id_segmaps'][0]
 
-        if args.debug:
-            im = draw_cuboid_markers(objects, bp.camera, im)
+        with profiler.stage('redirect'):
+            # disable output redirection
+            os.close(fd)
+            os.dup(old)
+            os.close(old)
+
+        im = data['colors'][0]
 
-        filename = os.path.join(out_directory, str(frame).zfill(6) + ".png")
-        im.save(filename)
+        if background_plan is not None and not background_plan['hdr']:
+            # We have an ordinary image, already rotated, cropped and scaled by the
+            # background pipeline. We blend the render over it in place
+            with profiler.stage('compositing'):
+                im = composite_over(im, background_pipeline.get(frame))
 
-        ## Export JSON file
-        filename = os.path.join(out_directory, str(frame).zfill(6) + ".json")
-        write_json(filename, args, bp.camera, objects, objects_data, segs['class_segmaps'][0])
+        with profiler.stage('projection'):
+            # Project the cuboids of all objects once for the JSON data and the debug overlay
+            cuboids = project_cuboids(objects, bp.camera)
+
+        if args.debug:
+            im = draw_cuboid_markers(cuboids, im)
+
+        with profiler.stage('save_image'):
+            image_filename = os.path.join(out_directory, str(frame).zfill(6) + ".png")
+            writer.save_image(image_filename, im)
+
+            frame_files = [image_filename]
+            if args.depth:
+                depth_filename = os.path.join(out_directory, str(frame).zfill(6) + ".depth.npy")
+                writer.save_array(depth_filename, data['depth'][0])
+                frame_files.append(depth_filename)
+
+        with profiler.stage('write_json'):
+            ## Export JSON file
+            json_filename = os.path.join(out_directory, str(frame).zfill(6) + ".json")
+            data = write_json(json_filename, args, bp.camera, objects, objects_data,
+                              seg_map, cuboids, writer)
+            if shard_writer is not None:
+                shard_writer.append(str(frame).zfill(6), data)
+            frame_files.append(json_filename)
+
+        # Feed the occlusion ratios of the frame back to the controller
+        if controller is not None:
+            with profiler.stage('occlusion_control'):
+                visible = {oo['name']: oo['visibility'] for oo in data['objects']}
+                areas = expected_areas(get_bound_boxes(objects), bp.camera.get_camera_pose(),
+                                       bp.camera.get_intrinsics_as_K_matrix(), args.width, args.height)
+                ratios = occlusion_ratios([visible.get(oo['name'], 0) for oo in objects_data], areas,
+                                          min_area=max(100, args.min_pixels))
+                controller.update(level_index, ratios)
+                if controller.nb_frames % args.occlusion_save_every == 0:
+                    controller.save(controller_path, writer)
+
+        # the frame is recorded once its files are on disk
+        writer.after_pending(lambda frame=frame, files=frame_files: manifest.record(frame, files))
+
+    if controller is not None:
+        controller.save(controller_path, writer)
+        print(controller.report())
+    if background_pipeline is not None:
+        background_pipeline.close()
+    writer.close()
+    if shard_writer is not None:
+        shard_writer.close()
+    profiler.close()
 
 
 if __name__ == "__main__":
@@ -619,6 +590,24 @@ if __name__ == "__main__":
         default=None,
         help = "folder containing background images. Images can .jpeg, .png, or .hdr."
    )
+    parser.add_argument(
+        '--background_cache_size',
+        default=64,
+        type=int,
+        help="how many decoded background images to keep in memory"
+    )
+    parser.add_argument(
+        '--background_workers',
+        default=2,
+        type=int,
+        help="threads preparing the backgrounds of the next frames"
+    )
+    parser.add_argument(
+        '--background_prefetch',
+        default=4,
+        type=int,
+        help="how many frames ahead backgrounds are prepared"
+    )
     parser.add_argument(
         '--nb_objects',
         default=1,
@@ -637,6 +626,40 @@ if __name__ == "__main__":
         help='Scaling to apply to distractor objects in order to put in units of centimeters; '
              'e.g if the object scale is meters -> scale=100; if it is in cm -> scale=1'
     )
+    parser.add_argument(
+        '--placement_attempts',
+        default=32,
+        type=int,
+        help='Candidate positions drawn for every object and distractor before accepting one '
+             'that overlaps the objects already placed'
+    )
+    parser.add_argument(
+        '--frustum_resamples',
+        default=10,
+        type=int,
+        help='How many times the targets of a frame are redrawn when none of their projected '
+             'bounding boxes covers --min_pixels; frames that still fail are not rendered'
+    )
+    parser.add_argument(
+        '--diversity_threshold',
+        default=0.0,
+        type=float,
+        help='Redraw the poses of frames closer than this to an earlier frame with the same '
+             'background (RMS per object of the camera-frame location / --diversity_location_scale '
+             'and quaternion distances); 0 keeps every frame'
+    )
+    parser.add_argument(
+        '--diversity_location_scale',
+        default=10.0,
+        type=float,
+        help='Camera-frame distance that weighs as much as a unit of quaternion distance'
+    )
+    parser.add_argument(
+        '--diversity_resamples',
+        default=10,
+        type=int,
+        help='How many times a near duplicate frame is redrawn before it is skipped'
+    )
     parser.add_argument(
         '--nb_frames',
         type = int,
@@ -654,6 +677,121 @@ if __name__ == "__main__":
         default='output_example/',
         help = "output filename inside output/"
     )
+    parser.add_argument(
+        '--occlusion_target',
+        default=None,
+        help="Steer the distractors toward this histogram of occlusion ratios of the objects: "
+             "'low:high:bins' (e.g. 0:0.8:8) or comma separated bin weights over [0, 1]"
+    )
+    parser.add_argument(
+        '--occlusion_exploration',
+        default=0.1,
+        type=float,
+        help='Share of the frames that try a random occlusion level'
+    )
+    parser.add_argument(
+        '--occlusion_save_every',
+        default=50,
+        type=int,
+        help='Save the state of the occlusion controller every N frames, for --resume'
+    )
+    parser.add_argument(
+        '--seed',
+        default=None,
+        type=int,
+        help='Seed of the random generators. Set per run by the run script so that each run '
+        'is reproducible'
+    )
+    parser.add_argument(
+        '--resume',
+        action='store_true',
+        default=False,
+        help='Continue an interrupted run in the same output directory: frames recorded as '
+        'complete in its manifest are skipped, missing or corrupt ones are regenerated'
+    )
+    parser.add_argument(
+        '--overwrite',
+        action='store_true',
+        default=False,
+        help='Start over in an output directory that already holds generated frames'
+    )
+    parser.add_argument(
+        '--annotation_shards',
+        default=None,
+        help='Also append the annotations to sharded NumPy arrays in this directory (see '
+        'annotation_shards.py); use one directory per run'
+    )
+    parser.add_argument(
+        '--frames_per_shard',
+        default=FRAMES_PER_SHARD,
+        type=int,
+        help='How many frames each annotation shard holds'
+    )
+    parser.add_argument(
+        '--no_mesh_cache',
+        action='store_true',
+        help='Always parse the OBJ files instead of using (and writing) the .cache.blend files next to them'
+    )
+    parser.add_argument(
+        '--depth',
+        action='store_true',
+        help='Also save the depth of every frame (in scene units) as a .depth.npy file'
+    )
+    parser.add_argument(
+        '--visibility_scale',
+        default=1.0,
+        type=float,
+        help='Count the visible pixels on a segmentation pass this many times smaller than the '
+             'image (e.g. 0.25) instead of full resolution masks; 1 uses the masks of the render'
+    )
+    parser.add_argument(
+        '--profile',
+        default=None,
+        help='Write the time spent in every stage of every frame to this .jsonl or .csv file'
+    )
+    parser.add_argument(
+        '--profile_report_every',
+        default=50,
+        type=int,
+        help='Print the rolling frames per second every N frames, 0 disables it'
+    )
+    parser.add_argument(
+        '--cprofile_every',
+        default=0,
+        type=int,
+        help='Run every Nth frame under cProfile and dump its statistics; 0 disables it'
+    )
+    parser.add_argument(
+        '--png_compression',
+        default=6,
+        type=int,
+        help='PNG compression level, from 0 (fastest) to 9 (smallest files)'
+    )
+    parser.add_argument(
+        '--writer_workers',
+        default=2,
+        type=int,
+        help='Threads (or processes) writing images and JSON files in the background; 0 writes '
+        'them synchronously'
+    )
+    parser.add_argument(
+        '--writer_queue',
+        default=8,
+        type=int,
+        help='How many files may wait to be written before the render loop blocks'
+    )
+    parser.add_argument(
+        '--writer_processes',
+        action='store_true',
+        default=False,
+        help='Encode the output files in processes instead of threads'
+    )
+    parser.add_argument(
+        '--cpu_threads',
+        default=0,
+        type=int,
+        help='Number of render threads; 0 lets blender decide'
+    )
     parser.add_argument(
         '--debug',
         action='store_true',
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+
+"""
+Library of baked occluder drops.
+
+bake_drops.py simulates occluders falling on the scene once and saves the
+settled poses of every drop as drop_<n>.npz. The drops are packed into a
+single library that the render loop samples from. Applying a drop only sets
+the pose of the pooled occluders, so the occlusions are physically plausible
+without any per-frame physics. Like in annotation_shards.py, the occluders of
+drop i are
+
+    occluders of drop i = offsets[i] : offsets[i+1]
+
+Baking runs in parallel through the usual launcher, followed by packing:
+
+    python run_blenderproc_datagen.py --script bake_drops.py --nb_workers 8 \
+        --nb_frames 2000 --outf drops/ -- --scene scene11.blend
+    python drop_library.py pack drops/ drops.npz
+
+'python drop_library.py selftest' checks that baked drops survive the merge
+of run_blenderproc_datagen.py and are packed.
+"""
+
+import argparse
+import glob
+import os
+import sys
+import tempfile
+from types import SimpleNamespace
+
+import numpy as np
+
+
+SHAPES = ['CUBE', 'SPHERE']
+DROP_PATTERN = 'drop_*.npz'
+
+
+def save_drop(path, shapes, locations, rotations, scales):
+    """Save the settled occluders of one drop (shape names and (n, 3) poses)."""
+    np.savez(path,
+             shapes=np.array([SHAPES.index(ss) for ss in shapes], dtype=np.int8),
+             locations=np.asarray(locations, dtype=np.float32).reshape(-1, 3),
+             rotations=np.asarray(rotations, dtype=np.float32).reshape(-1, 3),
+             scales=np.asarray(scales, dtype=np.float32).reshape(-1, 3))
+
+
+def pack(drops_directory, library_path):
+    """Pack the drop_*.npz files of a directory into one library; returns the number of drops."""
+    paths = sorted(glob.glob(os.path.join(drops_directory, DROP_PATTERN)))
+    fields = {'shapes': [np.zeros(0, dtype=np.int8)],
+              'locations': [np.zeros((0, 3), dtype=np.float32)],
+              'rotations': [np.zeros((0, 3), dtype=np.float32)],
+              'scales': [np.zeros((0, 3), dtype=np.float32)]}
+    offsets = [0]
+    for path in paths:
+        with np.load(path) as drop:
+            for name, values in fields.items():
+                values.append(drop[name])
+            offsets.append(offsets[-1] + len(drop['shapes']))
+
+    np.savez(library_path, offsets=np.array(offsets, dtype=np.int64),
+             **{name: np.concatenate(values) for name, values in fields.items()})
+    return len(paths)
+
+
+class DropLibrary:
+
+    def __init__(self, path):
+        with np.load(path) as library:
+            self.offsets = library['offsets']
+            self.shapes = library['shapes']
+            self.locations = library['locations']
+            self.rotations = library['rotations']
+            self.scales = library['scales']
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def drop(self, index):
+        """(shape names, locations, euler rotations, scales) of the occluders of one drop."""
+        start, end = self.offsets[index], self.offsets[index+1]
+        return ([SHAPES[ss] for ss in self.shapes[start:end]], self.locations[start:end],
+                self.rotations[start:end], self.scales[start:end])
+
+    def sample(self, rng=np.random):
+        return self.drop(rng.randint(len(self)))
+
+
+def selftest():
+    """Merge fake baked shards like run_blenderproc_datagen.py does, then pack them; True if they all survive."""
+    from run_blenderproc_datagen import merge_shards
+
+    passed = True
+
+    def check(name, ok):
+        nonlocal passed
+        passed &= ok
+        print(f"{'ok  ' if ok else 'FAIL'} {name}")
+
+    with tempfile.TemporaryDirectory() as directory:
+        args = SimpleNamespace(outf=directory, shards_dir=os.path.join(directory, 'shards'))
+        for run_id in range(2):
+            shard = os.path.join(args.shards_dir, str(run_id))
+            os.makedirs(shard)
+            for drop in range(3):
+                save_drop(os.path.join(shard, f"drop_{drop:06d}.npz"), ['CUBE', 'SPHERE'],
+                          np.full((2, 3), run_id), np.zeros((2, 3)), np.ones((2, 3)))
+            open(os.path.join(shard, 'manifest.jsonl'), 'w').close()
+
+        nb_merged, left = merge_shards(args, range(2))
+        check("every baked drop is merged", nb_merged == 6 and not left)
+        check("merged drops are numbered contiguously",
+              sorted(os.listdir(directory)) == [f"drop_{ii:06d}.npz" for ii in range(6)] + ['shards'])
+        library_path = os.path.join(directory, 'drops.npz')
+        check("every merged drop is packed", pack(directory, library_path) == 6)
+        library = DropLibrary(library_path)
+        check("packed drops keep their occluders",
+              len(library) == 6 and all(len(library.drop(ii)[0]) == 2 for ii in range(6)))
+
+        # a second merge into the same directory continues the numbering
+        shard = os.path.join(args.shards_dir, '0')
+        save_drop(os.path.join(shard, 'drop_000000.npz'), ['CUBE'], np.zeros((1, 3)), np.zeros((1, 3)),
+                  np.ones((1, 3)))
+        nb_merged, left = merge_shards(args, [0])
+        check("a later merge keeps the earlier drops",
+              nb_merged == 1 and os.path.exists(os.path.join(directory, 'drop_000006.npz')))
+    return passed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    pack_parser = subparsers.add_parser('pack', help="pack baked drops into a single library")
+    pack_parser.add_argument('drops_directory', help="directory of the drop_*.npz files of bake_drops.py")
+    pack_parser.add_argument('library', help="library file to write, e.g. drops.npz")
+
+    subparsers.add_parser('selftest', help="check that baked drops survive the merge of the driver")
+
+    opt = parser.parse_args()
+    if opt.command == 'selftest':
+        sys.exit(0 if selftest() else 1)
+    nb = pack(opt.drops_directory, opt.library)
+    print(f"{nb} drops packed into '{opt.library}'")
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+
+"""
+Append-only manifest of the frames written by a generator run.
+
+Every finished frame appends one JSON line with its index, seed, status and
+the sha256 of its output files to <output dir>/manifest.jsonl. Each frame
+draws its random numbers from a seed derived from the run seed and the frame
+index, so a run restarted with --resume can skip the frames that are already
+complete and regenerate only the missing or corrupt ones with the same random
+state they would have had originally.
+"""
+
+import hashlib
+import json
+import os
+import random
+import threading
+
+import numpy as np
+
+
+MANIFEST_NAME = 'manifest.jsonl'
+# suffixes of the files the generators write for a frame (.npz: drops of bake_drops.py)
+FRAME_SUFFIXES = ('.png', '.jpg', '.jpeg', '.json', '.depth.npy', '.npz')
+
+
+def frame_seed(seed, frame, stream=0):
+    """
+    Seed of one frame, derived from the seed of the run. Other values of
+    'stream' give independent seeds for the same frame, for generators that
+    must not share the global random state (e.g. worker threads).
+    """
+    entropy = [seed, frame] if stream == 0 else [seed, frame, stream]
+    return int(np.random.SeedSequence(entropy).generate_state(1)[0])
+
+
+def seed_frame(seed, frame):
+    """Reseed python's and numpy's global generators for one frame."""
+    fseed = frame_seed(seed, frame)
+    random.seed(fseed)
+    np.random.seed(fseed)
+    return fseed
+
+
+def has_frames(directory):
+    """True if 'directory' holds frame files, e.g. of a run from before the manifests."""
+    return any(name.endswith(FRAME_SUFFIXES) and any(cc.isdigit() for cc in name)
+               for name in os.listdir(directory))
+
+
+def file_hash(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+class FrameManifest:
+    """
+    Use open() to create one: it reads back an existing manifest when
+    resuming, starts a new one otherwise, and refuses to silently overwrite
+    the frames of a previous run, with or without a manifest.
+    """
+
+    def __init__(self, path, seed, records):
+        self.path = path
+        self.seed = seed
+        self.records = records # frame index -> last record of that frame
+        self._lock = threading.Lock() # frames may be recorded from writer threads
+
+    @classmethod
+    def open(cls, out_directory, seed=None, resume=False, overwrite=False):
+        path = os.path.join(out_directory, MANIFEST_NAME)
+        records = {}
+        run_seed = None
+        if os.path.exists(path):
+            if not (resume or overwrite):
+                raise FileExistsError(f"'{out_directory}' already holds generated frames; "
+                                      "use --resume to continue or --overwrite to start over")
+            if resume:
+                with open(path) as f:
+                    for line in f:
+                        try:
+                            record = json.loads(line)
+                        except ValueError:
+                            # last line of a run that died while writing it
+                            continue
+                        if 'frame' in record:
+                            records[record['frame']] = record
+                        elif 'seed' in record:
+                            run_seed = record['seed']
+            else:
+                os.remove(path)
+        elif not overwrite and has_frames(out_directory):
+            # frames without a manifest cannot be checked, so they cannot be resumed either
+            raise FileExistsError(f"'{out_directory}' already holds frames of a run without a manifest; "
+                                  "use --overwrite to start over")
+
+        new_run = run_seed is None
+        if new_run:
+            run_seed = seed if seed is not None else random.SystemRandom().randrange(2**32)
+        elif seed is not None and seed != run_seed:
+            print(f"Resuming with the seed of the original run ({run_seed}) instead of {seed}")
+
+        manifest = cls(path, run_seed, records)
+        if new_run:
+            manifest._append({'seed': run_seed})
+        return manifest
+
+    def frame_seed(self, frame):
+        return frame_seed(self.seed, frame)
+
+    def seed_frame(self, frame):
+        return seed_frame(self.seed, frame)
+
+    def is_complete(self, frame, check_hashes=True):
+        """True if the frame was finished and all its files are still intact."""
+        record = self.records.get(frame)
+        if record is None or record['status'] != 'done':
+            return False
+        directory = os.path.dirname(self.path)
+        for name, digest in record['files'].items():
+            path = os.path.join(directory, name)
+            if not os.path.exists(path):
+                return False
+            if check_hashes and file_hash(path) != digest:
+                return False
+        return True
+
+    def record(self, frame, paths, status='done'):
+        """Append the record of a finished frame; paths are its output files."""
+        record = {'frame': frame,
+                  'seed': self.frame_seed(frame),
+                  'status': status,
+                  'files': {os.path.basename(pp): file_hash(pp) for pp in paths}}
+        with self._lock:
+            self._append(record)
+            self.records[frame] = record
+        return record
+
+    def _append(self, record):
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+
+"""
+Lightweight per-frame timing of the generators.
+
+Iterate over the frames with profiler.frames(indices) (or wrap every frame
+in profiler.frame(index)) and wrap its stages in profiler.stage(name). Each
+frame produces one timing record, written as a JSON line (.jsonl) or as
+'frame,stage,seconds' rows (.csv) depending on the extension of the output
+file. A rolling frames-per-second report is printed every 'report_every'
+frames, with or without an output file, and every 'cprofile_every' frames the
+whole frame runs under cProfile and the statistics are dumped to
+'cprofile_directory'. Frames the generator skips without rendering call
+profiler.skip(); they are counted but not timed, so they do not inflate the
+frame rate. Without an output file the profiler only costs a few
+perf_counter() calls.
+"""
+
+from collections import deque
+from contextlib import contextmanager
+import cProfile
+import csv
+import json
+import os
+import time
+
+
+class FrameProfiler:
+
+    def __init__(self, out_path=None, report_every=50, cprofile_every=0,
+                 cprofile_directory=None, window=50):
+        self.out_path = out_path
+        self.report_every = report_every
+        self.cprofile_every = cprofile_every
+        self.cprofile_directory = cprofile_directory
+        if cprofile_every and cprofile_directory is None:
+            base = os.path.dirname(out_path) if out_path else '.'
+            self.cprofile_directory = os.path.join(base, 'cprofile')
+        if cprofile_every:
+            os.makedirs(self.cprofile_directory, exist_ok=True)
+
+        self._file = None
+        self._csv = None
+        if out_path:
+            os.makedirs(os.path.dirname(out_path) or '.', exist_ok=True)
+            self._file = open(out_path, 'a', newline='')
+            if out_path.endswith('.csv'):
+                self._csv = csv.writer(self._file)
+                if self._file.tell() == 0:
+                    self._csv.writerow(['frame', 'stage', 'seconds'])
+
+        self._stages = None
+        self._skipped = False
+        self._durations = deque(maxlen=window)
+        self._totals = {}
+        self._nb_frames = 0
+        self._nb_skipped = 0
+
+    @contextmanager
+    def frame(self, index):
+        self._stages = {}
+        self._skipped = False
+        profile = None
+        if self.cprofile_every and index % self.cprofile_every == 0:
+            profile = cProfile.Profile()
+            profile.enable()
+        start = time.perf_counter()
+        try:
+            yield self
+        finally:
+            duration = time.perf_counter() - start
+            if profile is not None:
+                profile.disable()
+                profile.dump_stats(os.path.join(self.cprofile_directory,
+                                                f"frame_{index:06d}.prof"))
+            self._finish(index, duration)
+
+    def frames(self, indices):
+        """Yield the frame indices, timing the loop body of each as one frame."""
+        for index in indices:
+            with self.frame(index):
+                yield index
+
+    def skip(self):
+        """Mark the current frame as skipped: it is counted but its time is not recorded."""
+        self._skipped = True
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if self._stages is not None:
+                self._stages[name] = self._stages.get(name, 0.0) + time.perf_counter() - start
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self.out_path and self._nb_frames:
+            print(self.summary())
+
+    def summary(self):
+        skipped = f" ({self._nb_skipped} skipped frames not timed)" if self._nb_skipped else ""
+        lines = [f"{self._nb_frames} frames profiled{skipped}, mean seconds per frame:"]
+        for name, total in sorted(self._totals.items(), key=lambda kv: -kv[1]):
+            lines.append(f"  {name:<16} {total/self._nb_frames:.4f}")
+        return '\n'.join(lines)
+
+    def _finish(self, index, duration):
+        stages = self._stages
+        self._stages = None
+        if self._skipped:
+            self._nb_skipped += 1
+            return
+        self._durations.append(duration)
+        self._nb_frames += 1
+        for name, seconds in list(stages.items()) + [('total', duration)]:
+            self._totals[name] = self._totals.get(name, 0.0) + seconds
+
+        if self._csv is not None:
+            for name, seconds in stages.items():
+                self._csv.writerow([index, name, f"{seconds:.6f}"])
+            self._csv.writerow([index, 'total', f"{duration:.6f}"])
+            self._file.flush()
+        elif self._file is not None:
+            record = {'frame': index, 'time': time.time(), 'total': duration, 'stages': stages}
+            self._file.write(json.dumps(record) + '\n')
+            self._file.flush()
+
+        if self.report_every and self._nb_frames % self.report_every == 0:
+            fps = len(self._durations) / sum(self._durations)
+            slowest = max(stages.items(), key=lambda kv: kv[1])[0] if stages else '-'
+            print(f"frame {index}: {fps:.2f} frames/s over the last {len(self._durations)} "
+                  f"frames (slowest stage of this frame: {slowest})")
@@ -0,0 +1,377 @@
+#!/usr/bin/env python3
+
+"""
+Long-lived BlenderProc worker that runs generator jobs without restarting
+Blender.
+
+A one-shot launch of syntheticdata-generator.py, cuboid-generator-6.py,
+object_rain.py or dope_model.py starts Blender, runs bproc.init(), loads its
+scene or models, globs its model folders and sets up the renderer before the
+first frame. For jobs of a few hundred frames that dominates. The daemon pays
+for it once. It then takes job specs from a queue directory and runs the
+unchanged scripts in its own process, with a warm state behind their calls:
+
+    bproc.init()                 keyframes reset; Blender is initialized once
+    bproc.loader.load_blend()    scenes loaded once; the objects are reused with their loaded pose
+    bproc.loader.load_obj()      models loaded once; a job asking twice gets linked duplicates
+    glob.glob()                  folder scans cached until a job asks for a rescan
+    renderer.enable_*_output()   enabled once by the daemon (segmentation by category_id,
+                                 instance and name; depth with --depth)
+
+Objects a job creates (lights, occluders, duplicates) are deleted when it
+ends, and warm objects that the next job does not load again are hidden.
+Before every job, the camera data (lens, sensor, shift, clip planes), the
+render settings and devices are restored to what they were after
+bproc.init(), and the world nodes a job added are deleted, so a job renders
+like it would in a fresh Blender. The render outputs are shared by all the
+jobs, so a job may render outputs it does not use.
+
+A job is a JSON file in <queue>/pending:
+
+    {"script": "dope_model.py", "args": ["--nb_frames", "200", "--outf", "out/a"],
+     "cwd": null, "rescan": false}
+
+A daemon claims it by moving it to <queue>/running, so several daemons (one
+per GPU) can share a queue. The spec is then written to <queue>/done or
+<queue>/failed with its status, duration and error. A file named 'stop' in
+the queue directory stops the daemons once their current job is finished.
+Jobs left in 'running' by a daemon of the same host that died (e.g. Blender
+crashed) are put back in 'pending' when a daemon starts, or in 'failed' once
+they were retried --max_retries times.
+daemon_client.py submits jobs and benchmarks the daemon against one-shot
+launches.
+
+    blenderproc run generator_daemon.py --queue jobs/
+    python daemon_client.py submit jobs/ dope_model.py -- --nb_frames 200 --outf output/a
+"""
+
+import blenderproc as bproc  # must be first!
+import bpy
+
+import argparse
+from contextlib import contextmanager
+import glob
+import json
+import os
+import runpy
+import socket
+import sys
+import time
+import traceback
+
+from daemon_client import QUEUE_DIRECTORIES, STOP_NAME
+
+
+SEGMENTATION_MAPS = ["category_id", "instance", "name"]
+
+# settings a job may change that bproc.init() would reset in a fresh Blender
+CAMERA_SETTINGS = ('type', 'lens', 'lens_unit', 'sensor_fit', 'sensor_width', 'sensor_height',
+                   'shift_x', 'shift_y', 'clip_start', 'clip_end')
+RENDER_SETTINGS = ('resolution_x', 'resolution_y', 'resolution_percentage', 'pixel_aspect_x', 'pixel_aspect_y',
+                   'threads_mode', 'threads')
+CYCLES_SETTINGS = ('device', 'samples', 'use_denoising')
+
+
+def _set_hidden(blender_obj, hidden):
+    blender_obj.hide_render = hidden
+    blender_obj.hide_viewport = hidden
+
+
+def _snapshot(data, names):
+    return {name: getattr(data, name) for name in names}
+
+
+def _restore(data, values):
+    for name, value in values.items():
+        if getattr(data, name) != value:
+            setattr(data, name, value)
+
+
+def _cycles_preferences():
+    return bpy.context.preferences.addons['cycles'].preferences
+
+
+class WarmState:
+    """
+    Blender state kept from job to job, and the functions that stand in for
+    the BlenderProc loaders while a job runs.
+
+    depth - enable the depth output, for jobs run with --depth
+    """
+
+    def __init__(self, depth=False):
+        bproc.init()
+        bproc.renderer.enable_segmentation_output(map_by=SEGMENTATION_MAPS,
+                                                  default_values={"category_id": 0})
+        if depth:
+            bproc.renderer.enable_depth_output(activate_antialiasing=False)
+        self.depth = depth
+
+        self._load_blend = bproc.loader.load_blend
+        self._load_obj = bproc.loader.load_obj
+        self._glob = glob.glob
+        self.loaded = {} # (loader, path, options) -> warm objects
+        self.poses = {} # name of a warm object -> its local to world matrix when it was loaded
+        self.globs = {}
+        self.base_objects = {obj.name for obj in bpy.data.objects} # the camera
+        self._used = set() # loads handed out to the current job
+
+        # what a job may change (intrinsics, threads, devices, HDR nodes), as bproc.init() left it
+        scene = bpy.context.scene
+        self.camera_settings = _snapshot(scene.camera.data, CAMERA_SETTINGS)
+        self.render_settings = _snapshot(scene.render, RENDER_SETTINGS)
+        self.cycles_settings = _snapshot(scene.cycles, CYCLES_SETTINGS)
+        preferences = _cycles_preferences()
+        self.compute_device_type = preferences.compute_device_type
+        self.devices = {device.id: device.use for device in preferences.devices}
+        self.world_nodes = {node.name for node in scene.world.node_tree.nodes}
+
+    def warm_objects(self):
+        return [obj for objects in self.loaded.values() for obj in objects]
+
+    def begin_job(self, rescan=False):
+        bproc.utility.reset_keyframes()
+        bproc.renderer.set_output_format(enable_transparency=False)
+        scene = bpy.context.scene
+        _restore(scene.camera.data, self.camera_settings)
+        _restore(scene.render, self.render_settings)
+        _restore(scene.cycles, self.cycles_settings)
+        preferences = _cycles_preferences()
+        if preferences.compute_device_type != self.compute_device_type:
+            preferences.compute_device_type = self.compute_device_type
+            preferences.get_devices()
+        for device in preferences.devices:
+            if device.id in self.devices:
+                device.use = self.devices[device.id]
+        # drop the HDR texture and mapping nodes a job added to the world, with their links
+        world = scene.world
+        for node in list(world.node_tree.nodes):
+            if node.name not in self.world_nodes:
+                world.node_tree.nodes.remove(node)
+        for link in list(world.node_tree.links):
+            if link.to_node.type == 'BACKGROUND':
+                world.node_tree.links.remove(link)
+        bproc.renderer.set_world_background([0.05, 0.05, 0.05])
+        if rescan:
+            self.globs.clear()
+        self._used.clear()
+        for obj in self.warm_objects():
+            _set_hidden(obj.blender_obj, True)
+
+    def end_job(self):
+        """Delete the objects the job created, and the data only they used."""
+        keep = self.base_objects | {obj.get_name() for obj in self.warm_objects()}
+        for obj in list(bpy.data.objects):
+            if obj.name not in keep:
+                bpy.data.objects.remove(obj, do_unlink=True)
+        for collection in (bpy.data.meshes, bpy.data.lights, bpy.data.materials, bpy.data.images):
+            for block in list(collection):
+                if block.users == 0:
+                    collection.remove(block)
+
+    def load(self, loader, path, *args, **kwargs):
+        key = (loader.__name__, os.path.abspath(path), repr(args), repr(sorted(kwargs.items())))
+        objects = self.loaded.get(key)
+        if objects is None:
+            objects = loader(path, *args, **kwargs)
+            self.loaded[key] = objects
+            for obj in objects:
+                self.poses[obj.get_name()] = obj.get_local2world_mat()
+        elif key in self._used:
+            # a second copy within the same job
+            return [obj.duplicate(linked=True) for obj in objects]
+        else:
+            for obj in objects:
+                obj.set_local2world_mat(self.poses[obj.get_name()])
+                _set_hidden(obj.blender_obj, False)
+        self._used.add(key)
+        return objects
+
+    def load_blend(self, path, *args, **kwargs):
+        return self.load(self._load_blend, path, *args, **kwargs)
+
+    def load_obj(self, path, *args, **kwargs):
+        return self.load(self._load_obj, path, *args, **kwargs)
+
+    def glob_cached(self, pathname, *args, **kwargs):
+        key = (os.path.abspath(pathname), repr(args), repr(sorted(kwargs.items())))
+        if key not in self.globs:
+            self.globs[key] = self._glob(pathname, *args, **kwargs)
+        return list(self.globs[key])
+
+    def enable_depth_output(self, *args, **kwargs):
+        if not self.depth:
+            raise RuntimeError("the depth output is only available from a daemon started with --depth")
+
+    @contextmanager
+    def patched(self):
+        """Stand in for the BlenderProc functions the generator scripts call during setup."""
+        replacements = [(bproc, 'init', lambda *args, **kwargs: None),
+                        (bproc.loader, 'load_blend', self.load_blend),
+                        (bproc.loader, 'load_obj', self.load_obj),
+                        (bproc.renderer, 'enable_segmentation_output', lambda *args, **kwargs: None),
+                        (bproc.renderer, 'enable_depth_output', self.enable_depth_output),
+                        (glob, 'glob', self.glob_cached)]
+        originals = [(module, name, getattr(module, name)) for module, name, _ in replacements]
+        for module, name, function in replacements:
+            setattr(module, name, function)
+        try:
+            yield
+        finally:
+            for module, name, function in originals:
+                setattr(module, name, function)
+
+
+def _write_spec(spec, path):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(spec, f, indent=4)
+    os.replace(path + '.tmp', path)
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # a process of another user
+        return True
+    return True
+
+
+def claim_job(queue):
+    """Path of the next pending job, moved to 'running'; None if there is none."""
+    pending = os.path.join(queue, 'pending')
+    for name in sorted(os.listdir(pending)):
+        if not name.endswith('.json'):
+            continue
+        path = os.path.join(queue, 'running', name)
+        try:
+            os.rename(os.path.join(pending, name), path)
+        except FileNotFoundError:
+            # claimed by another daemon
+            continue
+        # the daemon running the job, so a daemon started later can tell whether it died
+        with open(path) as f:
+            spec = json.load(f)
+        spec['daemon'] = {'host': socket.gethostname(), 'pid': os.getpid()}
+        _write_spec(spec, path)
+        return path
+    return None
+
+
+def reclaim_jobs(queue, max_retries=1):
+    """
+    Put the jobs of dead daemons of this host back in 'pending', or in
+    'failed' once they were retried 'max_retries' times. Jobs of daemons of
+    other hosts are left alone. Returns the names of the reclaimed jobs.
+    """
+    running = os.path.join(queue, 'running')
+    host = socket.gethostname()
+    reclaimed = []
+    for name in sorted(os.listdir(running)):
+        if not name.endswith('.json'):
+            continue
+        path = os.path.join(running, name)
+        try:
+            with open(path) as f:
+                spec = json.load(f)
+        except (OSError, ValueError):
+            continue
+        owner = spec.pop('daemon', None) or {}
+        if not owner and time.time() - os.path.getmtime(path) < 60:
+            # just claimed, its daemon has not written its name yet
+            continue
+        if owner.get('host', host) != host:
+            continue
+        if owner.get('pid') is not None and _alive(owner['pid']):
+            continue
+
+        spec['retries'] = spec.get('retries', 0) + 1
+        if spec['retries'] > max_retries:
+            spec.update({'status': 'failed', 'seconds': 0.0, 'finished': time.time(),
+                         'error': f"the daemon running it died {spec['retries']} times"})
+            _write_spec(spec, os.path.join(queue, 'failed', name))
+        else:
+            _write_spec(spec, os.path.join(queue, 'pending', name))
+        os.remove(path)
+        reclaimed.append(name)
+    return reclaimed
+
+
+def run_job(state, queue, path):
+    with open(path) as f:
+        spec = json.load(f)
+    script = spec['script']
+    if not os.path.isabs(script) and not os.path.exists(script):
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), script)
+
+    argv, cwd = sys.argv, os.getcwd()
+    start = time.perf_counter()
+    status, error = 'done', None
+    with state.patched():
+        state.begin_job(spec.get('rescan', False))
+        try:
+            if spec.get('cwd'):
+                os.chdir(spec['cwd'])
+            sys.argv = [script] + [str(aa) for aa in spec.get('args', [])]
+            runpy.run_path(script, run_name='__main__')
+        except SystemExit as e:
+            if e.code not in (None, 0):
+                status, error = 'failed', f"exit status {e.code}"
+        except Exception:
+            status, error = 'failed', traceback.format_exc()
+        finally:
+            sys.argv = argv
+            os.chdir(cwd)
+            state.end_job()
+
+    spec.update({'status': status, 'error': error, 'seconds': time.perf_counter() - start,
+                 'finished': time.time()})
+    spec.pop('daemon', None)
+    _write_spec(spec, os.path.join(queue, status, os.path.basename(path)))
+    os.remove(path)
+    return spec
+
+
+def main(args):
+    for name in QUEUE_DIRECTORIES:
+        os.makedirs(os.path.join(args.queue, name), exist_ok=True)
+    for name in reclaim_jobs(args.queue, args.max_retries):
+        print(f"Reclaimed job {name} of a daemon that died")
+
+    start = time.perf_counter()
+    state = WarmState(depth=args.depth)
+    print(f"Daemon ready in {time.perf_counter() - start:.1f}s, waiting for jobs in {args.queue}")
+
+    idle_since = time.perf_counter()
+    nb_jobs = 0
+    while not os.path.exists(os.path.join(args.queue, STOP_NAME)):
+        path = claim_job(args.queue)
+        if path is None:
+            if args.max_idle > 0 and time.perf_counter() - idle_since > args.max_idle:
+                break
+            time.sleep(args.poll)
+            continue
+
+        result = run_job(state, args.queue, path)
+        nb_jobs += 1
+        print(f"Job {os.path.basename(path)} {result['status']} in {result['seconds']:.1f}s")
+        if result['error']:
+            print(result['error'])
+        idle_since = time.perf_counter()
+
+    print(f"Daemon stopped after {nb_jobs} jobs")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--queue', default="jobs/", help="queue directory the jobs are submitted to")
+    parser.add_argument('--depth', action='store_true', help="enable the depth output, for dope_model.py jobs run with --depth")
+    parser.add_argument('--poll', default=0.5, type=float, help="seconds between two looks at an empty queue")
+    parser.add_argument('--max_retries', default=1, type=int,
+                        help="times a job whose daemon died is run again before it is marked as failed")
+    parser.add_argument('--max_idle', default=0, type=float, help="stop after this many seconds without a job, 0 waits forever")
+
+    opt = parser.parse_args()
+    main(opt)
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+"""
+Per-instance statistics of a segmentation map computed with histograms.
+
+Instead of scanning the whole map once per object (np.sum(seg_map == idx)),
+the pixel counts, tight 2D bounding boxes and truncation flags of every
+instance id are derived from one row histogram and one column histogram.
+"""
+
+import numpy as np
+
+
+class InstanceStats:
+    """
+    counts    - (num_ids,) number of visible pixels of each id
+    bboxes    - (num_ids, 4) tight [x_min, y_min, x_max, y_max] box in pixels,
+                -1 for ids that are not visible
+    truncated - (num_ids,) True if the visible part touches the image border
+    """
+
+    def __init__(self, counts, bboxes, truncated):
+        self.counts = counts
+        self.bboxes = bboxes
+        self.truncated = truncated
+
+    def bounding_box(self, idx):
+        """Bounding box of one id in the DOPE json layout, or None if it is not visible."""
+        if self.counts[idx] == 0:
+            return None
+        x_min, y_min, x_max, y_max = self.bboxes[idx].tolist()
+        return {'top_left': [x_min, y_min], 'bottom_right': [x_max, y_max]}
+
+    def rescaled(self, width, height, new_width, new_height):
+        """
+        Statistics of a (width, height) map carried over to a (new_width,
+        new_height) image, e.g. from a low resolution segmentation pass to the
+        rendered frame. Counts are scaled by the pixel area and every box grows
+        to cover the pixels of its low resolution pixels.
+        """
+        sx = new_width / width
+        sy = new_height / height
+        counts = np.rint(self.counts * (sx * sy)).astype(np.int64)
+        bboxes = self.bboxes.copy()
+        visible = self.counts > 0
+        bboxes[visible, 0] = np.floor(self.bboxes[visible, 0] * sx)
+        bboxes[visible, 1] = np.floor(self.bboxes[visible, 1] * sy)
+        bboxes[visible, 2] = np.minimum(np.ceil((self.bboxes[visible, 2] + 1) * sx) - 1, new_width - 1)
+        bboxes[visible, 3] = np.minimum(np.ceil((self.bboxes[visible, 3] + 1) * sy) - 1, new_height - 1)
+        return InstanceStats(counts, bboxes, self.truncated.copy())
+
+
+def instance_stats(seg_map, num_ids):
+    """
+    Compute the statistics of ids 0 .. num_ids-1 of an (H, W) segmentation
+    map. Ids outside of that range are ignored.
+    """
+    seg = np.asarray(seg_map)
+    if seg.ndim == 3:
+        seg = seg[..., 0]
+    height, width = seg.shape
+
+    # Ids out of range are sent to an extra overflow bin that is dropped
+    ids = seg.astype(np.int64)
+    nb_bins = num_ids + 1
+    ids[(ids < 0) | (ids >= num_ids)] = num_ids
+
+    rows = np.arange(height, dtype=np.int64)[:, None] * nb_bins
+    row_hist = np.bincount((ids + rows).ravel(),
+                           minlength=height*nb_bins).reshape(height, nb_bins)[:, :num_ids]
+    cols = np.arange(width, dtype=np.int64)[None, :] * nb_bins
+    col_hist = np.bincount((ids + cols).ravel(),
+                           minlength=width*nb_bins).reshape(width, nb_bins)[:, :num_ids]
+
+    counts = row_hist.sum(axis=0)
+    visible = counts > 0
+
+    row_present = row_hist > 0
+    col_present = col_hist > 0
+    bboxes = np.stack([np.argmax(col_present, axis=0),
+                       np.argmax(row_present, axis=0),
+                       width - 1 - np.argmax(col_present[::-1], axis=0),
+                       height - 1 - np.argmax(row_present[::-1], axis=0)], axis=1)
+    bboxes[~visible] = -1
+
+    truncated = visible & ((bboxes[:, 0] == 0) | (bboxes[:, 1] == 0) |
+                           (bboxes[:, 2] == width - 1) | (bboxes[:, 3] == height - 1))
+
+    return InstanceStats(counts, bboxes, truncated)
@@ -1,12 +1,30 @@
 import blenderproc as bproc
 import argparse
 import os
-from PIL import Image
 import numpy as np
 
+from async_writer import AsyncWriter
+from coco_builder import CocoBuilder
+from frame_profiler import FrameProfiler
+from yolo_pose import export_labels
+
 parser = argparse.ArgumentParser()
 parser.add_argument('scene', nargs='?', default="scene.blend", help="Path to the scene.blend file")
 parser.add_argument('output_dir', nargs='?', default="output", help="Path to where the final files will be saved")
+parser.add_argument('--width', default=640, type=int, help="Image width")
+parser.add_argument('--height', default=480, type=int, help="Image height")
+parser.add_argument('--min_pixels', default=1, type=int, help="Minimum number of visible pixels for an object to get a label")
+parser.add_argument('--png_compression', default=6, type=int, help="PNG compression level, 0 (fastest) to 9 (smallest)")
+parser.add_argument('--writer_workers', default=2, type=int,
+                    help="Threads (or processes) writing images in the background, 0 writes synchronously")
+parser.add_argument('--writer_queue', default=8, type=int, help="Images that may wait to be written before rendering blocks")
+parser.add_argument('--writer_processes', action='store_true', help="Encode the images in processes instead of threads")
+parser.add_argument('--nb_rotations', default=36, type=int, help="Number of poses over a full turn of the objects")
+parser.add_argument('--batch_size', default=6, type=int, help="Poses rendered by a single render call; more is faster but holds more images in memory")
+parser.add_argument('--coco_shard_size', default=0, type=int, help="Images per COCO annotation file (listed in coco_index.json), 0 writes a single coco_annotations.json")
+parser.add_argument('--profile', default=None, help="Write the time spent in every stage of every batch to this .jsonl or .csv file")
+parser.add_argument('--profile_report_every', default=50, type=int, help="Print the rolling batches per second every N batches, 0 disables it")
+parser.add_argument('--cprofile_every', default=0, type=int, help="Run every Nth batch under cProfile and dump its statistics, 0 disables it")
 args = parser.parse_args()
 
 bproc.init()
@@ -25,10 +43,8 @@ light.set_location([5, -5, 5])
 light.set_energy(1000)
 
 # Define the camera intrinsics
-bproc.camera.set_resolution(640, 480)  # Set to LINEMOD-like resolution (640x480)
+bproc.camera.set_resolution(args.width, args.height)  # LINEMOD-like resolution (640x480) by default
 K = bproc.camera.get_intrinsics_as_K_matrix()  # Get camera intrinsic matrix
-fx, fy = K[0][0], K[1][1]
-cx, cy = K[0][2], K[1][2]
 
 # Enable segmentation output for generating masks
 bproc.renderer.enable_segmentation_output(map_by=["category_id", "instance", "name"])
@@ -43,52 +59,80 @@ os.makedirs(mask_dir, exist_ok=True)
 os.makedirs(label_dir, exist_ok=True)
 os.makedirs(coco_dir, exist_ok=True)
 
-# Loop to rotate object and change camera position
-for angle in np.linspace(0, 2 * np.pi, num=36):  # 36 rotations for a full 360-degree turn
-    for obj in objs:
-        # Apply rotation to the object around the Z-axis and Y-axis for variation
-        obj.set_rotation_euler([angle / 2, angle, 0])
-
-    # Randomize the camera position for each rotation
-    camera_position = np.random.uniform([-10, -10, 8], [10, 10, 12])  # Random camera position
-    rotation_matrix = bproc.camera.rotation_from_forward_vec([0, 0, 0] - camera_position, inplane_rot=np.random.uniform(-0.7854, 0.7854))
-    cam2world_matrix = bproc.math.build_transformation_mat(camera_position, rotation_matrix)
-    bproc.camera.add_camera_pose(cam2world_matrix)
-
-    # Render the scene with the current object rotation
-    data = bproc.renderer.render()
-
-    # Save RGB images using PIL
-    for i, color_img in enumerate(data["colors"]):
-        img = Image.fromarray((color_img * 255).astype('uint8'))  # Convert to uint8 format
-        img.save(os.path.join(rgb_dir, f"{str(i).zfill(6)}_angle_{int(np.degrees(angle))}.png"))
+# PNG encoding overlaps the rendering of the next images
+writer = AsyncWriter(workers=args.writer_workers, max_pending=args.writer_queue,
+                     compress_level=args.png_compression, use_processes=args.writer_processes)
+
+# COCO annotations of all the poses, referencing the images of rgb_dir
+coco = CocoBuilder(coco_dir, shard_size=args.coco_shard_size)
+
+# Per-batch stage timings
+profiler = FrameProfiler(args.profile, args.profile_report_every, args.cprofile_every)
+
+# Bounding box corners of every object in its own coordinates; the world pose of a
+# rendered pose is rebuilt from the rotation keyframed for it
+local_boxes = np.stack([obj.get_bound_box(local_coords=True) for obj in objs])  # (n_objects, 8, 3)
+locations = np.stack([obj.get_location() for obj in objs])
+scales = np.stack([obj.get_scale() for obj in objs])
+category_ids = np.array([obj.get_cp("category_id") for obj in objs])
+
+# Rotate the objects and move the camera, registering args.batch_size poses per render
+angles = np.linspace(0, 2 * np.pi, num=args.nb_rotations)  # full 360-degree turn
+batches = [range(start, min(start + args.batch_size, len(angles)))
+           for start in range(0, len(angles), args.batch_size)]
+for step in profiler.frames(range(len(batches))):
+    batch = batches[step]
+    cam2worlds = []
+    with profiler.stage('pose'):
+        for key, pose in enumerate(batch):
+            angle = angles[pose]
+            for obj in objs:
+                # Apply rotation to the object around the Z-axis and Y-axis for variation
+                obj.set_rotation_euler([angle / 2, angle, 0], frame=key)
+
+            # Randomize the camera position for each rotation
+            camera_position = np.random.uniform([-10, -10, 8], [10, 10, 12])  # Random camera position
+            rotation_matrix = bproc.camera.rotation_from_forward_vec([0, 0, 0] - camera_position, inplane_rot=np.random.uniform(-0.7854, 0.7854))
+            cam2world_matrix = bproc.math.build_transformation_mat(camera_position, rotation_matrix)
+            bproc.camera.add_camera_pose(cam2world_matrix, frame=key)
+            cam2worlds.append(cam2world_matrix)
+
+    # Render all the poses of the batch in one call
+    with profiler.stage('render'):
+        data = bproc.renderer.render()
+
+    names = [f"{str(pose).zfill(6)}_angle_{int(np.degrees(angles[pose]))}" for pose in batch]
+
+    # Save RGB images in the background
+    with profiler.stage('save_images'):
+        for name, color_img in zip(names, data["colors"]):
+            img = (color_img * 255).astype('uint8')  # Convert to uint8 format
+            writer.save_image(os.path.join(rgb_dir, name + ".png"), img)
 
     # Save black and white segmentation masks
-    for i, instance_map in enumerate(data["instance_segmaps"]):
-        bw_mask = np.where(instance_map > 0, 255, 0).astype(np.uint8)  # Object pixels as 255, background as 0
-        img = Image.fromarray(bw_mask)
-        img.save(os.path.join(mask_dir, f"{str(i).zfill(6)}_angle_{int(np.degrees(angle))}.png"))
-
-    # Write COCO-style annotations
-    bproc.writer.write_coco_annotations(os.path.join(coco_dir, f'annotations_angle_{int(np.degrees(angle))}'),
-                                        instance_segmaps=data["instance_segmaps"],
-                                        instance_attribute_maps=data["instance_attribute_maps"],
-                                        colors=data["colors"],
-                                        color_file_format="PNG")
-
-    # Generate .txt files for each rendered image
-    for i, obj in enumerate(objs):
-        keypoints_2d = bproc.camera.project_points(obj.get_bound_box())
-        keypoints_2d_norm = [(kp[0] / 640, kp[1] / 480) for kp in keypoints_2d]
-
-        # Compute bounding box
-        x_min, y_min, x_max, y_max = min(kp[0] for kp in keypoints_2d_norm), min(kp[1] for kp in keypoints_2d_norm), max(kp[0] for kp in keypoints_2d_norm), max(kp[1] for kp in keypoints_2d_norm)
-
-        category_id = obj.get_cp("category_id")
-        with open(os.path.join(label_dir, f"{str(i).zfill(6)}_angle_{int(np.degrees(angle))}.txt"), 'w') as f:
-            label_data = [category_id] + [coord for kp in keypoints_2d_norm for coord in kp]
-            label_data += [fx, fy, 640, 480, cx, cy, 640, 480]
-            f.write(' '.join(map(str, label_data)) + '\n')
-
+    with profiler.stage('save_masks'):
+        for name, instance_map in zip(names, data["instance_segmaps"]):
+            bw_mask = np.where(instance_map > 0, 255, 0).astype(np.uint8)  # Object pixels as 255, background as 0
+            writer.save_image(os.path.join(mask_dir, name + ".png"), bw_mask)
+
+    # Append the COCO-style annotations of the batch
+    with profiler.stage('coco'):
+        for name, segmap, attribute_map in zip(names, data["instance_segmaps"], data["instance_attribute_maps"]):
+            coco.add_image(segmap, attribute_map, file_name=os.path.relpath(os.path.join(rgb_dir, name + ".png"), coco_dir))
+
+    # One YOLOv8-pose label file per rendered image, class = category_id - 1
+    with profiler.stage('labels'):
+        rotations = np.stack([bproc.math.build_transformation_mat([0, 0, 0], [angles[pose] / 2, angles[pose], 0])[0:3, 0:3]
+                              for pose in batch])
+        bound_boxes = np.einsum('pij,onj->poni', rotations, local_boxes * scales[:, None, :]) + locations[None, :, None, :]
+        export_labels([os.path.join(label_dir, name + ".txt") for name in names], data["category_id_segmaps"],
+                      bound_boxes, np.stack(cam2worlds), K, category_ids, category_ids - 1, writer,
+                      min_pixels=args.min_pixels)
+
+    # Forget the poses of this batch so the next render only renders its own
+    bproc.utility.reset_keyframes()
+
+writer.close()
+coco.close()
+profiler.close()
 print("Dataset generation with object rotation and camera variation complete.")
-
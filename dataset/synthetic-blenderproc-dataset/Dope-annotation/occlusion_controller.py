@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+
+"""
+Feedback controller that steers the occluders of the generated frames toward
+a target histogram of occlusion ratios.
+
+The occlusion ratio of a target is 1 - visible / expected. 'visible' is the
+visibility pixel count written by write_json. 'expected' is the area of the
+convex hull of the projected bounding box, clipped to the image: the area
+the target would cover if nothing hid it. That is exact for box shaped
+targets (doors, frames, cuboids) and an upper bound for other shapes.
+
+The scripts turn a single occlusion level in [0, 1] into the count, size and
+placement of their occluders: more of them, larger, and more of them on the
+lines of sight of the targets. After every frame the controller records the
+ratios it produced and the mean ratio each level yields. The next level
+aims at the center of the histogram bin that is furthest below its target
+share. A fraction of the frames explore a random level so the response of
+every level stays up to date.
+
+The state is saved as JSON in the output directory so a resumed run keeps
+filling the same histogram. Frames regenerated on resume may then get other
+occluders than in the original run.
+
+    python occlusion_controller.py output/0/occlusion_controller.json
+"""
+
+import argparse
+import json
+import os
+
+import numpy as np
+
+from yolo_pose import project_points
+
+
+# frame_seed() stream of the occlusion levels, independent of the global random state
+OCCLUSION_STREAM = 3
+STATE_NAME = 'occlusion_controller.json'
+
+
+def parse_target(spec):
+    """
+    Target histogram of a 'low:high:bins' spec, uniform over [low, high]
+    (e.g. '0:0.8:8'), or of a comma separated list of bin weights over [0, 1].
+    Returns (edges, weights).
+    """
+    if ':' in spec:
+        low, high, bins = spec.split(':')
+        return np.linspace(float(low), float(high), int(bins) + 1), np.ones(int(bins))
+    weights = np.array([float(ww) for ww in spec.split(',')])
+    return np.linspace(0.0, 1.0, len(weights) + 1), weights
+
+
+def _convex_hull(points):
+    """Monotone chain convex hull of (n, 2) points, counter-clockwise."""
+    points = sorted(set(map(tuple, points)))
+    if len(points) < 3:
+        return points
+
+    def half(sequence):
+        hull = []
+        for pp in sequence:
+            while len(hull) >= 2 and ((hull[-1][0] - hull[-2][0]) * (pp[1] - hull[-2][1])
+                                      - (hull[-1][1] - hull[-2][1]) * (pp[0] - hull[-2][0])) <= 0:
+                hull.pop()
+            hull.append(pp)
+        return hull
+
+    lower, upper = half(points), half(reversed(points))
+    return lower[:-1] + upper[:-1]
+
+
+def _clip_polygon(polygon, width, height):
+    """Sutherland-Hodgman clipping of a polygon to the image rectangle."""
+    def clip(polygon, inside, intersect):
+        clipped = []
+        for ii, current in enumerate(polygon):
+            previous = polygon[ii - 1]
+            if inside(current):
+                if not inside(previous):
+                    clipped.append(intersect(previous, current))
+                clipped.append(current)
+            elif inside(previous):
+                clipped.append(intersect(previous, current))
+        return clipped
+
+    def at_x(x):
+        return lambda p, q: (x, p[1] + (q[1] - p[1]) * (x - p[0]) / (q[0] - p[0]))
+
+    def at_y(y):
+        return lambda p, q: (p[0] + (q[0] - p[0]) * (y - p[1]) / (q[1] - p[1]), y)
+
+    for inside, intersect in ((lambda p: p[0] >= 0, at_x(0)), (lambda p: p[0] <= width, at_x(width)),
+                              (lambda p: p[1] >= 0, at_y(0)), (lambda p: p[1] <= height, at_y(height))):
+        if not polygon:
+            break
+        polygon = clip(polygon, inside, intersect)
+    return polygon
+
+
+def _polygon_area(polygon):
+    if len(polygon) < 3:
+        return 0.0
+    xy = np.asarray(polygon, dtype=float)
+    return 0.5 * abs(np.dot(xy[:, 0], np.roll(xy[:, 1], -1)) - np.dot(xy[:, 1], np.roll(xy[:, 0], -1)))
+
+
+def expected_areas(bboxes, cam2world, K, width, height, near=1e-3):
+    """
+    (n,) pixels the world bounding boxes (n, 8, 3) would cover unoccluded:
+    the area of their projected hull inside the image. NaN for boxes that
+    cross the camera plane, whose projection is not a hull of their corners.
+    """
+    bboxes = np.asarray(bboxes, dtype=float).reshape(-1, 8, 3)
+    uv, depth = project_points(bboxes[None], np.asarray(cam2world, dtype=float)[None], K)
+    areas = np.full(len(bboxes), np.nan)
+    for ii, (corners, corner_depths) in enumerate(zip(uv[0], depth[0])):
+        if np.all(corner_depths > near):
+            areas[ii] = _polygon_area(_clip_polygon(_convex_hull(corners), width, height))
+    return areas
+
+
+def occlusion_ratios(visible, areas, min_area=100):
+    """
+    (n,) occlusion ratios of targets with 'visible' pixels out of 'areas';
+    NaN for targets too small or too far outside the image to be judged.
+    """
+    visible = np.asarray(visible, dtype=float)
+    areas = np.asarray(areas, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratios = np.clip(1.0 - visible / areas, 0.0, 1.0)
+    ratios[~(areas >= min_area)] = np.nan
+    return ratios
+
+
+def line_of_sight_points(eye, targets, n, rng, span=(0.3, 0.9), jitter=0.05):
+    """
+    (n, 3) points on the segments from the camera 'eye' to random 'targets'
+    (m, 3), between span[0] and span[1] of the way, off the line by up to
+    'jitter' of the distance to the target.
+    """
+    eye = np.asarray(eye, dtype=float)
+    targets = np.asarray(targets, dtype=float).reshape(-1, 3)
+    chosen = targets[rng.integers(0, len(targets), n)]
+    t = rng.uniform(span[0], span[1], (n, 1))
+    distance = np.linalg.norm(chosen - eye, axis=1, keepdims=True)
+    return eye + t * (chosen - eye) + rng.uniform(-jitter, jitter, (n, 3)) * distance
+
+
+class OcclusionController:
+    """
+    edges, weights - bins and relative weights of the target histogram of occlusion ratios
+    nb_levels      - discrete occlusion levels the controller chooses from
+    exploration    - share of the frames that try a random level
+    """
+
+    def __init__(self, edges, weights, nb_levels=11, exploration=0.1):
+        self.edges = np.asarray(edges, dtype=float)
+        self.weights = np.asarray(weights, dtype=float) / np.sum(weights)
+        self.nb_levels = nb_levels
+        self.exploration = exploration
+        self.counts = np.zeros(len(self.weights), dtype=np.int64)
+        self.nb_outside = 0 # ratios outside of the target range
+        self.nb_frames = 0
+        # mean occlusion ratio every level produced; before any frame, the level maps
+        # linearly onto the target range
+        self.level_means = np.linspace(self.edges[0], self.edges[-1], nb_levels)
+        self.level_frames = np.zeros(nb_levels, dtype=np.int64)
+
+    @classmethod
+    def load(cls, path, edges, weights, nb_levels=11, exploration=0.1):
+        """Controller resumed from the state saved in 'path', if it has the same bins."""
+        controller = cls(edges, weights, nb_levels, exploration)
+        if os.path.exists(path):
+            with open(path) as f:
+                state = json.load(f)
+            if (np.allclose(state['edges'], controller.edges)
+                    and len(state['level_means']) == nb_levels):
+                controller.counts = np.asarray(state['counts'], dtype=np.int64)
+                controller.nb_outside = state['nb_outside']
+                controller.nb_frames = state['nb_frames']
+                controller.level_means = np.asarray(state['level_means'], dtype=float)
+                controller.level_frames = np.asarray(state['level_frames'], dtype=np.int64)
+            else:
+                print(f"Ignoring the occlusion controller state of {path}: other target histogram")
+        return controller
+
+    def state(self):
+        return {'edges': self.edges.tolist(),
+                'weights': self.weights.tolist(),
+                'counts': self.counts.tolist(),
+                'nb_outside': int(self.nb_outside),
+                'nb_frames': int(self.nb_frames),
+                'level_means': self.level_means.tolist(),
+                'level_frames': self.level_frames.tolist()}
+
+    def choose(self, rng):
+        """Index of the level of the next frame."""
+        if rng.uniform() < self.exploration:
+            return int(rng.integers(0, self.nb_levels))
+        deficit = self.weights * (self.counts.sum() + 1) - self.counts
+        target_bin = int(np.argmax(deficit))
+        center = 0.5 * (self.edges[target_bin] + self.edges[target_bin + 1])
+        return int(np.argmin(np.abs(self.level_means - center)))
+
+    def level(self, index):
+        """Occlusion level in [0, 1] of a level index, which the scripts map onto their occluders."""
+        return index / max(1, self.nb_levels - 1)
+
+    def update(self, index, ratios):
+        """Record the occlusion ratios (NaN for targets that could not be judged) of a frame."""
+        ratios = np.asarray(ratios, dtype=float)
+        ratios = ratios[~np.isnan(ratios)]
+        self.nb_frames += 1
+        if len(ratios) == 0:
+            return
+        bins = np.searchsorted(self.edges, ratios, side='right') - 1
+        # the upper edge belongs to the last bin
+        bins[ratios == self.edges[-1]] = len(self.counts) - 1
+        inside = (bins >= 0) & (bins < len(self.counts))
+        np.add.at(self.counts, bins[inside], 1)
+        self.nb_outside += int(np.sum(~inside))
+
+        # running mean that keeps following the scene once a level has many frames
+        self.level_frames[index] += 1
+        rate = max(1.0 / self.level_frames[index], 0.05)
+        self.level_means[index] += rate * (ratios.mean() - self.level_means[index])
+
+    def distance(self):
+        """Total variation distance between the histogram so far and the target."""
+        total = self.counts.sum() + self.nb_outside
+        if total == 0:
+            return 1.0
+        observed = np.append(self.counts, self.nb_outside) / total
+        return 0.5 * np.abs(observed - np.append(self.weights, 0.0)).sum()
+
+    def report(self):
+        total = max(1, self.counts.sum() + self.nb_outside)
+        lines = [f"occlusion ratios of {self.nb_frames} frames, distance to target {self.distance():.3f}:"]
+        for low, high, count, weight in zip(self.edges[:-1], self.edges[1:], self.counts, self.weights):
+            lines.append(f"  {low:.2f}-{high:.2f} {100.0 * count / total:5.1f}% (target {100.0 * weight:5.1f}%)")
+        lines.append(f"  outside   {100.0 * self.nb_outside / total:5.1f}% (target   0.0%)")
+        return '\n'.join(lines)
+
+    def save(self, path, writer=None):
+        if writer is not None:
+            writer.save_json(path, self.state(), indent=4)
+        else:
+            with open(path, 'w') as f:
+                json.dump(self.state(), f, indent=4)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('state', help="occlusion controller state saved by a generator run")
+    opt = parser.parse_args()
+
+    with open(opt.state) as f:
+        state = json.load(f)
+    controller = OcclusionController.load(opt.state, state['edges'], state['weights'],
+                                          len(state['level_means']))
+    print(controller.report())
+    print("mean occlusion ratio of every level:")
+    for index, (mean, frames) in enumerate(zip(controller.level_means, controller.level_frames)):
+        print(f"  {controller.level(index):.2f} {mean:.3f} ({frames} frames)")
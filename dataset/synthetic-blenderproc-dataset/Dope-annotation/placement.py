@@ -0,0 +1,394 @@
+#!/usr/bin/env python3
+
+"""
+Vectorized, collision-aware placement of the objects and distractors of a frame.
+
+Positions and rotations are drawn for all the objects at once with NumPy.
+Every object is approximated by its bounding sphere, and candidates that
+overlap an already placed sphere are rejected. The lookup uses a spatial hash
+of the placed spheres, so it only checks the spheres of neighbouring cells.
+Distractors are sampled uniformly in the volume of the camera frustum: depth d
+has the density 3d^2/(far^3 - near^3), so d = cbrt(near^3 + u*(far^3 - near^3)).
+
+With a FrustumCheck, the bounding boxes of the targets are projected with the
+camera intrinsics before anything is rendered. Draws where no target covers
+min_pixels of the image are resampled, and frames that never get a visible
+target are flagged so the generator can skip their render.
+
+Whole pose tables can be generated ahead of a run with pose_table(). Every
+frame draws from its own generator, seeded from the run seed and the frame
+index, so a resumed run gets the same poses.
+
+    python placement.py --selftest
+"""
+
+import argparse
+from math import pi
+import sys
+
+import numpy as np
+
+from frame_manifest import frame_seed
+from yolo_pose import project_points
+
+# frame_seed() stream of the placements, independent of the global random state
+PLACEMENT_STREAM = 2
+
+
+def rotation_x(angles):
+    c, s = np.cos(angles), np.sin(angles)
+    o, z = np.ones_like(angles), np.zeros_like(angles)
+    return np.stack([np.stack([o, z, z], -1), np.stack([z, c, -s], -1), np.stack([z, s, c], -1)], -2)
+
+
+def rotation_y(angles):
+    c, s = np.cos(angles), np.sin(angles)
+    o, z = np.ones_like(angles), np.zeros_like(angles)
+    return np.stack([np.stack([c, z, s], -1), np.stack([z, o, z], -1), np.stack([-s, z, c], -1)], -2)
+
+
+def rotation_z(angles):
+    c, s = np.cos(angles), np.sin(angles)
+    o, z = np.ones_like(angles), np.zeros_like(angles)
+    return np.stack([np.stack([c, -s, z], -1), np.stack([s, c, z], -1), np.stack([z, z, o], -1)], -2)
+
+
+def random_rotation_matrices(n, rng, max_angle=180):
+    """
+    (n, 3, 3) rotations, drawn like dope_model.py always did: the board is
+    oriented so a white square (sq #0) is in the upper left corner, then
+    rotated by up to 'max_angle' degrees around X, Y and Z.
+    """
+    mr = pi * (max_angle / 180.0)
+    angles = mr * rng.uniform(-1.0, 1.0, size=(3, n))
+    return rotation_y(-0.5 * pi) @ rotation_x(angles[0]) @ rotation_y(angles[1]) @ rotation_z(angles[2])
+
+
+def random_object_positions(n, rng, near=20.0, far=100.0):
+    """Object positions in the visible box in front of the default camera (x, z in [-20, 20])."""
+    return np.stack([rng.uniform(-20.0, 20.0, n), rng.uniform(near, far, n), rng.uniform(-20.0, 20.0, n)],
+                    axis=1)
+
+
+def frustum_depths(n, rng, near, far):
+    """Depths of points drawn uniformly in the volume of a pyramidal frustum."""
+    return np.cbrt(near**3 + rng.uniform(0.0, 1.0, n) * (far**3 - near**3))
+
+
+def frustum_points(n, rng, fov, cam2world, near=5.0, far=100.0):
+    """
+    (n, 3) world points drawn uniformly in the frustum of a Blender camera
+    (looking down -Z, +Y up) with the full field of view 'fov' = (fov_x, fov_y).
+    """
+    depth = frustum_depths(n, rng, near, far)
+    x = rng.uniform(-1.0, 1.0, n) * depth * np.tan(fov[0] / 2)
+    y = rng.uniform(-1.0, 1.0, n) * depth * np.tan(fov[1] / 2)
+    cam = np.stack([x, y, -depth, np.ones(n)], axis=1)
+    return (cam @ np.asarray(cam2world, dtype=float).T)[:, 0:3]
+
+
+def bounding_radius(local_box, scale=1.0):
+    """Radius of the sphere around the object origin that holds its (8, 3) local bounding box."""
+    return float(np.linalg.norm(np.asarray(local_box, dtype=float), axis=1).max() * scale)
+
+
+class FrustumCheck:
+    """
+    Analytic visibility test of the targets of a draw, without rendering.
+
+    local_boxes - (n, 8, 3) bounding box corners of the targets in their local coordinates
+    scale       - scale applied to the targets after their pose
+    cam2world   - 4x4 pose of the (Blender) camera
+    K           - 3x3 camera intrinsics
+    min_pixels  - a target must cover at least this many pixels with its projected box
+    """
+
+    def __init__(self, local_boxes, scale, cam2world, K, width, height, min_pixels=1, near=1.0):
+        self.local_boxes = np.asarray(local_boxes, dtype=float).reshape(-1, 8, 3) * scale
+        self.cam2world = np.asarray(cam2world, dtype=float)
+        self.K = np.asarray(K, dtype=float)
+        self.width = width
+        self.height = height
+        self.min_pixels = max(1, min_pixels)
+        self.near = near
+
+    def areas(self, positions, rotations):
+        """
+        (n,) on-screen area in pixels of the projected bounding boxes of the
+        posed targets. It bounds the number of pixels a target can cover.
+        """
+        corners = np.einsum('nij,nkj->nki', rotations, self.local_boxes) + positions[:, None, :]
+        uv, depth = project_points(corners[None], self.cam2world[None], self.K)
+        uv, depth = uv[0], depth[0]
+        in_front = depth > self.near
+        with np.errstate(invalid='ignore'):
+            x0 = np.clip(uv[..., 0].min(axis=1), 0, self.width)
+            x1 = np.clip(uv[..., 0].max(axis=1), 0, self.width)
+            y0 = np.clip(uv[..., 1].min(axis=1), 0, self.height)
+            y1 = np.clip(uv[..., 1].max(axis=1), 0, self.height)
+        areas = np.nan_to_num((x1 - x0) * (y1 - y0))
+        # a box crossing the near plane does not project as a box: keep it
+        areas[in_front.any(axis=1) & ~in_front.all(axis=1)] = self.width * self.height
+        areas[~in_front.any(axis=1)] = 0
+        return areas
+
+    def accepts(self, positions, rotations):
+        """True if at least one target can cover min_pixels of the image."""
+        return len(positions) == 0 or bool(np.any(self.areas(positions, rotations) >= self.min_pixels))
+
+
+class SpatialHash:
+    """Placed spheres hashed by the cell of their center; cells are as large as the largest sphere."""
+
+    def __init__(self, cell_size):
+        self.cell_size = max(float(cell_size), 1e-6)
+        self.centers = []
+        self.radii = []
+        self.cells = {}
+
+    def _cell(self, point):
+        return tuple(np.floor(np.asarray(point) / self.cell_size).astype(int))
+
+    def add(self, center, radius):
+        self.cells.setdefault(self._cell(center), []).append(len(self.centers))
+        self.centers.append(np.asarray(center, dtype=float))
+        self.radii.append(float(radius))
+
+    def free(self, candidates, radius):
+        """(n,) True for the candidate centers whose sphere of 'radius' overlaps no placed sphere."""
+        candidates = np.asarray(candidates, dtype=float).reshape(-1, 3)
+        if not self.centers:
+            return np.ones(len(candidates), dtype=bool)
+        # spheres no larger than a cell can only touch the 27 cells around a center
+        reach = int(np.ceil(radius / self.cell_size)) + 1
+        offsets = range(-reach, reach + 1)
+        neighbours = set()
+        for cell in {self._cell(cc) for cc in candidates}:
+            for dx in offsets:
+                for dy in offsets:
+                    for dz in offsets:
+                        neighbours.update(self.cells.get((cell[0]+dx, cell[1]+dy, cell[2]+dz), ()))
+        if not neighbours:
+            return np.ones(len(candidates), dtype=bool)
+        neighbours = sorted(neighbours)
+        centers = np.stack([self.centers[ii] for ii in neighbours])
+        radii = np.array([self.radii[ii] for ii in neighbours])
+        distances = np.linalg.norm(candidates[:, None, :] - centers[None, :, :], axis=2)
+        return np.all(distances >= radii[None, :] + radius, axis=1)
+
+
+def move_to_free(placed, positions, radii, candidates, selected):
+    """
+    Move every selected row of 'positions' (n, 3) to the first of its
+    'candidates' (n, k, 3) whose sphere does not overlap a sphere of 'placed';
+    a row whose candidates all overlap keeps its position. The spheres of the
+    rows that are not selected must already be in 'placed'; the selected ones
+    are added. Returns the new positions and which rows moved.
+    """
+    positions = np.array(positions, dtype=float)
+    moved = np.zeros(len(positions), dtype=bool)
+    for ii in np.flatnonzero(selected):
+        free = placed.free(candidates[ii], radii[ii])
+        if free.any():
+            positions[ii] = candidates[ii, int(np.argmax(free))]
+            moved[ii] = True
+        placed.add(positions[ii], radii[ii])
+    return positions, moved
+
+
+class PlacementSampler:
+    """
+    object_radii     - bounding sphere radius of every target object
+    distractor_radii - bounding sphere radius of every distractor
+    fov, cam2world   - camera the distractors are placed in front of
+    max_attempts     - candidates drawn per object before accepting an overlap
+    frustum_check    - optional FrustumCheck of the targets of every draw
+    max_resamples    - draws of the targets repeated when the frustum check fails
+    """
+
+    def __init__(self, object_radii, distractor_radii, fov, cam2world, object_near=20.0, object_far=100.0,
+                 distractor_near=5.0, distractor_far=100.0, max_attempts=32, frustum_check=None,
+                 max_resamples=10):
+        self.object_radii = np.asarray(object_radii, dtype=float)
+        self.distractor_radii = np.asarray(distractor_radii, dtype=float)
+        self.fov = fov
+        self.cam2world = np.asarray(cam2world, dtype=float)
+        self.object_range = (object_near, object_far)
+        self.distractor_range = (distractor_near, distractor_far)
+        self.max_attempts = max_attempts
+        radii = np.concatenate([self.object_radii, self.distractor_radii, [1e-3]])
+        self.cell_size = 2 * radii.max()
+        self.frustum_check = frustum_check
+        self.max_resamples = max_resamples
+        self.nb_overlaps = 0 # objects placed with an overlap after max_attempts candidates
+        self.nb_draws = 0 # draws of the targets, resamples included
+        self.nb_rejected_draws = 0 # draws that failed the frustum check
+        self.nb_frames = 0
+        self.nb_rejected_frames = 0 # frames without a visible target after max_resamples
+
+    def sample(self, rng):
+        """
+        Poses of one frame: (object positions (n, 3), object rotations
+        (n, 3, 3), distractor positions (m, 3), distractor rotations (m, 3, 3),
+        accepted), where 'accepted' is False if the frustum check still fails
+        after max_resamples draws.
+        """
+        row, nb_draws = self._draw(rng)
+        self.nb_frames += 1
+        self.nb_draws += nb_draws
+        self.nb_rejected_draws += nb_draws - int(row[4])
+        self.nb_rejected_frames += not row[4]
+        return row
+
+    def _draw(self, rng):
+        """Poses of one frame like sample(), and the number of target draws, without counting the frame."""
+        for nb_draws in range(1, (self.max_resamples + 1 if self.frustum_check is not None else 1) + 1):
+            placed = SpatialHash(self.cell_size)
+            object_positions = self._place(placed, self.object_radii, rng,
+                                           lambda n: random_object_positions(n, rng, *self.object_range))
+            object_rotations = random_rotation_matrices(len(self.object_radii), rng)
+            accepted = self.frustum_check is None or self.frustum_check.accepts(object_positions,
+                                                                                object_rotations)
+            if accepted:
+                break
+
+        distractor_positions = self._place(placed, self.distractor_radii, rng,
+                                           lambda n: frustum_points(n, rng, self.fov, self.cam2world,
+                                                                    *self.distractor_range))
+        return (object_positions, object_rotations, distractor_positions,
+                random_rotation_matrices(len(self.distractor_radii), rng), accepted), nb_draws
+
+    def report(self):
+        """Acceptance rate of the frustum check, i.e. the share of renders it saved."""
+        if self.nb_draws == 0:
+            return "frustum check: no draws"
+        return (f"frustum check: {self.nb_draws - self.nb_rejected_draws}/{self.nb_draws} draws accepted "
+                f"({100.0 * (1 - self.nb_rejected_draws / self.nb_draws):.1f}%), "
+                f"{self.nb_rejected_draws} renders of frames without a visible target avoided, "
+                f"{self.nb_rejected_frames}/{self.nb_frames} frames skipped")
+
+    def _place(self, placed, radii, rng, draw):
+        positions = np.zeros((len(radii), 3))
+        if len(radii) == 0:
+            return positions
+        # every object gets a batch of candidates; the first free one is kept
+        candidates = draw(len(radii) * self.max_attempts).reshape(len(radii), self.max_attempts, 3)
+        for ii, radius in enumerate(radii):
+            free = placed.free(candidates[ii], radius)
+            choice = int(np.argmax(free))
+            if not free[choice]:
+                self.nb_overlaps += 1
+            positions[ii] = candidates[ii, choice]
+            placed.add(positions[ii], radius)
+        return positions
+
+    def pose_table(self, frames, seed, diversity=None, backgrounds=None):
+        """
+        Poses of the given frames as a dictionary of stacked arrays, see sample().
+        With a PoseIndex 'diversity' (see pose_diversity.py), draws closer than its
+        threshold to an earlier frame of the same background ('backgrounds' maps a
+        frame to its background id) are redrawn, and frames that stay near
+        duplicates are not accepted.
+        """
+        rows = []
+        for frame in frames:
+            rng = np.random.default_rng(frame_seed(seed, frame, PLACEMENT_STREAM))
+            row = self.sample(rng)
+            if diversity is not None and row[4]:
+                background = backgrounds(frame) if backgrounds is not None else 0
+                descriptor = diversity.describe(row[0], row[1])
+                for attempt in range(diversity.max_resamples):
+                    if not diversity.is_duplicate(descriptor, background):
+                        break
+                    diversity.nb_resampled += 1
+                    # redraws are not frames: they leave the frustum check counters alone
+                    candidate, _ = self._draw(rng)
+                    # redraws that fail the frustum check are not used
+                    if candidate[4]:
+                        row = candidate
+                        descriptor = diversity.describe(row[0], row[1])
+                if diversity.is_duplicate(descriptor, background):
+                    diversity.nb_rejected += 1
+                    row = row[0:4] + (False,)
+                else:
+                    diversity.add(descriptor, background)
+            rows.append(row)
+        names = ['object_positions', 'object_rotations', 'distractor_positions', 'distractor_rotations',
+                 'accepted']
+        table = {name: np.stack([row[ii] for row in rows]) if rows else np.zeros((0,))
+                 for ii, name in enumerate(names)}
+        table['frames'] = np.asarray(list(frames), dtype=np.int64)
+        return table
+
+
+def selftest(nb_samples=200000, seed=0):
+    """Statistical checks of the samplers; returns True if they all pass."""
+    rng = np.random.default_rng(seed)
+    passed = True
+
+    def check(name, statistic, threshold):
+        nonlocal passed
+        ok = statistic < threshold
+        passed &= ok
+        print(f"{'ok  ' if ok else 'FAIL'} {name}: {statistic:.5f} (< {threshold})")
+
+    # Kolmogorov-Smirnov distance of the depths to the volume CDF of the frustum
+    near, far = 5.0, 100.0
+    depths = np.sort(frustum_depths(nb_samples, rng, near, far))
+    cdf = (depths**3 - near**3) / (far**3 - near**3)
+    ks = np.max(np.abs(cdf - np.arange(1, nb_samples + 1) / nb_samples))
+    check("frustum depth KS distance", ks, 1.63 / np.sqrt(nb_samples)) # 1% level
+
+    # equal volume slabs of the frustum get the same number of points (chi square, 19 dof)
+    fov = (0.785398, 0.6)
+    points = frustum_points(nb_samples, rng, fov, np.eye(4), near, far)
+    edges = np.cbrt(near**3 + np.linspace(0, 1, 21) * (far**3 - near**3))
+    counts = np.histogram(-points[:, 2], edges)[0]
+    expected = nb_samples / 20
+    check("frustum slab chi square", np.sum((counts - expected)**2 / expected), 36.19) # 1% level
+
+    # the points fill the cross section of their depth uniformly and stay inside it
+    u = points[:, 0] / (-points[:, 2] * np.tan(fov[0] / 2))
+    v = points[:, 1] / (-points[:, 2] * np.tan(fov[1] / 2))
+    check("frustum cross section bound", max(np.abs(u).max(), np.abs(v).max()) - 1.0, 1e-9)
+    counts = np.histogram2d(u, v, bins=10, range=[[-1, 1], [-1, 1]])[0]
+    expected = nb_samples / 100
+    check("frustum cross section chi square", np.sum((counts - expected)**2 / expected), 134.64) # 99 dof
+
+    # rotations are orthonormal
+    rotations = random_rotation_matrices(1000, rng)
+    error = np.abs(rotations @ np.transpose(rotations, (0, 2, 1)) - np.eye(3)).max()
+    check("rotation orthonormality error", error, 1e-9)
+
+    # placed spheres do not overlap when there is room for them
+    sampler = PlacementSampler(np.full(5, 3.0), np.full(10, 2.0), fov, np.eye(4))
+    overlaps = 0
+    for _ in range(200):
+        objects, _, distractors, _, _ = sampler.sample(rng)
+        centers = np.concatenate([objects, distractors])
+        radii = np.concatenate([sampler.object_radii, sampler.distractor_radii])
+        distances = np.linalg.norm(centers[:, None] - centers[None], axis=2)
+        overlaps += int(np.sum(np.triu(distances < radii[:, None] + radii[None] - 1e-9, 1)))
+    check("overlapping pairs", overlaps, 1)
+
+    # the frustum check keeps a target in front of the camera and rejects one behind it or off to the side
+    box = np.array([[x, y, z] for x in (-1, 1) for y in (-1, 1) for z in (-1, 1)], dtype=float)
+    K = np.array([[500.0, 0, 320], [0, 500.0, 240], [0, 0, 1]])
+    frustum = FrustumCheck(box[None], 1.0, np.eye(4), K, 640, 480, min_pixels=100)
+    areas = [frustum.areas(np.array([position], dtype=float), np.eye(3)[None])[0]
+             for position in ([0, 0, -20], [0, 0, 20], [200, 0, -20], [0, 0, -2000])]
+    check("frustum check visible area error", abs(areas[0] - (2 * 500 / 19)**2), 1.0)
+    check("frustum check rejected area", max(areas[1:]), 100)
+    return passed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--selftest', action='store_true', help="run the statistical checks of the samplers")
+    parser.add_argument('--nb_samples', default=200000, type=int, help="samples drawn by the checks")
+    parser.add_argument('--seed', default=0, type=int, help="seed of the checks")
+    opt = parser.parse_args()
+
+    if opt.selftest:
+        sys.exit(0 if selftest(opt.nb_samples, opt.seed) else 1)
+    parser.print_help()
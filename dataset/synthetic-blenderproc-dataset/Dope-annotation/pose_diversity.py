@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+
+"""
+Nearest neighbour index of the poses of the generated frames, used to skip
+near-duplicate frames before they are rendered.
+
+Every frame is described by a compact vector holding, per object, its
+location in the camera frame (divided by 'location_scale') and its
+camera-relative rotation as a unit quaternion with w >= 0. The distance
+between two frames is the RMS over the objects of the distance between their
+descriptors. Frames are only compared with frames of the same background, so
+the same pose over another backdrop is never a duplicate.
+
+The index appends the descriptors to preallocated arrays and answers a query
+with one vectorized distance computation over the frames of the background.
+That is cheap next to a render even for hundreds of thousands of frames.
+
+coverage() summarizes how well the accepted frames fill the pose space:
+the nearest neighbour distances, the share of coarse camera-frame location
+cells and of viewpoint bins that hold at least one object, and the number of
+frames per background.
+
+    python pose_diversity.py output/0/pose_coverage.json
+"""
+
+import argparse
+import json
+
+import numpy as np
+
+
+COVERAGE_NAME = 'pose_coverage.json'
+VIEWPOINT_BINS = (24, 12) # azimuth x elevation bins of equal area on the view sphere
+
+
+def rotation_quaternions(rotations):
+    """(..., 4) unit quaternions [w, x, y, z] with w >= 0 of rotation matrices (..., 3, 3)."""
+    R = np.asarray(rotations, dtype=float)
+    trace = R[..., 0, 0] + R[..., 1, 1] + R[..., 2, 2]
+    w = 0.5 * np.sqrt(np.maximum(0.0, 1.0 + trace))
+    x = 0.5 * np.sqrt(np.maximum(0.0, 1.0 + R[..., 0, 0] - R[..., 1, 1] - R[..., 2, 2]))
+    y = 0.5 * np.sqrt(np.maximum(0.0, 1.0 - R[..., 0, 0] + R[..., 1, 1] - R[..., 2, 2]))
+    z = 0.5 * np.sqrt(np.maximum(0.0, 1.0 - R[..., 0, 0] - R[..., 1, 1] + R[..., 2, 2]))
+    x = np.copysign(x, R[..., 2, 1] - R[..., 1, 2])
+    y = np.copysign(y, R[..., 0, 2] - R[..., 2, 0])
+    z = np.copysign(z, R[..., 1, 0] - R[..., 0, 1])
+    q = np.stack([w, x, y, z], axis=-1)
+    return q / np.linalg.norm(q, axis=-1, keepdims=True)
+
+
+class PoseIndex:
+    """
+    cam2world      - 4x4 pose of the camera the object poses are seen from
+    threshold      - frames closer than this to an indexed frame are near duplicates; 0 keeps all
+    location_scale - camera-frame distance that counts as much as a unit of quaternion distance
+    max_resamples  - draws of a frame repeated while it is a near duplicate
+    """
+
+    def __init__(self, cam2world, threshold, location_scale=10.0, max_resamples=10):
+        self.world2cam = np.linalg.inv(np.asarray(cam2world, dtype=float))
+        self.threshold = threshold
+        self.location_scale = location_scale
+        self.max_resamples = max_resamples
+        self._descriptors = {} # background id -> (array, number of rows used)
+        self.nearest_distances = [] # distance of every accepted frame to its nearest earlier frame
+        self.locations = [] # camera-frame locations of the objects of the accepted frames
+        self.viewpoints = [] # direction of the camera in the object frames
+        self.background_frames = {}
+        self.nb_resampled = 0 # draws redrawn because they were near duplicates
+        self.nb_rejected = 0 # frames still near duplicates after max_resamples
+
+    def describe(self, positions, rotations):
+        """Descriptor of a frame from the world positions (n, 3) and rotations (n, 3, 3) of its objects."""
+        locations = positions @ self.world2cam[0:3, 0:3].T + self.world2cam[0:3, 3]
+        quaternions = rotation_quaternions(self.world2cam[0:3, 0:3] @ rotations)
+        return np.concatenate([locations / self.location_scale, quaternions], axis=1).ravel()
+
+    def distance(self, descriptor, background=0):
+        """RMS distance per object of 'descriptor' to the nearest indexed frame of the background."""
+        descriptors, size = self._descriptors.get(background, (None, 0))
+        if size == 0:
+            return np.inf
+        nb_objects = max(1, len(descriptor) // 7)
+        squared = np.sum((descriptors[0:size] - descriptor)**2, axis=1)
+        return float(np.sqrt(squared.min() / nb_objects))
+
+    def is_duplicate(self, descriptor, background=0):
+        return self.threshold > 0 and self.distance(descriptor, background) < self.threshold
+
+    def add(self, descriptor, background=0):
+        self.nearest_distances.append(self.distance(descriptor, background))
+        descriptors, size = self._descriptors.get(background, (None, 0))
+        if descriptors is None or size == len(descriptors):
+            grown = np.empty((max(64, 2 * size), len(descriptor)))
+            if size:
+                grown[0:size] = descriptors[0:size]
+            descriptors = grown
+        descriptors[size] = descriptor
+        self._descriptors[background] = (descriptors, size + 1)
+        self.background_frames[background] = self.background_frames.get(background, 0) + 1
+
+        rows = descriptor.reshape(-1, 7)
+        locations = rows[:, 0:3] * self.location_scale
+        self.locations.extend(locations)
+        # camera position in the object frame: the rotation of the object undone on -location
+        w, v = rows[:, 3:4], -rows[:, 4:7]
+        direction = -locations / np.maximum(np.linalg.norm(locations, axis=1, keepdims=True), 1e-9)
+        t = 2 * np.cross(v, direction)
+        self.viewpoints.extend(direction + w * t + np.cross(v, t))
+
+    def coverage(self):
+        """Coverage statistics of the accepted frames, as a JSON serializable dictionary."""
+        distances = np.array([dd for dd in self.nearest_distances if np.isfinite(dd)])
+        stats = {
+            'nb_frames': len(self.nearest_distances),
+            'nb_resampled': self.nb_resampled,
+            'nb_rejected': self.nb_rejected,
+            'threshold': self.threshold,
+            'location_scale': self.location_scale,
+            'nb_backgrounds': len(self.background_frames),
+            'frames_per_background': {'min': min(self.background_frames.values(), default=0),
+                                      'max': max(self.background_frames.values(), default=0)},
+        }
+        if len(distances):
+            stats['nearest_distance'] = {name: float(np.percentile(distances, pp))
+                                         for name, pp in (('p5', 5), ('p50', 50), ('p95', 95))}
+        if self.locations:
+            cells = np.floor(np.asarray(self.locations) / self.location_scale).astype(np.int64)
+            occupied = np.unique(cells, axis=0)
+            extent = cells.max(axis=0) - cells.min(axis=0) + 1
+            stats['location_cells'] = {'occupied': len(occupied), 'box': int(np.prod(extent)),
+                                       'share': len(occupied) / float(np.prod(extent))}
+        if self.viewpoints:
+            view = np.asarray(self.viewpoints)
+            azimuth = np.floor((np.arctan2(view[:, 1], view[:, 0]) + np.pi) / (2 * np.pi)
+                               * VIEWPOINT_BINS[0]).astype(np.int64) % VIEWPOINT_BINS[0]
+            elevation = np.clip(np.floor((view[:, 2] + 1) / 2 * VIEWPOINT_BINS[1]).astype(np.int64),
+                                0, VIEWPOINT_BINS[1] - 1)
+            occupied = len(np.unique(azimuth * VIEWPOINT_BINS[1] + elevation))
+            stats['viewpoint_bins'] = {'occupied': occupied, 'total': VIEWPOINT_BINS[0] * VIEWPOINT_BINS[1],
+                                       'share': occupied / float(VIEWPOINT_BINS[0] * VIEWPOINT_BINS[1])}
+        return stats
+
+    def report(self):
+        stats = self.coverage()
+        line = (f"pose diversity: {stats['nb_frames']} frames, {stats['nb_resampled']} near duplicate draws "
+                f"redrawn, {stats['nb_rejected']} frames skipped")
+        if 'viewpoint_bins' in stats:
+            line += f", {100.0 * stats['viewpoint_bins']['share']:.1f}% of the viewpoint bins covered"
+        return line
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.coverage(), f, indent=4)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('coverage', help="pose coverage statistics saved by a generator run")
+    opt = parser.parse_args()
+
+    with open(opt.coverage) as f:
+        print(json.dumps(json.load(f), indent=4))
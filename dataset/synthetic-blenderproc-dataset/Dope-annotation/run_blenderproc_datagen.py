@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+
+"""
+Run a BlenderProc generator in several headless worker processes.
+
+The requested number of frames is split into one shard per worker. Every
+shard gets its own seed and output directory (--run_id), workers that crash
+are restarted, and once all of them are done the shards are merged into a
+single dataset with contiguous frame numbers. Restarted workers run with
+--resume, so they only regenerate the frames missing from their manifest.
+
+    python run_blenderproc_datagen.py --nb_workers 8 --nb_frames 25000 \
+        --outf dataset/ -- --width 1920 --height 1080 --objs_folder models/
+
+Every argument after '--' is passed to the generator script unchanged.
+"""
+
+import argparse
+import os
+import re
+import shutil
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+from frame_manifest import FRAME_SUFFIXES, MANIFEST_NAME
+from occlusion_controller import STATE_NAME
+from pose_diversity import COVERAGE_NAME
+
+
+# files of a shard that describe its run and are not merged
+RUN_FILES = (MANIFEST_NAME, STATE_NAME, COVERAGE_NAME)
+FRAME_PATTERN = re.compile(r'^(.*?)(\d+)(' + '|'.join(re.escape(ss) for ss in FRAME_SUFFIXES) + r')$')
+
+
+def shard_sizes(nb_frames, nb_shards):
+    """Split nb_frames into nb_shards sizes that differ by at most one frame."""
+    base, extra = divmod(nb_frames, nb_shards)
+    return [base + (1 if ii < extra else 0) for ii in range(nb_shards)]
+
+
+def shard_seeds(seed, nb_shards):
+    """Independent, reproducible seeds for every shard of a run."""
+    children = np.random.SeedSequence(seed).spawn(nb_shards)
+    return [int(cc.generate_state(1)[0]) for cc in children]
+
+
+def worker_command(args, run_id, nb_frames, seed, script_args):
+    return ['blenderproc', 'run', args.script,
+            '--nb_runs', str(args.nb_workers),
+            '--run_id', str(run_id),
+            '--nb_frames', str(nb_frames),
+            '--seed', str(seed),
+            '--cpu_threads', str(args.cpu_threads),
+            '--outf', args.shards_dir] + script_args
+
+
+def start_worker(args, run_id, command):
+    log_path = os.path.join(args.shards_dir, f"run_{run_id}.log")
+    log = open(log_path, 'a')
+    process = subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT)
+    log.close()
+    return process
+
+
+def run_workers(args, script_args):
+    sizes = shard_sizes(args.nb_frames, args.nb_workers)
+    seeds = shard_seeds(args.seed, args.nb_workers)
+    commands = {run_id: worker_command(args, run_id, sizes[run_id], seeds[run_id], script_args)
+                for run_id in range(args.nb_workers) if sizes[run_id] > 0}
+
+    first_args = ['--resume'] if args.resume else []
+    running = {run_id: start_worker(args, run_id, cmd + first_args)
+               for run_id, cmd in commands.items()}
+    restarts = {run_id: 0 for run_id in commands}
+    failed = []
+    while running:
+        time.sleep(args.poll_interval)
+        for run_id, process in list(running.items()):
+            code = process.poll()
+            if code is None:
+                continue
+            del running[run_id]
+            if code == 0:
+                print(f"run {run_id} finished ({sizes[run_id]} frames)")
+            elif restarts[run_id] < args.max_restarts:
+                restarts[run_id] += 1
+                print(f"run {run_id} exited with code {code}, restarting "
+                      f"({restarts[run_id]}/{args.max_restarts})")
+                # the frames finished before the crash are kept
+                running[run_id] = start_worker(args, run_id, commands[run_id] + ['--resume'])
+            else:
+                print(f"run {run_id} exited with code {code}, giving up")
+                failed.append(run_id)
+
+    return sorted(commands), failed
+
+
+def frame_key(filename):
+    """
+    Split an output file name into its frame number and the rest of the name,
+    e.g. 'frame_000012.json' -> ('frame_', 12, '.json'). Returns None for
+    files that are not frames, such as the temporary files of an interrupted
+    writer ('000012.png.<pid>.<thread>.tmp').
+    """
+    match = FRAME_PATTERN.match(filename)
+    if match is None:
+        return None
+    return match.group(1), int(match.group(2)), len(match.group(2)), match.group(3)
+
+
+def next_free_frame(directory):
+    """Number after the highest frame already in 'directory', 0 if it holds none."""
+    numbers = [key[1] for key in map(frame_key, os.listdir(directory)) if key is not None]
+    return max(numbers) + 1 if numbers else 0
+
+
+def merge_shards(args, run_ids):
+    """
+    Move the frames of all shards into args.outf, renumbered contiguously
+    after the frames it already holds. Returns the number of frames merged
+    and the paths of the shard files that were not merged.
+    """
+    next_frame = first_frame = next_free_frame(args.outf)
+    left = []
+    for run_id in run_ids:
+        shard = os.path.join(args.shards_dir, str(run_id))
+        if not os.path.isdir(shard):
+            continue
+
+        frames = {}
+        for filename in os.listdir(shard):
+            key = frame_key(filename)
+            if key is not None:
+                frames.setdefault(key[1], []).append((filename, key))
+            elif filename not in RUN_FILES:
+                left.append(os.path.join(shard, filename))
+
+        for frame in sorted(frames):
+            for filename, (prefix, _, width, suffix) in frames[frame]:
+                target = os.path.join(args.outf, f"{prefix}{str(next_frame).zfill(width)}{suffix}")
+                if os.path.exists(target):
+                    # never replace a frame of another run
+                    raise FileExistsError(f"'{target}' already exists")
+                os.replace(os.path.join(shard, filename), target)
+            next_frame += 1
+
+    return next_frame - first_frame, left
+
+
+def main(args, script_args):
+    args.shards_dir = os.path.join(args.outf, 'shards')
+    os.makedirs(args.shards_dir, exist_ok=True)
+    if args.cpu_threads == 0:
+        args.cpu_threads = max(1, (os.cpu_count() or 1) // args.nb_workers)
+
+    run_ids, failed = run_workers(args, script_args)
+    if failed:
+        print(f"runs {failed} failed; their partial output is merged as well")
+
+    nb_merged, left = merge_shards(args, run_ids)
+    print(f"{nb_merged} frames merged into '{args.outf}'")
+
+    if left:
+        print(f"{len(left)} files of the shards were not merged (e.g. '{left[0]}'); "
+              f"keeping '{args.shards_dir}'")
+    elif not args.keep_shards and not failed:
+        shutil.rmtree(args.shards_dir)
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        '--script',
+        default='dope_model.py',
+        help='BlenderProc generator to run; it must accept --run_id, --nb_runs, --nb_frames, '
+        '--seed, --cpu_threads, --resume and --outf'
+    )
+    parser.add_argument(
+        '--nb_workers',
+        default=os.cpu_count() or 1,
+        type=int,
+        help='Number of BlenderProc processes (shards) to run in parallel'
+    )
+    parser.add_argument(
+        '--nb_frames',
+        default=2000,
+        type=int,
+        help='Total number of frames to generate over all the shards'
+    )
+    parser.add_argument(
+        '--seed',
+        default=0,
+        type=int,
+        help='Seed from which the seed of every shard is derived'
+    )
+    parser.add_argument(
+        '--cpu_threads',
+        default=0,
+        type=int,
+        help='Render threads per worker; 0 divides the available cores between the workers'
+    )
+    parser.add_argument(
+        '--resume',
+        action='store_true',
+        default=False,
+        help='Resume the shards of a launch that was interrupted before the merge'
+    )
+    parser.add_argument(
+        '--max_restarts',
+        default=3,
+        type=int,
+        help='How many times a crashed worker is restarted before giving up'
+    )
+    parser.add_argument(
+        '--poll_interval',
+        default=2.0,
+        type=float,
+        help='Seconds between checks of the worker processes'
+    )
+    parser.add_argument(
+        '--outf',
+        default='output_example/',
+        help='Directory of the merged dataset; shards are written to its shards/ subdirectory'
+    )
+    parser.add_argument(
+        '--keep_shards',
+        action='store_true',
+        default=False,
+        help='Keep the per-shard directories and logs after merging'
+    )
+
+    argv = sys.argv[1:]
+    script_args = []
+    if '--' in argv:
+        split = argv.index('--')
+        argv, script_args = argv[:split], argv[split+1:]
+
+    opt = parser.parse_args(argv)
+    sys.exit(main(opt, script_args))
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+
+"""
+Pools of lights and occluders that are reused from frame to frame.
+
+Instead of creating new lights and primitives every frame (and never removing
+them), the generators take what they need from a pool. Each frame they re-pose
+and re-parameterize the entities they use, and the pool hides the rest. The
+scene keeps a constant size, so the per-frame cost stays the same over
+arbitrarily long runs. A pool grows only if a frame asks for more entities
+than it holds.
+
+Must be imported after blenderproc, from a script run with 'blenderproc run'.
+"""
+
+import blenderproc as bproc
+
+
+def _set_hidden(entity, hidden):
+    entity.blender_obj.hide_render = hidden
+    entity.blender_obj.hide_viewport = hidden
+
+
+class LightPool:
+    """
+    size       - lights created up front
+    light_type - blender light type of the pooled lights
+    """
+
+    def __init__(self, size=0, light_type='POINT'):
+        self.light_type = light_type
+        self.lights = []
+        self._grow(size)
+
+    def use(self, count):
+        """The first 'count' lights of the pool, visible; all the other lights are hidden."""
+        self._grow(count)
+        for ii, light in enumerate(self.lights):
+            _set_hidden(light, ii >= count)
+        return self.lights[:count]
+
+    def _grow(self, size):
+        while len(self.lights) < size:
+            light = bproc.types.Light()
+            light.set_type(self.light_type)
+            self.lights.append(light)
+
+
+class OccluderPool:
+    """
+    size      - primitives of every shape created up front
+    shapes    - blender primitive types, e.g. 'CUBE' or 'SPHERE'
+    rigidbody - give the primitives an active rigid body when they are created
+    """
+
+    def __init__(self, size=0, shapes=('CUBE', 'SPHERE'), rigidbody=True):
+        self.rigidbody = rigidbody
+        self.occluders = {shape: [] for shape in shapes}
+        for shape in shapes:
+            self._grow(shape, size)
+
+    def use(self, shapes):
+        """
+        One visible primitive for every entry of 'shapes' (in that order); the
+        primitives that are not used this frame are hidden.
+        """
+        used = []
+        next_index = {shape: 0 for shape in self.occluders}
+        for shape in shapes:
+            self._grow(shape, next_index[shape] + 1)
+            used.append(self.occluders[shape][next_index[shape]])
+            next_index[shape] += 1
+        for shape, occluders in self.occluders.items():
+            for ii, occluder in enumerate(occluders):
+                _set_hidden(occluder, ii >= next_index[shape])
+        return used
+
+    def _grow(self, shape, size):
+        occluders = self.occluders.setdefault(shape, [])
+        while len(occluders) < size:
+            occluder = bproc.object.create_primitive(shape)
+            if self.rigidbody:
+                occluder.enable_rigidbody(active=True, mass=1.0)
+            occluders.append(occluder)
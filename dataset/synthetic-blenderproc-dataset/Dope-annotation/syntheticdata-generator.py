@@ -3,29 +3,20 @@
 import blenderproc as bproc
 import argparse
 import os
+import sys
 import numpy as np
 from PIL import Image, ImageDraw
-import cv2
-import json
 from scipy.spatial.transform import Rotation as R  # Import scipy for quaternion conversion
 
-def get_cuboid_image_space(mesh, camera):
-    """Project the 3D cuboid corners into 2D image space."""
-    bbox = mesh.get_bound_box()
-    centroid = np.mean(bbox, axis=0)
+from annotation_shards import FRAMES_PER_SHARD, ShardedAnnotationWriter
+from async_writer import AsyncWriter
+from cuboid_projection import project_cuboids
+from frame_manifest import FrameManifest
+from frame_profiler import FrameProfiler
+from instance_stats import instance_stats
+from scene_pool import LightPool
 
-    cam_pose = np.linalg.inv(camera.get_camera_pose())  # world to camera transformation
-    tvec = -cam_pose[0:3, 3]
-    rvec = -cv2.Rodrigues(cam_pose[0:3, 0:3])[0]
-    K = camera.get_intrinsics_as_K_matrix()
-
-    # Reorder points to match the DOPE cuboid format
-    dope_order = [6, 2, 1, 5, 7, 3, 0, 4]
-    cuboid = [cv2.projectPoints(bbox[ii], rvec, tvec, K, np.array([]))[0][0][0] for ii in dope_order]
-    cuboid.append(cv2.projectPoints(centroid, rvec, tvec, K, np.array([]))[0][0][0])  # Add centroid
-    return np.array(cuboid, dtype=float).tolist()
-
-def write_json(outf, args, camera, objects, objects_data, seg_map):
+def write_json(outf, args, camera, objects, objects_data, seg_map, cuboids, writer):
     cam_xform = camera.get_camera_pose()
     eye = (-cam_xform[0:3, 3]).tolist()  # Apply negation first, then convert to list
     at = (-cam_xform[0:3, 2]).tolist()  # Apply negation first, then convert to list
@@ -52,15 +43,18 @@ def write_json(outf, args, camera, objects, objects_data, seg_map):
         "objects": []
     }
 
+    # Visibility, 2D box and truncation of every object from a single histogram pass
+    stats = instance_stats(seg_map, len(objects) + 1)
+
     # Object data
     for ii, obj in enumerate(objects):
         idx = ii + 1  # Object ID starts at 1
-        num_pixels = int(np.sum((seg_map == idx)))
+        num_pixels = int(stats.counts[idx])
 
         if num_pixels < args.min_pixels:
             continue
 
-        projected_keypoints = get_cuboid_image_space(obj, camera)
+        projected_keypoints = cuboids[ii].tolist()
 
         # Get the rotation matrix and convert to quaternion using scipy
         rotation_matrix = obj.get_rotation_mat()
@@ -70,32 +64,32 @@ def write_json(outf, args, camera, objects, objects_data, seg_map):
             'class': objects_data[ii]['class'],
             'name': objects_data[ii]['name'],
             'visibility': num_pixels,
-            'projected_cuboid': projected_keypoints,  # Already converted to list in get_cuboid_image_space
+            'bounding_box': stats.bounding_box(idx),
+            'truncated': bool(stats.truncated[idx]),
+            'projected_cuboid': projected_keypoints,
             'location': obj.get_location().tolist(),  # Convert location (ndarray) to list
             'quaternion_xyzw': quaternion.tolist()  # Convert quaternion (ndarray) to list
         })
 
-    with open(outf, "w") as write_file:
-        json.dump(data, write_file, indent=4)
+    writer.save_json(outf, data, indent=4)
 
     return data
 
-def draw_cuboid_markers(objects, camera, im):
+def draw_cuboid_markers(cuboids, im):
     """Draw cuboid markers (keypoints) on the image."""
     colors = ['yellow', 'magenta', 'blue', 'red', 'green', 'orange', 'brown', 'cyan', 'white']
     R = 2  # Radius of the keypoint markers
     draw = ImageDraw.Draw(im)  # Prepare to draw on the image
-    for obj in objects:
-        projected_keypoints = get_cuboid_image_space(obj, camera)  # Project to 2D
+    for projected_keypoints in cuboids:
         for idx, pp in enumerate(projected_keypoints):
             x, y = int(pp[0]), int(pp[1])
             draw.ellipse((x-R, y-R, x+R, y+R), fill=colors[idx % len(colors)])  # Draw colored markers
     return im
 
-def add_random_lights():
-    """Add random lights to the scene."""
+def add_random_lights(light_pool):
+    """Light the scene with random lights from the pool."""
     num_lights = np.random.randint(1, 4)  # Random number of lights (1 to 3)
-    for _ in range(num_lights):
+    for light in light_pool.use(num_lights):
         # Random position for the light
         light_location = np.random.uniform([-10, -10, 5], [10, 10, 15])
         
@@ -105,14 +99,35 @@ def add_random_lights():
         # Random color for the light
         light_color = np.random.uniform([0.8, 0.8, 0.8], [1, 1, 1])  # Slightly varying white
 
-        # Add the light to the scene
-        light = bproc.types.Light()
-        light.set_type('POINT')
+        # Re-parameterize the pooled light
         light.set_location(light_location)
         light.set_energy(light_intensity)
         light.set_color(light_color)
 
 def main(args):
+    # Make output directory
+    out_directory = args.outf if args.run_id is None else os.path.join(args.outf, str(args.run_id))
+    os.makedirs(out_directory, exist_ok=True)
+
+    # Frame manifest, used to resume an interrupted run
+    try:
+        manifest = FrameManifest.open(out_directory, args.seed, args.resume, args.overwrite)
+    except FileExistsError as e:
+        print(e)
+        sys.exit(1)
+
+    # PNG encoding and JSON dumps overlap the rendering of the next frame
+    writer = AsyncWriter(workers=args.writer_workers, max_pending=args.writer_queue,
+                         compress_level=args.png_compression, use_processes=args.writer_processes)
+
+    # Optional compact copy of the annotations for the training loader
+    shard_writer = None
+    if args.annotation_shards:
+        shard_writer = ShardedAnnotationWriter(args.annotation_shards, args.frames_per_shard)
+
+    # Seed the random generators so a run (or a shard of a run) can be reproduced
+    np.random.seed(manifest.seed)
+
     # Set up blenderproc
     bproc.init()
 
@@ -135,14 +150,33 @@ def main(args):
     # Renderer setup
     bproc.renderer.set_output_format('PNG')
     bproc.renderer.set_render_devices(desired_gpu_ids=[0])
+    if args.cpu_threads > 0:
+        bproc.renderer.set_cpu_threads(args.cpu_threads)
+
+    # Lights are reused from frame to frame so the scene keeps a constant size
+    light_pool = LightPool(size=3)
+
+    # Per-frame stage timings
+    profiler = FrameProfiler(args.profile, args.profile_report_every, args.cprofile_every)
 
     # Prepare folder for JSON data
-    for frame in range(args.nb_frames):
+    complete = [frame for frame in range(args.nb_frames) if args.resume and manifest.is_complete(frame)]
+    frames = sorted(set(range(args.nb_frames)) - set(complete))
+    if shard_writer is not None:
+        # finished frames whose annotations were lost with the buffer of an interrupted run
+        shard_writer.append_missing({f"frame_{frame:06d}": os.path.join(out_directory, f"frame_{frame:06d}.json")
+                                     for frame in complete})
+    for frame in profiler.frames(frames):
+        # Every frame has its own random state so it can be regenerated on its own
+        manifest.seed_frame(frame)
+
         # Add random lights to the scene
-        add_random_lights()
+        with profiler.stage('lights'):
+            add_random_lights(light_pool)
 
         # Render the scene
-        data = bproc.renderer.render()
+        with profiler.stage('render'):
+            data = bproc.renderer.render()
 
         # Get segmentation map
         seg_map = data.get("instance_segmaps")[0]  # Segmentation map of the first frame
@@ -156,18 +190,35 @@ def main(args):
                 'location': obj.get_location().tolist()  # Convert location to list
             })
 
+        # Project the cuboids of all target objects once for the JSON data and the debug overlay
+        with profiler.stage('projection'):
+            cuboids = project_cuboids(target_objects, bproc.camera)
+
         # Save JSON and images
-        json_filename = os.path.join(args.outf, f"frame_{frame:06d}.json")
-        write_json(json_filename, args, bproc.camera, target_objects, objects_data, seg_map)
+        json_filename = os.path.join(out_directory, f"frame_{frame:06d}.json")
+        with profiler.stage('write_json'):
+            frame_data = write_json(json_filename, args, bproc.camera, target_objects, objects_data, seg_map, cuboids, writer)
+            if shard_writer is not None:
+                shard_writer.append(f"frame_{frame:06d}", frame_data)
 
         im = Image.fromarray(data['colors'][0])
         if args.debug:
-            im = draw_cuboid_markers(target_objects, bproc.camera, im)
+            im = draw_cuboid_markers(cuboids, im)
+
+        image_filename = os.path.join(out_directory, f"frame_{frame:06d}.png")
+        with profiler.stage('save_image'):
+            writer.save_image(image_filename, np.asarray(im))
+
+        # The frame is recorded once its files are on disk
+        writer.after_pending(lambda frame=frame, files=[image_filename, json_filename]:
+                             manifest.record(frame, files))
 
-        image_filename = os.path.join(args.outf, f"frame_{frame:06d}.png")
-        im.save(image_filename)
+    writer.close()
+    if shard_writer is not None:
+        shard_writer.close()
+    profiler.close()
 
-    print(f"Saved JSON and images to {args.outf}")
+    print(f"Saved JSON and images to {out_directory}")
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -179,6 +230,25 @@ if __name__ == "__main__":
     parser.add_argument('--outf', default='output/', help="output folder for images and JSON data")
     parser.add_argument('--min_pixels', default=100, type=int, help="minimum number of pixels for visibility")
     parser.add_argument('--debug', action='store_true', help="Render cuboid markers for debugging purposes")
+    parser.add_argument('--seed', default=None, type=int, help="seed of the random generators")
+    parser.add_argument('--nb_runs', default=1, type=int, help="how many runs generate the dataset together (set by run_blenderproc_datagen.py)")
+    parser.add_argument('--run_id', default=None, type=int,
+                        help="if set, output files are put in a subdirectory of this name (set by run_blenderproc_datagen.py)")
+    parser.add_argument('--resume', action='store_true',
+                        help="skip the frames recorded as complete in the manifest of --outf and regenerate the rest")
+    parser.add_argument('--overwrite', action='store_true', help="start over in an output folder that already holds frames")
+    parser.add_argument('--annotation_shards', default=None,
+                        help="also append the annotations to sharded NumPy arrays in this folder (one folder per run)")
+    parser.add_argument('--frames_per_shard', default=FRAMES_PER_SHARD, type=int, help="how many frames each annotation shard holds")
+    parser.add_argument('--png_compression', default=6, type=int, help="PNG compression level, 0 (fastest) to 9 (smallest)")
+    parser.add_argument('--writer_workers', default=2, type=int,
+                        help="threads (or processes) writing the output files in the background, 0 writes synchronously")
+    parser.add_argument('--writer_queue', default=8, type=int, help="files that may wait to be written before rendering blocks")
+    parser.add_argument('--writer_processes', action='store_true', help="encode the output files in processes instead of threads")
+    parser.add_argument('--profile', default=None, help="write the time spent in every stage of every frame to this .jsonl or .csv file")
+    parser.add_argument('--profile_report_every', default=50, type=int, help="print the rolling frames per second every N frames, 0 disables it")
+    parser.add_argument('--cprofile_every', default=0, type=int, help="run every Nth frame under cProfile and dump its statistics, 0 disables it")
+    parser.add_argument('--cpu_threads', default=0, type=int, help="number of render threads, 0 lets blender decide")
 
     opt = parser.parse_args()
     main(opt)
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+
+"""
+YOLOv8-pose labels of the rendered objects.
+
+The cuboid keypoints of all the objects in all the poses of a batch are
+projected with a single array operation. Every image gets one label file
+written in a single write, with one line per visible object:
+
+    class x_center y_center width height  x1 y1 v1 ... x9 y9 v9
+
+Coordinates are normalized by the image size, and the 2D box is the tight box
+of the object's pixels in the segmentation map. The keypoints are the 8 box
+corners in DOPE order plus the centroid (kpt_shape: [9, 3]). The visibility
+flags follow the COCO convention:
+
+    0  outside the image or behind the camera (x and y are set to 0)
+    1  inside the image but hidden by another object
+    2  visible: the object covers a pixel within 'radius' of the keypoint
+
+The projection uses the Blender camera convention (looking down -Z, +Y up),
+like bproc.camera.project_points, and unlike the historical DOPE projection of
+cuboid_projection.py.
+"""
+
+import numpy as np
+
+from cuboid_projection import DOPE_ORDER
+from instance_stats import instance_stats
+
+
+def cuboid_keypoints(bboxes):
+    """(..., 8, 3) bounding box corners -> (..., 9, 3) keypoints: DOPE ordered corners plus centroid."""
+    bboxes = np.asarray(bboxes, dtype=float)
+    return np.concatenate([bboxes[..., DOPE_ORDER, :], bboxes.mean(axis=-2, keepdims=True)], axis=-2)
+
+
+def project_points(points, cam2world, K):
+    """
+    Project world points (n_poses, ..., 3) with the camera poses (n_poses, 4, 4)
+    of a Blender camera. Returns the pixels (n_poses, ..., 2) and the depths
+    in front of the camera (n_poses, ...).
+    """
+    points = np.asarray(points, dtype=float)
+    world2cam = np.linalg.inv(np.asarray(cam2world, dtype=float))
+    n_poses = points.shape[0]
+    flat = points.reshape(n_poses, -1, 3)
+    cam = flat @ np.transpose(world2cam[:, 0:3, 0:3], (0, 2, 1)) + world2cam[:, None, 0:3, 3]
+
+    # blender cameras look down -Z with +Y up; OpenCV looks down +Z with +Y down
+    depth = -cam[..., 2]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        u = K[0][0] * cam[..., 0] / depth + K[0][2]
+        v = -K[1][1] * cam[..., 1] / depth + K[1][2]
+    uv = np.stack([u, v], axis=-1)
+    return uv.reshape(points.shape[:-1] + (2,)), depth.reshape(points.shape[:-1])
+
+
+def keypoint_visibility(keypoints, depth, seg_map, ids, radius=2):
+    """
+    COCO visibility flags (n_objects, n_keypoints) of the pixel keypoints
+    (n_objects, n_keypoints, 2) of the objects 'ids' in one segmentation map.
+    """
+    height, width = seg_map.shape[0:2]
+    x = np.floor(keypoints[..., 0])
+    y = np.floor(keypoints[..., 1])
+    inside = (depth > 0) & (x >= 0) & (x < width) & (y >= 0) & (y < height)
+
+    # the object owns a pixel of the (2*radius+1)^2 window around the keypoint
+    xi = np.where(inside, x, 0).astype(int)
+    yi = np.where(inside, y, 0).astype(int)
+    offsets = np.arange(-radius, radius + 1)
+    wx = np.clip(xi[..., None, None] + offsets[None, :], 0, width - 1)
+    wy = np.clip(yi[..., None, None] + offsets[:, None], 0, height - 1)
+    owned = seg_map[wy, wx] == np.asarray(ids).reshape((-1,) + (1,) * (wx.ndim - 1))
+    visible = owned.any(axis=(-2, -1))
+
+    return np.where(inside, np.where(visible, 2, 1), 0).astype(np.int8)
+
+
+def yolo_pose_lines(keypoints, depth, seg_map, ids, class_ids, min_pixels=1, radius=2):
+    """
+    Label lines of one image. 'keypoints' (n_objects, 9, 2) and 'depth'
+    (n_objects, 9) are the projected cuboids of the objects whose pixels have
+    the value ids[i] in 'seg_map'. Objects with less than 'min_pixels' visible
+    pixels are left out.
+    """
+    if seg_map.ndim == 3:
+        seg_map = seg_map[..., 0]
+    height, width = seg_map.shape[0:2]
+    ids = np.asarray(ids)
+    stats = instance_stats(seg_map, int(ids.max()) + 1 if len(ids) else 1)
+    flags = keypoint_visibility(keypoints, depth, seg_map, ids, radius)
+
+    keep = stats.counts[ids] >= max(1, min_pixels)
+    if not keep.any():
+        return []
+
+    boxes = stats.bboxes[ids[keep]].astype(float)
+    size = np.array([width, height], dtype=float)
+    centers = (boxes[:, 0:2] + boxes[:, 2:4] + 1) / 2 / size
+    extents = (boxes[:, 2:4] - boxes[:, 0:2] + 1) / size
+
+    points = keypoints[keep] / size
+    points[flags[keep] == 0] = 0
+    values = np.concatenate([centers, extents,
+                             np.concatenate([points, flags[keep, :, None]], axis=-1)
+                             .reshape(len(boxes), -1)], axis=1)
+
+    lines = []
+    for class_id, row, kp_flags in zip(np.asarray(class_ids)[keep], values, flags[keep]):
+        fields = [str(int(class_id))] + [f"{vv:.6f}" for vv in row[0:4]]
+        for (px, py), flag in zip(row[4:].reshape(-1, 3)[:, 0:2], kp_flags):
+            fields += [f"{px:.6f}", f"{py:.6f}", str(int(flag))]
+        lines.append(' '.join(fields))
+    return lines
+
+
+def export_labels(label_paths, seg_maps, bboxes, cam2world, K, ids, class_ids, writer,
+                  min_pixels=1, radius=2):
+    """
+    Write the YOLOv8-pose label file of every pose of a batch.
+
+    label_paths - (n_poses,) label file of every pose
+    seg_maps    - (n_poses, H, W) maps of the object ids
+    bboxes      - (n_poses, n_objects, 8, 3) world bounding box corners
+    cam2world   - (n_poses, 4, 4) camera poses
+    K           - 3x3 intrinsics shared by the poses
+    ids         - (n_objects,) value of every object in the maps
+    class_ids   - (n_objects,) YOLO class of every object
+    writer      - AsyncWriter the files are saved with
+    """
+    keypoints, depth = project_points(cuboid_keypoints(bboxes), cam2world, K)
+    for path, seg_map, pose_keypoints, pose_depth in zip(label_paths, seg_maps, keypoints, depth):
+        lines = yolo_pose_lines(pose_keypoints, pose_depth, np.asarray(seg_map), ids, class_ids,
+                                min_pixels, radius)
+        writer.save_text(path, ''.join(line + '\n' for line in lines))